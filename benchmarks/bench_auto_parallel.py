@@ -0,0 +1,46 @@
+"""Time a block of independent commands with and without --auto-parallel
+
+Runs [number of commands] commands that each wait [seconds] and declare
+different resources, first one after the other and then with auto parallel.
+
+    bench_auto_parallel.py [number of commands] [seconds]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+parsescript.LOG = parsescript.ConfigLogging()
+
+
+def TimeSteps(raw_steps):
+    "Return the time in seconds to run the steps"
+    steps = parsescript.ParseSteps(raw_steps)
+    start = time.time()
+    parsescript.ExecuteSteps(steps, parsescript.VariableStore(), "run")
+    return time.time() - start
+
+
+def Main():
+    num_commands = 8
+    seconds = .2
+    if len(sys.argv) > 1:
+        num_commands = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        seconds = float(sys.argv[2])
+
+    raw_steps = [
+        '"%s" -c "import time; time.sleep(%s)" {*writes=file%d*}' % (
+            sys.executable, seconds, i)
+                for i in range(num_commands)]
+
+    print "in order:      %.2f s" % TimeSteps(raw_steps)
+    parsescript.AUTO_PARALLEL = True
+    print "auto parallel: %.2f s" % TimeSteps(raw_steps)
+
+
+if __name__ == "__main__":
+    Main()
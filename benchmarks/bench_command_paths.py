@@ -0,0 +1,59 @@
+"""Time checking that commands exist on a long PATH
+
+Creates a PATH of [number of folders] folders (with the commands in the last
+one) and validates [number of commands] commands, then reports the average
+time per command.
+
+    bench_command_paths.py [number of commands] [number of folders]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+
+def Main():
+    num_commands = 500
+    num_folders = 40
+    if len(sys.argv) > 1:
+        num_commands = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_folders = int(sys.argv[2])
+
+    root = tempfile.mkdtemp()
+    prev_path = os.environ.get('PATH', '')
+    try:
+        folders = []
+        for i in range(num_folders):
+            folder = os.path.join(root, "folder%d" % i)
+            os.mkdir(folder)
+            for j in range(20):
+                open(os.path.join(folder, "file%d.txt" % j), "w").close()
+            folders.append(folder)
+
+        command_file = os.path.join(folders[-1], "bench_command")
+        if sys.platform == "win32":
+            command_file += ".exe"
+        open(command_file, "w").close()
+        os.chmod(command_file, 0755)
+
+        os.environ['PATH'] = os.environ['path'] = os.pathsep.join(folders)
+
+        start = time.time()
+        for i in range(num_commands):
+            parsescript.ValidateCommandPath("bench_command arg%d" % i)
+        elapsed = time.time() - start
+        print "%d commands, %d folders: %.3f ms/command" % (
+            num_commands, num_folders, elapsed / num_commands * 1000)
+    finally:
+        os.environ['PATH'] = os.environ['path'] = prev_path
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    Main()
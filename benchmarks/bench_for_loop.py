@@ -0,0 +1,73 @@
+"""Measure the overhead of each iteration of a for loop
+
+Runs a for loop with a small body over many values and reports the time per
+iteration. For comparison the same loop is also run the way for loops used
+to run - with a "set" step parsed for every value and all the steps of the
+whole loop built before any of them are run. Where the resource module is
+available the peak memory use after each loop is also reported (the loop is
+run first - so the second figure includes the memory used by the unrolled
+loop).
+
+    bench_for_loop.py [number of values]
+"""
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+parsescript.LOG = parsescript.ConfigLogging()
+
+
+def PeakMemory():
+    "Return a description of the peak memory used so far"
+    if resource is None:
+        return ""
+    return "(peak memory %d MB)" % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def UnrolledLoop(step, values, variables):
+    "Run the loop step by unrolling all the values first"
+    loop_steps = []
+    for value in values.split("\n"):
+        loop_steps.append(parsescript.VariableDefinition(
+            "set %s = %s" % (step.variable, value)))
+        loop_steps.extend(step.steps)
+    parsescript.ExecuteSteps(loop_steps, variables, "run")
+
+
+def Main():
+    num_values = 100000
+    if len(sys.argv) > 1:
+        num_values = int(sys.argv[1])
+
+    values = "\n".join(["file_%d.txt" % i for i in range(num_values)])
+    step = parsescript.ParseStep(
+        {"for file in <values>": ["set last = <file>"]})
+
+    variables = parsescript.VariableStore({'values': values})
+    start = time.time()
+    step.execute(variables, "run")
+    elapsed = time.time() - start
+    assert variables['last'] == "file_%d.txt" % (num_values - 1)
+    print "for loop: %5.2f us per iteration (%d values) %s" % (
+        elapsed / num_values * 1000000, num_values, PeakMemory())
+
+    variables = parsescript.VariableStore({'values': values})
+    start = time.time()
+    UnrolledLoop(step, values, variables)
+    elapsed = time.time() - start
+    print "unrolled: %5.2f us per iteration %s" % (
+        elapsed / num_values * 1000000, PeakMemory())
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,69 @@
+"""Measure how quickly __loopvar__ references are matched to variables
+
+Builds a store of 5000 variables (environment variables plus mapping
+entries) and looks up references such as <map.<key> > as they are when
+checking the body of a loop, with the VariableStore index and by checking
+every variable.
+
+    bench_loopvar.py [number of variables] [number of lookups]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+
+def BuildVariables(num_vars):
+    "Return a dictionary of num_vars variables"
+    variables = {}
+    i = 0
+    while len(variables) < num_vars:
+        variables["shell.env_var_%d" % i] = "value %d" % i
+        variables["map_%d.key_%d" % (i % 50, i)] = "mapped %d" % i
+        i += 1
+    return variables
+
+
+REFERENCES = [
+    "map_7.__loopvar__",
+    "map___loopvar__.key_1234",
+    "__loopvar__.key_999",
+    "shell.__loopvar__",
+    "missing.__loopvar__",
+    ]
+
+
+def Rate(variables, count):
+    "Return the number of lookups per second"
+    start = time.time()
+    for i in xrange(count):
+        for reference in REFERENCES:
+            parsescript.FindVariableMatchingLoopVar(reference, variables)
+    return count * len(REFERENCES) / (time.time() - start)
+
+
+def Main():
+    num_vars = 5000
+    count = 200
+    if len(sys.argv) > 1:
+        num_vars = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+
+    variables = BuildVariables(num_vars)
+    store = parsescript.VariableStore(variables)
+
+    for reference in REFERENCES:
+        assert (parsescript.FindVariableMatchingLoopVar(reference, store) is
+            None) == (parsescript.FindVariableMatchingLoopVar(
+                reference, dict(store)) is None)
+
+    print "index: %9.0f lookups/s" % Rate(store, count)
+    print "scan:  %9.0f lookups/s" % Rate(dict(store), max(1, count / 20))
+
+
+if __name__ == "__main__":
+    Main()
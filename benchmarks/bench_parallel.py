@@ -0,0 +1,80 @@
+"""Measure the overhead of running the steps of a parallel block
+
+Runs a parallel block of short jobs in the shared pool and (for comparison)
+with one thread per job that is polled until it finishes - which is how
+parallel blocks used to be run. Then runs CPU bound jobs (like the in-process
+built in commands) in threads and in worker processes ({*processes*}).
+
+    bench_parallel.py [number of jobs] [job duration in ms] [max jobs]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parallel
+
+
+def CpuBound(count):
+    "A job that only uses the CPU"
+    total = 0
+    for i in xrange(count):
+        total += i * i
+    return total
+
+
+def ThreadPerJob(jobs):
+    "Run each job in its own thread and poll the threads until they finish"
+    threads = []
+    for job in jobs:
+        thread = threading.Thread(target = job)
+        thread.start()
+        threads.append(thread)
+
+    while threads:
+        for thread in threads:
+            thread.join(.01)
+            if not thread.isAlive():
+                threads.remove(thread)
+
+
+def Main():
+    num_jobs = 2000
+    duration = 0
+    if len(sys.argv) > 1:
+        num_jobs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        duration = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        parallel.MAX_JOBS = int(sys.argv[3])
+
+    def Job():
+        time.sleep(duration / 1000.0)
+    jobs = [Job] * num_jobs
+
+    start = time.time()
+    parallel.RunJobs(jobs)
+    print "pool (%d jobs):     %.2fs" % (
+        parallel.Pool().max_jobs, time.time() - start)
+
+    start = time.time()
+    ThreadPerJob(jobs)
+    print "thread per job:     %.2fs" % (time.time() - start)
+
+    cpu_jobs = [lambda: CpuBound(2000000)] * parallel.Pool().max_jobs * 2
+
+    start = time.time()
+    parallel.RunJobs(cpu_jobs)
+    print "CPU bound, threads:   %.2fs" % (time.time() - start)
+
+    start = time.time()
+    parallel.RunJobs([
+        lambda: parallel.RunInProcess(CpuBound, 2000000)] * len(cpu_jobs))
+    print "CPU bound, processes: %.2fs" % (time.time() - start)
+    parallel.Shutdown()
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,88 @@
+"""Measure how quickly script text is parsed
+
+Generates a large script and reports the parse throughput (MB/s) of the
+lexer and of the YAML parser (which is used for scripts the lexer does not
+handle).
+
+    bench_parse.py [size in MB] [YAML sample size in MB]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+from betterbatch import lexer
+
+parsescript.LOG = parsescript.ConfigLogging()
+
+BLOCK = """\
+# step block %(num)d
+- set project_%(num)d = <__script_dir__>\\project_%(num)d
+- set build_time_%(num)d = 12:30 "quoted"
+- if exists <project_%(num)d>\\build.bb:
+    - include <project_%(num)d>\\build.bb
+    - echo Building project %(num)d: <project_%(num)d>
+  else:
+    - echo Skipping: <project_%(num)d>
+- for file in {{{exec dir /b
+        <project_%(num)d>\\*.txt}}}:
+    - copy <file> <shell.temp>\\backup_%(num)d {*nocheck*}
+- function build_%(num)d(target, config=release):
+    - cd <project_%(num)d>  # go to the project folder
+    - make <target> CONFIG=<config>
+    - return <target>
+- set usage = build.bb target=value
+- end 0, finished %(num)d
+"""
+
+
+def GenerateScript(size_mb):
+    "Return a script of (at least) size_mb megabytes"
+    blocks = []
+    size = 0
+    num = 0
+    while size < size_mb * 1024 * 1024:
+        block = BLOCK % {'num': num}
+        blocks.append(block)
+        size += len(block)
+        num += 1
+    return "".join(blocks)
+
+
+def Throughput(parse_func, text):
+    "Return the MB/s that parse_func parses text at"
+    start = time.time()
+    parse_func(text)
+    elapsed = time.time() - start
+    return len(text) / (1024.0 * 1024) / elapsed, elapsed
+
+
+def Main():
+    size_mb = 4
+    yaml_size_mb = 0.25
+    if len(sys.argv) > 1:
+        size_mb = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        yaml_size_mb = float(sys.argv[2])
+
+    text = GenerateScript(size_mb)
+    sample = GenerateScript(yaml_size_mb)
+
+    # ensure that both give the same result
+    assert lexer.ParseScriptText(sample) == \
+        parsescript.ParseYAMLTextWithYAML(sample, "bench.bb")
+
+    rate, elapsed = Throughput(lexer.ParseScriptText, text)
+    print "lexer: %6.2f MB/s (%.1f MB in %.2fs)" % (
+        rate, len(text) / (1024.0 * 1024), elapsed)
+
+    rate, elapsed = Throughput(
+        lambda t: parsescript.ParseYAMLTextWithYAML(t, "bench.bb"), sample)
+    print "YAML:  %6.2f MB/s (%.2f MB in %.2fs)" % (
+        rate, len(sample) / (1024.0 * 1024), elapsed)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,61 @@
+"""Measure how quickly variable references are replaced
+
+Renders typical step texts (as in the body of a loop) with the compiled
+templates (with and without the cached values of a VariableStore) and with
+the full pass by pass replacement.
+
+    bench_render.py [number of renders]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+VARIABLES = {
+    'project': '<root>\\projects\\<name>',
+    'root': 'c:\\work',
+    'name': 'betterbatch',
+    'config': 'release',
+    'file': 'c:\\work\\projects\\betterbatch\\setup.py',
+    }
+
+TEXTS = [
+    'copy <file> <project>\\build\\<config> {*nocheck*}',
+    'echo Building <name> (<config>) in <project>',
+    'make <<target>> CONFIG=<config> >> <project>\\build.log',
+    'set output = <project>\\dist\\<name>_<config>.zip',
+    ]
+
+
+def Rate(replace_func, count, variables=VARIABLES):
+    "Return the number of texts replace_func renders per second"
+    start = time.time()
+    for i in xrange(count):
+        for text in TEXTS:
+            replace_func(text, variables)
+    return count * len(TEXTS) / (time.time() - start)
+
+
+def Main():
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    for text in TEXTS:
+        assert parsescript.ReplaceVariableReferences(text, VARIABLES) == \
+            parsescript.ReplaceAllVariableReferences(text, VARIABLES)
+
+    print "store:    %9.0f renders/s" % Rate(
+        parsescript.ReplaceVariableReferences, count,
+        parsescript.VariableStore(VARIABLES))
+    print "compiled: %9.0f renders/s" % Rate(
+        parsescript.ReplaceVariableReferences, count)
+    print "full:     %9.0f renders/s" % Rate(
+        parsescript.ReplaceAllVariableReferences, count)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,55 @@
+"""Measure how much streaming a for loop overlaps producing and running
+
+The loop command writes a line every [delay] ms and each iteration of the
+loop runs a command that takes [delay] ms. Without {*stream*} the loop only
+starts when the command has finished.
+
+    bench_stream_loop.py [number of lines] [delay in ms]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+parsescript.LOG = parsescript.ConfigLogging()
+
+
+def PythonCommand(code):
+    "Return a command that runs the python code"
+    return '"%s" -c "%s"' % (sys.executable, code)
+
+
+def TimeLoop(num_lines, delay, qualifiers):
+    "Return how long the loop takes to run"
+    producer = PythonCommand(
+        "import sys, time\n"
+        "for i in range(%d):\n"
+        "    time.sleep(%f); print i; sys.stdout.flush()" % (
+            num_lines, delay / 1000.0))
+    body = PythonCommand("import time; time.sleep(%f)" % (delay / 1000.0))
+
+    step = parsescript.ParseStep(
+        {"for x in {{{ %s }}} %s" % (producer, qualifiers): [body]})
+
+    start = time.time()
+    step.execute(parsescript.VariableStore(), "run")
+    return time.time() - start
+
+
+def Main():
+    num_lines = 20
+    delay = 100
+    if len(sys.argv) > 1:
+        num_lines = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        delay = float(sys.argv[2])
+
+    print "captured: %.2fs" % TimeLoop(num_lines, delay, "")
+    print "streamed: %.2fs" % TimeLoop(num_lines, delay, "{*stream*}")
+
+
+if __name__ == "__main__":
+    Main()
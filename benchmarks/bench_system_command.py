@@ -0,0 +1,58 @@
+"""Measure the overhead of running trivial commands with SystemCommand
+
+Runs commands that finish straight away [number of commands] times and
+reports the average time per command (the time to start the command and
+collect its output). A small external program is run both through the shell
+and directly, and commands are also run in a persistent shell.
+
+    bench_system_command.py [number of commands]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import built_in_commands
+from betterbatch import persistent_shell
+
+# a small program that does (almost) nothing
+if sys.platform == "win32":
+    EXTERNAL_COMMAND = "hostname"
+else:
+    EXTERNAL_COMMAND = "true"
+
+
+def TimeCommands(num_commands, command, qualifiers):
+    "Return the average time in seconds to run the command"
+    start = time.time()
+    for i in range(num_commands):
+        ret, output = built_in_commands.SystemCommand(command, qualifiers)
+    return (time.time() - start) / num_commands
+
+
+def Main():
+    num_commands = 1000
+    if len(sys.argv) > 1:
+        num_commands = int(sys.argv[1])
+
+    for name, command, qualifiers in (
+            ("echo (shell)", "echo x", []),
+            ("echo nocapture", "echo x", ['nocapture']),
+            ("external (shell)", EXTERNAL_COMMAND, ['shell']),
+            ("external (noshell)", EXTERNAL_COMMAND, ['noshell'])):
+        print "%-20s %.2f ms/command" % (
+            name, TimeCommands(num_commands, command, qualifiers) * 1000)
+
+    persistent_shell.ENABLED = True
+    try:
+        print "%-20s %.2f ms/command" % (
+            "echo (persistent)",
+            TimeCommands(num_commands, "echo x", []) * 1000)
+    finally:
+        persistent_shell.ENABLED = False
+        persistent_shell.CloseAll()
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,55 @@
+"""Compare running a bundled tool in process with running it in a new Python
+
+Reads a value from an ini file with the get_ini_option tool [number of
+calls] times each way and reports the average time per call.
+
+    bench_tools.py [number of calls]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import built_in_commands
+
+
+def TimeCalls(num_calls, func, params):
+    "Return the average time in seconds for func(params)"
+    start = time.time()
+    for i in range(num_calls):
+        ret, output = func(params, [])
+        if ret or output.strip() != "value":
+            raise RuntimeError("Unexpected result: %d %r" % (ret, output))
+    return (time.time() - start) / num_calls
+
+
+def Main():
+    num_calls = 200
+    if len(sys.argv) > 1:
+        num_calls = int(sys.argv[1])
+
+    handle, ini_file = tempfile.mkstemp(suffix = ".ini")
+    os.write(handle, "[section]\nkey = value\n")
+    os.close(handle)
+    try:
+        tool = built_in_commands.NAME_ACTION_MAPPING['get_ini_option']
+        params = '"%s" section key' % ini_file
+
+        # what running the tool as an external command does
+        def Subprocess(params, qualifiers):
+            return built_in_commands.SystemCommand(
+                '"%s" "%s" %s' % (sys.executable, tool.full_path, params),
+                qualifiers)
+
+        print "subprocess: %.2f ms/call" % (
+            TimeCalls(num_calls, Subprocess, params) * 1000)
+        print "in process: %.2f ms/call" % (
+            TimeCalls(num_calls, tool, params) * 1000)
+    finally:
+        os.remove(ini_file)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,63 @@
+"""Time a command that is run every time against one that is up to date
+
+Runs a command that copies a file [number of runs] times without and then
+with {*inputs=...*} {*outputs=...*} (and {*hash*}) and reports the average
+time per step.
+
+    bench_up_to_date.py [number of runs]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+from betterbatch import statedb
+
+parsescript.LOG = parsescript.ConfigLogging()
+parsescript.LOG.setLevel(parsescript.logging.WARNING)
+
+
+def TimeStep(raw_step, num_runs):
+    "Return the average time in seconds to run the step"
+    step = parsescript.ParseStep(raw_step)
+    start = time.time()
+    for i in range(num_runs):
+        step.execute({}, "run")
+    return (time.time() - start) / num_runs
+
+
+def Main():
+    num_runs = 50
+    if len(sys.argv) > 1:
+        num_runs = int(sys.argv[1])
+
+    folder = tempfile.mkdtemp()
+    try:
+        statedb.DATABASE_FILE = os.path.join(folder, "state.sqlite")
+        src = os.path.join(folder, "src.txt")
+        out = os.path.join(folder, "out.txt")
+        open(src, "w").write("x" * 100000)
+        os.utime(src, (time.time() - 100, time.time() - 100))
+
+        command = '"%s" -c "import shutil; shutil.copy(r\'%s\', r\'%s\')"' % (
+            sys.executable, src, out)
+
+        print "always run: %.2f ms/step" % (
+            TimeStep(command, num_runs) * 1000)
+        print "up to date: %.2f ms/step" % (TimeStep(
+            command + " {*inputs=%s*}{*outputs=%s*}" % (src, out),
+            num_runs) * 1000)
+        print "hash:       %.2f ms/step" % (TimeStep(
+            command + " {*inputs=%s*}{*outputs=%s*}{*hash*}" % (src, out),
+            num_runs) * 1000)
+    finally:
+        statedb.Close()
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,71 @@
+"""Measure how long it takes to check (test phase) a deeply nested script
+
+Generates a script of nested if/for blocks and function calls and reports
+the time taken by the test phase that runs before every script.
+
+    bench_validate.py [depth] [number of blocks] [repeats]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from betterbatch import parsescript
+
+parsescript.LOG = parsescript.ConfigLogging()
+
+
+def NestedSteps(depth, num):
+    "Return raw steps nested depth levels deep"
+    steps = [
+        "set value_%d = <root>\\%d" % (num, num),
+        "echo {{{ call func_%d(<value_%d>) }}}" % (num, num),
+        ]
+    for level in range(depth):
+        if level % 2:
+            steps = [{"if defined value_%d" % num: steps + [
+                "echo level %d" % level]}]
+        else:
+            steps = [{"for x_%d in a b" % level: steps + [
+                "set last = <x_%d>" % level]}]
+    return steps
+
+
+def GenerateSteps(depth, blocks):
+    "Return the raw steps for the whole script"
+    steps = ["set root = c:\\work"]
+    for num in range(blocks):
+        steps.append({"function func_%d(arg)" % num: [
+            {"if defined arg": ["return <arg>"]},
+            "return none"]})
+        steps.extend(NestedSteps(depth, num))
+    return steps
+
+
+def Main():
+    depth = 12
+    blocks = 50
+    repeats = 5
+    if len(sys.argv) > 1:
+        depth = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        blocks = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        repeats = int(sys.argv[3])
+
+    steps = parsescript.ParseSteps(GenerateSteps(depth, blocks))
+
+    timings = []
+    for i in range(repeats):
+        variables = parsescript.VariableStore()
+        start = time.time()
+        parsescript.ExecuteSteps(steps, variables, "test")
+        timings.append(time.time() - start)
+
+    print "test phase: %.1f ms (best of %d, depth %d, %d blocks)" % (
+        min(timings) * 1000, repeats, depth, blocks)
+
+
+if __name__ == "__main__":
+    Main()
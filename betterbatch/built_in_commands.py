@@ -12,16 +12,61 @@ import operator
 import os
 import glob
 import subprocess
-import tempfile
 import sys
 import re
 import shlex
-import time
+import struct
+import tempfile
+import threading
+import traceback
 from . import compare
+from . import pathindex
+from . import persistent_shell
 
 RESULT_SUCCESS = 0
 RESULT_FAILURE = 1
 
+# ANSI escape sequences (stripped from the output of commands)
+# the following REGEX was copied from colorama.ansitowin32
+ANSI_RE = re.compile('\033\[((?:\d|;)*)([a-zA-Z])')
+
+# Longest command line that cmd.exe accepts and that CreateProcess accepts
+WINDOWS_SHELL_COMMAND_LIMIT = 8191
+WINDOWS_COMMAND_LIMIT = 32767
+
+# Linux limits the length of each argument (and 'sh -c' passes the whole
+# command as one argument), used if the OS limit cannot be found
+POSIX_ARG_LIMIT = 131072
+
+# (environment, size) of the last environment block measured by
+# EnvironmentSize() so it is only measured again when the environment changes
+_ENVIRONMENT_SIZE = (None, 0)
+
+# Characters that quote or escape the arguments of posix commands
+QUOTING_RE = re.compile(r'["\'\\]')
+
+# Characters that need a bundled tool to be run through the shell (wildcards
+# are passed to the tool as they are - as cmd.exe does)
+TOOL_SHELL_CHARACTERS_RE = re.compile(r'[<>|&^%$`\n]')
+
+# Bundled tools (in BETTER_BATCH_TOOLS_DIR) that are run in this process,
+# their modules have a run_tool(argv) function
+IN_PROCESS_TOOLS = set([
+    'find_in_file',
+    'get_ini_option',
+    'getlanguage',
+    'listfilesmatchingpattern',
+    'replace_in_file',
+    ])
+
+# Qualifiers used by SystemCommand (other qualifiers of external commands are
+# passed to the command as arguments)
+SYSTEM_COMMAND_QUALIFIERS = [
+    'ui', 'echo', 'nocheck', 'nocapture', 'shell', 'noshell', 'responsefile']
+
+# Split a command into the program and the arguments
+PROGRAM_AND_ARGS_RE = re.compile(r'\s*("[^"]*"|\S+)\s*(.*)', re.DOTALL)
+
 PUSH_DIRECTORY_LIST = []
 
 # the following commands are defined in the shell - so they won't work
@@ -35,6 +80,10 @@ SHELL_COMMANDS = [
     'rem', 'ren', 'rename', 'rmdir', 'set', 'setlocal', 'shift', 'start',
     'time', 'title', 'tree', 'type','ver', 'verify', 'vol']
 
+# Characters that need the shell (redirection, pipes, command separators,
+# grouping, variables, wildcards and comments)
+SHELL_METACHARACTERS_RE = re.compile(r'[<>|&^;()$`*?[%!~#\n]')
+
 
 def VerifyFileCount(file_pattern, count = None):
     """Verify that the file count is as specified
@@ -145,39 +194,156 @@ def SystemCommand(command, qualifiers = None):
     #    use_shell = True
 
     command = command.strip()
-    command_len = len(command)
+    command, qualifiers, response_file = FitCommand(command, qualifiers)
+    try:
+        return RunSystemCommand(command, qualifiers, capture_output)
+    finally:
+        if response_file:
+            os.remove(response_file)
 
-    subprocess_safe_command_limit = 2000
-    if command_len > subprocess_safe_command_limit:
-        raise RuntimeError(
-            "The command is %d characters long. "
-            "It cannot be longer than %d characters. '%s...'"% (
-                command_len,
-                subprocess_safe_command_limit,
-                str(command)[:80]))
 
-    # if we can turn shell off for some/all of the commands then it will
-    # allow us to better handle catastrophic issues (e.g. command not found)
+def RunSystemCommand(command, qualifiers, capture_output):
+    "Run the command and return the return value and the output (if captured)"
+    echo_output = bool(set(('echo', 'ui')).intersection(qualifiers))
+
+    if persistent_shell.CanRun(command, qualifiers):
+        ret, output = persistent_shell.RunCommand(command, echo_output)
+        if not capture_output:
+            output = ""
+        return ret, ANSI_RE.sub('', output)
 
     # Only capture output if 'nocapture' qualifier has not been specified
     new_stdout = sys.stdout
     if capture_output:
-        new_stdout, file_path = tempfile.mkstemp()
-        # open the output for reading also in a separate file so that
-        # we can keep different file pointers
-        cmd_output = open(file_path, "rb", buffering = 0)
+        new_stdout = subprocess.PIPE
 
     # if ui or echo qualifiers are not set
-    elif not set(('echo', 'ui')).intersection(qualifiers):
+    elif not echo_output:
         # ensure that output is not captured and not output
-        new_stdout = open("nul", "w")
+        new_stdout = open(os.devnull, "w")
+
+    cmd_pipe = StartCommand(command, qualifiers, new_stdout)
+
+    cmd_data = []
+    if capture_output:
+        # stdout and stderr both go to the one pipe - so it can be read
+        # until it is closed (os.read() returns whatever is available, so
+        # echoed output is shown as it happens)
+        pipe_fd = cmd_pipe.stdout.fileno()
+        while True:
+            step_data = os.read(pipe_fd, 65536)
+            if not step_data:
+                break
+            # Ensure that the user knows what is happening and also capture
+            # the output for the logfile
+            if echo_output:
+                sys.stdout.write(step_data)
+            cmd_data.append(step_data)
+        cmd_pipe.stdout.close()
+
+    cmd_pipe.wait()
+
+    if not capture_output and not echo_output:
+        new_stdout.close()
+
+    output = "".join(cmd_data)
+
+    # just in case there were ANSI escape sequences in the output - strip
+    # them
+    output = ANSI_RE.sub('', output)
+
+    return cmd_pipe.returncode, output
+
+
+def CommandArgs(command):
+    "Return the arguments to pass to Popen to run the command without a shell"
+    # Windows programs split their own command line
+    if sys.platform == "win32":
+        return command
+
+    # shlex is slow for long commands and not needed without quoting
+    if not QUOTING_RE.search(command):
+        return command.split()
+    return shlex.split(command)
+
+
+def NeedsShell(command, qualifiers = None):
+    """Return True if the command has to be run by the shell
+
+    The shell is needed for redirection, pipes, etc. and for commands that
+    are built into the shell. The {*shell*} and {*noshell*} qualifiers
+    override the check."""
+    if qualifiers:
+        if 'shell' in qualifiers:
+            return True
+        if 'noshell' in qualifiers:
+            return False
 
-    def is_windows_seven():
-        windows_version = sys.getwindowsversion()
-        major_index = 0
-        minor_index = 1
-        return (windows_version[major_index] == 6 and
-                windows_version[minor_index] == 1)
+    if SHELL_METACHARACTERS_RE.search(command):
+        return True
+
+    # posix was not avilable for shlex.split in python 2.5.1
+    lex = shlex.shlex(command, posix=False)
+    lex.whitespace_split = True
+    try:
+        command_name = lex.read_token()
+        CommandArgs(command)
+    except ValueError:
+        # e.g. quotes that are not closed - leave it to the shell
+        return True
+
+    command_name = command_name.strip('"\'')
+    # e.g. 'VAR=value command' sets an environment variable for the command
+    return (
+        not command_name or
+        "=" in command_name or
+        command_name.lower() in SHELL_COMMANDS)
+
+
+def ProgramPath(command):
+    """Return the full path of the program of the command on the PATH
+
+    Returns "" if the program includes a folder (it is not searched for) and
+    None if it is not on the PATH."""
+    lex = shlex.shlex(command, posix=False)
+    lex.whitespace_split = True
+    program = lex.read_token().strip('"\'')
+
+    if os.path.dirname(program):
+        return ""
+    return pathindex.FindCommand(program)
+
+
+def StartCommand(command, qualifiers, stdout):
+    """Start the command and return the Popen object
+
+    The command is run without a shell if it does not need one (stderr is
+    always sent to stdout)"""
+    # if the program is not on the PATH the shell is left to run the
+    # command (or report that it does not exist) - unless the error should
+    # be reported
+    program_path = None
+    if not NeedsShell(command, qualifiers):
+        program_path = ProgramPath(command)
+        if program_path is None and qualifiers and 'noshell' in qualifiers:
+            program_path = ""
+
+    if program_path is not None:
+        try:
+            # run the program that was found - Windows would otherwise look
+            # in other folders (e.g. System32) before the PATH
+            return subprocess.Popen(
+                CommandArgs(command),
+                executable = program_path or None,
+                stdout = stdout,
+                stderr = subprocess.STDOUT)
+        except (OSError, ValueError), e:
+            if qualifiers and 'noshell' in qualifiers:
+                raise RuntimeError(
+                    "Could not run the command without the shell: '%s' (%s)"%
+                        (command, e))
+            # e.g. a batch file or a script that the shell knows how to
+            # run - so let the shell run it
 
     # for some reason when passing to the shell - we need to quote the
     # WHOLE command with ""
@@ -186,50 +352,165 @@ def SystemCommand(command, qualifiers = None):
     if sys.version_info < (2, 7):
         command = '"%s"'% command
 
-    cmd_pipe = subprocess.Popen(
+    return subprocess.Popen(
         command,
         shell = True,
-        stdout = new_stdout,
+        stdout = stdout,
         stderr = subprocess.STDOUT)
 
-    cmd_data = []
-    # while the command hasn't finished - keep reading the data from the
-    # output file (if capturing)
-    while cmd_pipe.returncode is None:
-        # wait just a small bit between checks - avoids too 'busy' a cycle
-        time.sleep(.1)
-        # Ensure that the user knows what is happening and also capture the
-        # output for the logfile
-        if capture_output:
-            step_data = cmd_output.read()
-            # only append data if there is data (otherwise it could use all
-            # available memory)
-            if step_data:
-                # if echo or ui qualifier was set
-                if set(('echo', 'ui')).intersection(qualifiers):
-                    # output the data
-                    sys.stdout.write(step_data)
-                cmd_data.append(step_data)
-        cmd_pipe.poll()
-
-    # if we were capturing data - then we need to close the capturing
-    # file handle(s) and remove the file
-    if capture_output:
-        #import pdb; pdb.set_trace()
-        os.close(new_stdout)
-        cmd_output.close()
-        os.remove(file_path)
-    elif not set(('echo', 'ui')).intersection(qualifiers):
-        new_stdout.close()
 
-    output = "".join(cmd_data)
+def CommandLengthLimit(shell):
+    "Return the space the OS allows for a command (with or without the shell)"
+    if sys.platform == "win32":
+        if shell:
+            return WINDOWS_SHELL_COMMAND_LIMIT
+        return WINDOWS_COMMAND_LIMIT
 
-    # just in case there were ANSI escape sequences in the output - strip
-    # them the following REGEX was copied from colorama.ansitowin32
-    ANSI_RE = re.compile('\033\[((?:\d|;)*)([a-zA-Z])')
-    output = ANSI_RE.sub('', output)
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = POSIX_ARG_LIMIT
+
+    # the environment is passed in the same space (and some is kept back
+    # for the shell and the program name)
+    limit = arg_max - EnvironmentSize() - 2048
+    if shell:
+        limit = min(limit, POSIX_ARG_LIMIT)
+    return limit
+
+
+def EnvironmentSize():
+    "Return the space the environment takes in the arguments of a command"
+    global _ENVIRONMENT_SIZE
+    environment, size = _ENVIRONMENT_SIZE
+    if environment != os.environ:
+        environment = dict(os.environ)
+        size = sum([
+            len(name) + len(value) + 2 + struct.calcsize("P")
+                for name, value in environment.items()])
+        _ENVIRONMENT_SIZE = (environment, size)
+    return size
+
+
+def CommandSize(command, shell):
+    "Return the space the command needs (see CommandLengthLimit())"
+    if shell or sys.platform == "win32":
+        return len(command)
+
+    # each argument is passed as a separate string and a pointer to it
+    # (quoted arguments are counted as several arguments - which is safe)
+    return len(command) + len(command.split()) * struct.calcsize("P")
+
+
+def CheckCommandLength(command, qualifiers = None):
+    """Raise an error if the command is too long to be run
+
+    Returns None if the command can be run as it is, 'noshell' if it can
+    only be run without the shell and 'responsefile' if its arguments have
+    to be passed in a response file ({*responsefile*} qualifier)."""
+    if qualifiers is None:
+        qualifiers = []
 
-    return cmd_pipe.returncode, output
+    # persistent shells have the same limit as the shell
+    if CommandSize(command, True) <= CommandLengthLimit(True):
+        return None
+
+    needs_shell = NeedsShell(command, qualifiers)
+    if not needs_shell:
+        if CommandSize(command, False) <= CommandLengthLimit(False):
+            return "noshell"
+        if 'responsefile' in qualifiers:
+            return "responsefile"
+
+    if needs_shell:
+        reason = "when run in the shell"
+    else:
+        reason = "(use {*responsefile*} if the command accepts @file)"
+    raise RuntimeError(
+        "The command is too long (it needs %d characters). "
+        "It cannot be longer than %d characters %s. '%s...'"% (
+            CommandSize(command, needs_shell),
+            CommandLengthLimit(needs_shell),
+            reason,
+            str(command)[:80]))
+
+
+def ResponseFileCommand(command):
+    """Return the command with its arguments moved to a response file
+
+    Returns the new command ("program @file") and the path of the file"""
+    program, args = PROGRAM_AND_ARGS_RE.match(command).groups()
+
+    handle, path = tempfile.mkstemp(suffix = ".rsp")
+    response_file = os.fdopen(handle, "w")
+    try:
+        response_file.write(args)
+    finally:
+        response_file.close()
+
+    response_arg = "@" + path
+    if " " in response_arg:
+        response_arg = '"%s"' % response_arg
+    return "%s %s" % (program, response_arg), path
+
+
+def FitCommand(command, qualifiers):
+    """Return (command, qualifiers, response file) to run the command
+
+    Raises an error if the command is too long (see CheckCommandLength()).
+    The qualifiers get 'noshell' if the command is too long for the shell.
+    The caller has to remove the response file (if not None)."""
+    fit = CheckCommandLength(command, qualifiers)
+    if fit is None:
+        return command, qualifiers, None
+
+    qualifiers = list(qualifiers) + ['noshell']
+    response_file = None
+    if fit == "responsefile":
+        command, response_file = ResponseFileCommand(command)
+    return command, qualifiers, response_file
+
+
+class StreamedCommand(object):
+    """Run a system command and iterate over the lines of output as they are
+    written
+
+    The command is started when iteration starts, returncode is set when all
+    the output has been read. If iteration is stopped early the command is
+    stopped."""
+
+    def __init__(self, command, qualifiers = None):
+        if qualifiers is None:
+            qualifiers = []
+
+        self.command = command.strip()
+        CheckCommandLength(self.command, qualifiers)
+        self.echo = bool(set(('echo', 'ui')).intersection(qualifiers))
+        self.qualifiers = qualifiers
+        self.returncode = None
+
+    def __iter__(self):
+        command, qualifiers, response_file = FitCommand(
+            self.command, self.qualifiers)
+        try:
+            cmd_pipe = StartCommand(command, qualifiers, subprocess.PIPE)
+
+            try:
+                for line in iter(cmd_pipe.stdout.readline, ""):
+                    if self.echo:
+                        sys.stdout.write(line)
+                    yield ANSI_RE.sub('', line.rstrip("\r\n"))
+                self.returncode = cmd_pipe.wait()
+            finally:
+                cmd_pipe.stdout.close()
+                if cmd_pipe.poll() is None:
+                    # not available before Python 2.6
+                    if hasattr(cmd_pipe, "terminate"):
+                        cmd_pipe.terminate()
+                    cmd_pipe.wait()
+        finally:
+            if response_file:
+                os.remove(response_file)
 
 
 def dirname(path, dummy = None):
@@ -294,24 +575,152 @@ class ExternalCommand(object):
                 "External command does not exist: '%s'"% full_path)
         self.full_path = full_path
 
-    def __call__(self, params, qualifiers = None):
-        if qualifiers is None:
-            qualifiers = []
+    def command_line(self, params, qualifiers):
+        """Return the command line to run the command with params
 
+        Qualifiers that are not for SystemCommand are removed from qualifiers
+        and passed to the command as arguments"""
         arg_qualifiers = []
         for qualifier in reversed(qualifiers):
-            if qualifier not in ['ui', 'echo', 'nocheck', "nocapture"]:
+            if qualifier not in SYSTEM_COMMAND_QUALIFIERS:
                 qualifiers.remove(qualifier)
                 arg_qualifiers.append(qualifier)
 
         if isinstance(params, basestring):
-            params = " ".join([self.full_path, params] + arg_qualifiers)
+            return " ".join([self.full_path, params] + arg_qualifiers)
         else:
             raise RuntimeError(
                 "ExternalCommand.__call__ only accepts strings")
+
+    def __call__(self, params, qualifiers = None):
+        if qualifiers is None:
+            qualifiers = []
+
+        params = self.command_line(params, qualifiers)
         return SystemCommand(params, qualifiers)
 
 
+class InProcessTool(ExternalCommand):
+    """A bundled tool that is run in this process
+
+    The run_tool(argv) function of the tool's module is called instead of
+    starting a new Python to run the script. The output and the return value
+    are the same as if the script had been run."""
+    def __init__(self, full_path, module_name):
+        ExternalCommand.__init__(self, full_path)
+        self.module_name = module_name
+
+    def tool_function(self):
+        "Return the run_tool() function of the tool (imported once)"
+        module = __import__(
+            "tools." + self.module_name, globals(), {}, ["run_tool"], 1)
+        return module.run_tool
+
+    def __call__(self, params, qualifiers = None):
+        if qualifiers is None:
+            qualifiers = []
+
+        command = self.command_line(params, qualifiers)
+        args = command[len(self.full_path):]
+        if 'shell' in qualifiers or TOOL_SHELL_CHARACTERS_RE.search(args):
+            return SystemCommand(command, qualifiers)
+
+        echo_output = bool(set(('echo', 'ui')).intersection(qualifiers))
+        ret, output = RunToolInProcess(
+            self.tool_function(), SplitArguments(args), echo_output)
+
+        if 'nocapture' in qualifiers:
+            output = ""
+        return ret, ANSI_RE.sub('', output)
+
+
+class _ThreadOutput(object):
+    "Stand in for sys.stdout/sys.stderr that can capture a thread's output"
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        captured = getattr(_TOOL_OUTPUT, "captured", None)
+        if captured is None:
+            self.stream.write(text)
+            return
+
+        captured.append(text)
+        if _TOOL_OUTPUT.echo_stream is not None:
+            _TOOL_OUTPUT.echo_stream.write(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if getattr(_TOOL_OUTPUT, "captured", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_TOOL_OUTPUT = threading.local()
+_TOOL_OUTPUT_LOCK = threading.Lock()
+
+
+def SplitArguments(text):
+    "Split the text into arguments (as the C runtime would for a program)"
+    if sys.platform != "win32":
+        return CommandArgs(text)
+
+    lex = shlex.shlex(text, posix = True)
+    lex.whitespace_split = True
+    lex.commenters = ""
+    # backslashes are path separators - not escapes
+    lex.escape = ""
+    return list(lex)
+
+
+def RunToolInProcess(run_tool, argv, echo = False):
+    """Call run_tool(argv) and return (return value, output)
+
+    Output written to stdout and stderr by the current thread while the tool
+    runs is captured (and also written to stdout if echo is True)"""
+    _TOOL_OUTPUT_LOCK.acquire()
+    try:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, _ThreadOutput):
+            sys.stderr = _ThreadOutput(sys.stderr)
+    finally:
+        _TOOL_OUTPUT_LOCK.release()
+
+    captured = []
+    _TOOL_OUTPUT.captured = captured
+    _TOOL_OUTPUT.echo_stream = None
+    if echo:
+        _TOOL_OUTPUT.echo_stream = sys.stdout.stream
+    try:
+        try:
+            ret = run_tool(argv)
+        except SystemExit, e:
+            ret = e.code
+        except Exception:
+            # report it as Python would for the script
+            traceback.print_exc()
+            ret = 1
+
+        if ret is None:
+            ret = 0
+        elif not isinstance(ret, (int, long)):
+            print >> sys.stderr, ret
+            ret = 1
+    finally:
+        _TOOL_OUTPUT.captured = None
+
+    # the script would have written its output in text mode
+    output = "".join(captured).replace("\n", os.linesep)
+    return ret, output
+
+
 def EscapeNewlines(text, qualifiers = ''):
     "Return the input with newlines replaced"
     text = text.replace("\r", "\\\\r")
@@ -394,7 +803,13 @@ def PopulateFromToolsFolder(tools_folder, dummy = None):
 
             full_path = os.path.join(tools_folder, tool_file)
             if name not in NAME_ACTION_MAPPING:
-                NAME_ACTION_MAPPING[name] = ExternalCommand(full_path)
+                if name in IN_PROCESS_TOOLS and ext == ".PY" and (
+                        os.path.normcase(os.path.abspath(tools_folder)) ==
+                        os.path.normcase(BETTER_BATCH_TOOLS_DIR)):
+                    NAME_ACTION_MAPPING[name] = InProcessTool(
+                        full_path, os.path.splitext(tool_file)[0])
+                else:
+                    NAME_ACTION_MAPPING[name] = ExternalCommand(full_path)
             else:
                 if (not hasattr(NAME_ACTION_MAPPING[name], "full_path") or
                     full_path != NAME_ACTION_MAPPING[name].full_path):
@@ -495,6 +910,7 @@ NAME_ACTION_MAPPING = {
     'add_tools_dir'   : PopulateFromToolsFolder,
 }
 
-BETTER_BATCH_TOOLS_DIR = os.path.join(os.path.dirname(__file__), "tools")
+BETTER_BATCH_TOOLS_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "tools"))
 if os.path.exists(BETTER_BATCH_TOOLS_DIR):
     PopulateFromToolsFolder(BETTER_BATCH_TOOLS_DIR)
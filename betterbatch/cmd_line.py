@@ -6,6 +6,7 @@ USAGE = r"""
 Executes a BetterBatch script file.
 
 %prog [-c][-h][-v] (script file) [var=value] [var=value]...
+%prog --clear-cache
 
 Examples:
     bbrun.py --verbose my_script.bb test_dir=%temp%\there build=H099"""
@@ -96,13 +97,72 @@ def ParseArguments():
         default = False,
         help='Validate all the scripts in the same directory as the script')
 
+    parser.add_option(
+        '--no-cache',
+        action = "store_true",
+        default = False,
+        help='Do not use (or update) the cache of parsed scripts')
+
+    parser.add_option(
+        '--clear-cache',
+        action = "store_true",
+        default = False,
+        help='Empty the cache of parsed scripts')
+
+    parser.add_option(
+        '--no-persist',
+        action = "store_true",
+        default = False,
+        help='Compute the values of {*persist=...*} variables again instead '
+            'of using the values stored by earlier runs')
+
+    parser.add_option(
+        '--clear-persisted',
+        action = "store_true",
+        default = False,
+        help='Remove the values stored for {*persist=...*} variables')
+
+    parser.add_option(
+        '--stream',
+        action = "store_true",
+        default = False,
+        help='Check and run each top level step as soon as it is read '
+            '(for very large scripts). Errors in later steps are only found '
+            'when they are reached. The script is read once before it runs '
+            'to find the functions it defines')
+
+    parser.add_option(
+        '--jobs',
+        type = "int",
+        default = None,
+        help='Maximum number of steps of parallel blocks to run at the same '
+            'time (default: the number of processors)')
+
+    parser.add_option(
+        '--persistent-shell',
+        action = "store_true",
+        default = False,
+        help='Run external commands in a shell that is kept for the whole '
+            'run instead of starting a new shell for each command')
+
+    parser.add_option(
+        '--auto-parallel',
+        action = "store_true",
+        default = False,
+        help='Run steps that do not depend on each other at the same time '
+            '(see {*reads=...*} and {*writes=...*})')
+
 
     # parse the command line
     options, args = parser.parse_args()
-    if not args:
+    # clearing the caches is the only thing that can be done without a script
+    if not args and not options.clear_cache and not options.clear_persisted:
         print USAGE
         sys.exit()
 
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     # no_color is just an override - we will use options.colored_output
     if options.no_color:
         options.colored_output = False
@@ -136,6 +196,12 @@ def ValidateOptions(options, args):
     #    raise RuntimeError(
     #        "Specify only one script file - '%s' "% ", ".join(args))
 
+    if not args:
+        # only the cache is being cleared
+        options.script_file = None
+        options.variables = {}
+        return options
+
     options.script_file = args[0]
     if not os.path.exists(options.script_file):
         raise RuntimeError(
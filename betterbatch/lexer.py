@@ -0,0 +1,310 @@
+"""Fast parser for the subset of YAML used by BetterBatch scripts
+
+BetterBatch scripts are pre-processed before being handed to YAML (colons
+that are not at the end of a line and double quotes are protected, echo/usage
+and end statements are made into literal blocks, line breaks in {{{ }}}
+sections are removed). Scripts that only use the usual block sequences,
+mappings and plain strings can be read directly into the same structure line
+by line, which is much faster than the pre-processing plus the YAML parser.
+
+Anything that is not handled here raises UnsupportedSyntax - and the caller
+should then use the full YAML parser so that the result (or the error) is
+exactly the same.
+"""
+
+import re
+
+import yaml
+
+
+class UnsupportedSyntax(Exception):
+    "The text uses YAML that has to be handled by the full YAML parser"
+
+
+# characters (or sequences) that only the full YAML parser handles
+_NEEDS_YAML = re.compile(r"[^\n\r\x20-\x7e]|\r(?!\n)|\+\+\+\+\+")
+
+# statements that are treated as pre-formatted strings (see ParseYAMLText)
+_PREFORMATTED = re.compile(r"set +usage *=\s*|echo\s+|end\s+", re.I)
+_PREFORMATTED_NO_TEXT = re.compile(r"(set +usage *=|echo|end)\s*$", re.I)
+_PREFORMATTED_LINE = re.compile(
+    r"^ *\- +(set +usage *=|echo\s|end\s)", re.I | re.M)
+
+# a colon at the end of a line inside a {{{ }}} section
+_END_COLON = re.compile(r":[ \r]*\n")
+
+# characters that start something other than a plain string
+_INDICATORS = frozenset("?,[]{}#&*!|>'%@`")
+
+# the strings used to hide colons and double quotes from YAML
+_COLON = "+++++colon+++++"
+_DBLQUOTE = "+++++dblquote+++++"
+
+# YAML does not allow simple keys longer than 1024 characters
+_MAX_KEY_LENGTH = 1000
+
+_RESOLVER = yaml.resolver.Resolver()
+_STR_TAG = yaml.resolver.Resolver.DEFAULT_SCALAR_TAG
+
+
+def FoldBraceNewlines(text, strict=False):
+    """Replace the line breaks in {{{ }}} sections with spaces
+
+    The length of the text is not changed. If strict is True then
+    UnsupportedSyntax is raised for sections where the line breaks matter to
+    the other pre-processing steps."""
+    pieces = []
+    pos = 0
+    while True:
+        start = text.find("{{{", pos)
+        if start == -1:
+            break
+        end = text.find("}}}", start + 3)
+        if end == -1:
+            break
+        end += 3
+
+        quoted = text[start:end]
+        if "\n" in quoted or "\r" in quoted:
+            if strict and (
+                    _END_COLON.search(quoted) or
+                    _PREFORMATTED_LINE.search(quoted)):
+                raise UnsupportedSyntax()
+
+            #  we keep the same length with these replacements
+            quoted = quoted.replace("\r\n", "  ")
+            quoted = quoted.replace("\n", " ")
+            quoted = quoted.replace("\r", " ")
+
+        pieces.append(text[pos:start])
+        pieces.append(quoted)
+        pos = end
+
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def _CheckString(value, max_length=None):
+    "Raise UnsupportedSyntax if YAML would not read the value as a string"
+    # YAML sees the text with the colons and double quotes hidden
+    if ":" in value or '"' in value:
+        value = value.replace(":", _COLON).replace('"', _DBLQUOTE)
+
+    if max_length is not None and len(value) > max_length:
+        raise UnsupportedSyntax()
+
+    if _RESOLVER.resolve(yaml.ScalarNode, value, (True, False)) != _STR_TAG:
+        raise UnsupportedSyntax()
+
+
+def _KeyText(text):
+    "Return the key if text is a mapping key (ends with a colon) or None"
+    if " #" in text:
+        return None
+    text = text.rstrip(" ")
+    if text.endswith(":"):
+        return text[:-1].rstrip(" ")
+    return None
+
+
+def _IsSequenceEntry(text):
+    "Return True if text starts a sequence entry"
+    return text == "-" or text.startswith("- ")
+
+
+class _ScriptParser(object):
+    "Build the script structure from the lines of the script"
+
+    def __init__(self, text):
+        self.lines = text.split("\n")
+        self.indents = []
+        self.contents = []
+        for i, line in enumerate(self.lines):
+            if line.endswith("\r"):
+                line = line[:-1]
+                self.lines[i] = line
+            content = line.lstrip(" ")
+            indent = len(line) - len(content)
+
+            # document start/end markers
+            if not indent and content[:3] in ("---", "..."):
+                raise UnsupportedSyntax()
+
+            self.indents.append(indent)
+            self.contents.append(content)
+
+        self.num_lines = len(self.lines)
+
+    def NextContent(self, i):
+        "Return the index of the next line that is not blank or a comment"
+        contents = self.contents
+        while i < self.num_lines:
+            content = contents[i]
+            if content and content[0] != "#":
+                break
+            i += 1
+        return i
+
+    def Parse(self):
+        "Return the parsed structure of the whole script"
+        i = self.NextContent(0)
+        if i == self.num_lines:
+            return None
+
+        data, i = self.ParseNode(i, self.indents[i], self.contents[i], -1)
+
+        if self.NextContent(i) != self.num_lines:
+            raise UnsupportedSyntax()
+        return data
+
+    def ParseNode(self, i, col, text, parent_indent):
+        "Parse the node that starts with text at column col of line i"
+        if _IsSequenceEntry(text):
+            if col != self.indents[i]:
+                # compact nested sequence e.g. '- - item'
+                raise UnsupportedSyntax()
+            return self.ParseSequence(i, col)
+
+        if text[0] in _INDICATORS:
+            raise UnsupportedSyntax()
+
+        if _KeyText(text) is not None:
+            return self.ParseMapping(i, col)
+
+        return self.ParsePlain(i, text, parent_indent)
+
+    def ParseSequence(self, i, col):
+        "Parse the entries of the sequence at column col"
+        items = []
+        while True:
+            entry = self.contents[i][1:]
+            text = entry.lstrip(" ")
+            if not text:
+                raise UnsupportedSyntax()
+
+            if _PREFORMATTED_NO_TEXT.match(text):
+                # the pre-processing would join it with the next line
+                raise UnsupportedSyntax()
+
+            if _PREFORMATTED.match(text):
+                item, i = self.ParsePreformatted(i, col, text)
+            else:
+                entry_col = col + 1 + len(entry) - len(text)
+                item, i = self.ParseNode(i, entry_col, text, col)
+            items.append(item)
+
+            i = self.NextContent(i)
+            if i == self.num_lines or self.indents[i] < col:
+                break
+            if self.indents[i] > col:
+                raise UnsupportedSyntax()
+            if not _IsSequenceEntry(self.contents[i]):
+                # e.g. the next key of the mapping that contains the sequence
+                break
+
+        return items, i
+
+    def ParseMapping(self, i, col):
+        "Parse the keys and values of the mapping at column col"
+        mapping = {}
+        while True:
+            text = self.lines[i][col:]
+            if text[0] in _INDICATORS or _IsSequenceEntry(text):
+                raise UnsupportedSyntax()
+
+            key = _KeyText(text)
+            if not key:
+                raise UnsupportedSyntax()
+            _CheckString(key, _MAX_KEY_LENGTH)
+
+            value = None
+            i = self.NextContent(i + 1)
+            if i < self.num_lines:
+                indent = self.indents[i]
+                if indent > col:
+                    value, i = self.ParseNode(
+                        i, indent, self.contents[i], col)
+                elif indent == col and _IsSequenceEntry(self.contents[i]):
+                    # sequences can be at the same indent as the key
+                    value, i = self.ParseSequence(i, col)
+            mapping[key] = value
+
+            i = self.NextContent(i)
+            if i == self.num_lines or self.indents[i] < col:
+                break
+            if self.indents[i] > col:
+                raise UnsupportedSyntax()
+
+        return mapping, i
+
+    def ParsePlain(self, i, text, parent_indent):
+        "Parse a plain string - folding lines that continue it"
+        comment = text.find(" #")
+        if comment != -1:
+            value = text[:comment].rstrip(" ")
+            _CheckString(value)
+            return value, i + 1
+
+        parts = [text.rstrip(" ")]
+        breaks = 0
+        i += 1
+        while i < self.num_lines:
+            content = self.contents[i]
+            if not content:
+                breaks += 1
+                i += 1
+                continue
+
+            if self.indents[i] <= parent_indent or content[0] == "#":
+                break
+
+            # continuation lines that YAML might treat differently
+            if (content[0] in _INDICATORS or
+                    content[0] == "-" or
+                    " #" in content or
+                    _KeyText(content) is not None):
+                raise UnsupportedSyntax()
+
+            if breaks:
+                parts.append("\n" * breaks)
+            else:
+                parts.append(" ")
+            parts.append(content.rstrip(" "))
+            breaks = 0
+            i += 1
+
+        value = "".join(parts)
+        _CheckString(value)
+        return value, i
+
+    def ParsePreformatted(self, i, col, text):
+        """Parse an echo/usage/end statement
+
+        These are literal blocks so the text is kept as is (including
+        comments and trailing spaces) with a single trailing line break"""
+        # the following lines must not be part of the literal block
+        block_indent = col + 4
+        next_line = i + 1
+        while next_line < self.num_lines and not self.contents[next_line]:
+            if self.indents[next_line] > block_indent:
+                raise UnsupportedSyntax()
+            next_line += 1
+        if next_line < self.num_lines and self.indents[next_line] > col:
+            raise UnsupportedSyntax()
+
+        if i + 1 < self.num_lines:
+            text += "\n"
+        return text, i + 1
+
+
+def ParseScriptText(text):
+    """Return the structure of the (tab free) script text
+
+    Raises UnsupportedSyntax if the text needs the full YAML parser"""
+    if _NEEDS_YAML.search(text):
+        raise UnsupportedSyntax()
+
+    text = FoldBraceNewlines(text, strict=True)
+    return _ScriptParser(text).Parse()
@@ -0,0 +1,361 @@
+"""Run the steps of parallel blocks in a shared pool of worker threads
+
+All parallel blocks (including parallel blocks nested in other parallel
+blocks) share one budget of worker threads, so a parallel for loop over
+thousands of files does not start thousands of threads.
+
+A worker that runs a nested parallel block runs jobs of that block itself
+while it waits for them, so nested blocks can never deadlock waiting for
+workers that are all busy waiting.
+
+Jobs can also be run in a pool of worker processes (for blocks with the
+{*processes*} qualifier) - the threads of the pool then just wait for the
+processes, so the same limits apply.
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import threading
+from collections import deque
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5
+    multiprocessing = None
+
+# Maximum number of jobs run at the same time by all the parallel blocks
+# (set by Main from --jobs), if None then the number of processors is used
+MAX_JOBS = None
+
+_POOL = None
+_PROCESS_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# True in the worker processes (which cannot start processes themselves)
+_IN_WORKER_PROCESS = False
+
+# How long Shutdown() waits for the worker threads to finish
+SHUTDOWN_TIMEOUT = 5
+
+# Functions called in each worker process when it starts
+PROCESS_INITIALIZERS = []
+
+
+def CpuCount():
+    "Return the number of processors (1 if it cannot be found)"
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+
+    try:
+        return int(os.environ.get("NUMBER_OF_PROCESSORS", 1))
+    except ValueError:
+        return 1
+
+
+def JoinThreads(threads, timeout):
+    """Wait up to timeout seconds (in total) for the threads to finish
+
+    The calling thread is skipped if it is one of the threads"""
+    end_time = time.time() + timeout
+    for thread in threads:
+        if thread is threading.currentThread():
+            continue
+        thread.join(max(end_time - time.time(), 0))
+
+
+def DefaultMaxJobs():
+    "Return the maximum number of jobs to use if not set on the command line"
+    if MAX_JOBS:
+        return MAX_JOBS
+    return max(CpuCount(), 2)
+
+
+class _Block(object):
+    "The jobs of one parallel block"
+
+    def __init__(self, max_jobs):
+        self.pending = deque()
+        self.max_jobs = max_jobs
+        self.running = 0
+        self.unfinished = 0
+        self.errors = []
+
+    def can_start(self):
+        "Return True if a job of this block can be started now"
+        return self.pending and (
+            self.max_jobs is None or self.running < self.max_jobs)
+
+
+class JobPool(object):
+    """Pool of worker threads that run the jobs of parallel blocks
+
+    Worker threads are started when needed (up to max_jobs) and are kept
+    for later blocks."""
+
+    def __init__(self, max_jobs):
+        if max_jobs < 1:
+            raise RuntimeError(
+                "The maximum number of jobs must be at least 1: %d" %
+                    max_jobs)
+        self.max_jobs = max_jobs
+        self.condition = threading.Condition()
+        self.blocks = []
+        self.workers = 0
+        self.busy = 0
+        self.local = threading.local()
+        self.threads = []
+        self.stopping = False
+
+    def _next_job(self, blocks):
+        "Return the next (block, job) that can be started from blocks"
+        for block in blocks:
+            if block.can_start():
+                block.running += 1
+                return block, block.pending.popleft()
+        return None, None
+
+    def _run_job(self, block, job):
+        "Run the job and record that it has finished"
+        try:
+            job()
+        except Exception, e:
+            error = e
+        else:
+            error = None
+
+        self.condition.acquire()
+        try:
+            if error is not None:
+                block.errors.append(error)
+            block.running -= 1
+            block.unfinished -= 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _worker(self):
+        "Run jobs from any block - until the pool is stopped"
+        self.local.is_worker = True
+        while True:
+            self.condition.acquire()
+            try:
+                block, job = None, None
+                while job is None:
+                    if self.busy < self.max_jobs:
+                        block, job = self._next_job(self.blocks)
+                    if job is None:
+                        if self.stopping:
+                            self.workers -= 1
+                            return
+                        self.condition.wait()
+                self.busy += 1
+            finally:
+                self.condition.release()
+
+            try:
+                self._run_job(block, job)
+            finally:
+                self.condition.acquire()
+                try:
+                    self.busy -= 1
+                    self.condition.notifyAll()
+                finally:
+                    self.condition.release()
+
+    def _start_workers(self):
+        "Start workers for any jobs that are waiting (condition held)"
+        waiting = sum([len(block.pending) for block in self.blocks])
+        idle = self.workers - self.busy
+        while waiting > idle and self.workers < self.max_jobs:
+            worker = threading.Thread(target = self._worker)
+            worker.setDaemon(True)
+            worker.start()
+            self.threads.append(worker)
+            self.workers += 1
+            idle += 1
+
+    def _wait_for(self, block, done, is_worker):
+        """Wait until done() is True (condition held)
+
+        A worker does not wait idle (it would be holding one of the jobs) -
+        it runs the jobs of its block itself."""
+        while not done():
+            job = None
+            if is_worker:
+                dummy, job = self._next_job([block])
+
+            if job is None:
+                self.condition.wait()
+                continue
+
+            self.condition.release()
+            try:
+                self._run_job(block, job)
+            finally:
+                self.condition.acquire()
+
+    def run(self, jobs, max_jobs = None):
+        """Run the jobs (callables) and wait until they have all finished
+
+        jobs can be any iterable - jobs are started while later jobs are
+        still being produced (e.g. from the lines of output of a command).
+        No more than max_jobs of the jobs are run at the same time. Returns
+        the exceptions raised by the jobs (and by producing them)."""
+        if max_jobs is not None and max_jobs < 1:
+            raise RuntimeError(
+                "The maximum number of jobs must be at least 1: %d" %
+                    max_jobs)
+
+        block = _Block(max_jobs)
+        is_worker = getattr(self.local, "is_worker", False)
+
+        # limit how far producing the jobs can get ahead of running them
+        max_pending = self.max_jobs * 2
+        def PendingLimitOk():
+            return len(block.pending) < max_pending
+
+        producer_error = None
+        self.condition.acquire()
+        try:
+            self.blocks.append(block)
+            try:
+                # get the jobs without holding the lock as producing them
+                # may take a while
+                self.condition.release()
+                try:
+                    for job in jobs:
+                        self.condition.acquire()
+                        try:
+                            self._wait_for(block, PendingLimitOk, is_worker)
+                            block.pending.append(job)
+                            block.unfinished += 1
+                            self._start_workers()
+                            self.condition.notifyAll()
+                        finally:
+                            self.condition.release()
+                finally:
+                    self.condition.acquire()
+            except Exception, e:
+                producer_error = e
+
+            self._wait_for(block, lambda: not block.unfinished, is_worker)
+        finally:
+            self.blocks.remove(block)
+            self.condition.release()
+
+        if producer_error is not None:
+            block.errors.append(producer_error)
+        return block.errors
+
+    def stop(self, timeout):
+        """Stop the worker threads once they have no more jobs to run
+
+        Waits up to timeout seconds for them to finish"""
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            threads, self.threads = self.threads, []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+        JoinThreads(threads, timeout)
+
+
+def Pool():
+    "Return the pool shared by all the parallel blocks"
+    global _POOL
+    _POOL_LOCK.acquire()
+    try:
+        if _POOL is None:
+            _POOL = JobPool(DefaultMaxJobs())
+        else:
+            _POOL.max_jobs = DefaultMaxJobs()
+        return _POOL
+    finally:
+        _POOL_LOCK.release()
+
+
+def RunJobs(jobs, max_jobs = None):
+    "Run the jobs in the shared pool and return the exceptions they raised"
+    return Pool().run(jobs, max_jobs)
+
+
+def InWorker():
+    "Return True if called by a worker thread (or in a worker process)"
+    if _IN_WORKER_PROCESS:
+        return True
+    pool = _POOL
+    return pool is not None and getattr(pool.local, "is_worker", False)
+
+
+def ProcessesAvailable():
+    "Return True if jobs can be run in worker processes"
+    return multiprocessing is not None and not _IN_WORKER_PROCESS
+
+
+def AddProcessInitializer(func):
+    """Call func() in each worker process when it starts
+
+    func must be picklable (a module level function)"""
+    if func not in PROCESS_INITIALIZERS:
+        PROCESS_INITIALIZERS.append(func)
+
+
+def _InitWorkerProcess(initializers = ()):
+    "Set up a new worker process"
+    global _POOL, _PROCESS_POOL, _IN_WORKER_PROCESS
+    # the process may have been forked from a process with a pool - but
+    # not the threads of the pool
+    _POOL = None
+    _PROCESS_POOL = None
+    _IN_WORKER_PROCESS = True
+    for initializer in initializers:
+        initializer()
+
+
+def ProcessPool():
+    "Return the pool of worker processes (started when first needed)"
+    global _PROCESS_POOL
+    _POOL_LOCK.acquire()
+    try:
+        if _PROCESS_POOL is None:
+            _PROCESS_POOL = multiprocessing.Pool(
+                DefaultMaxJobs(),
+                _InitWorkerProcess,
+                (list(PROCESS_INITIALIZERS), ))
+        return _PROCESS_POOL
+    finally:
+        _POOL_LOCK.release()
+
+
+def RunInProcess(func, *args):
+    """Call func(*args) in one of the worker processes and return the result
+
+    func and the arguments must be picklable (so func has to be a module
+    level function)"""
+    return ProcessPool().apply_async(func, args).get()
+
+
+def Shutdown():
+    "Stop the worker threads and processes (if any were started)"
+    global _POOL, _PROCESS_POOL
+    _POOL_LOCK.acquire()
+    try:
+        pool, _POOL = _POOL, None
+        if _PROCESS_POOL is not None:
+            _PROCESS_POOL.close()
+            _PROCESS_POOL.join()
+            _PROCESS_POOL = None
+    finally:
+        _POOL_LOCK.release()
+
+    # the workers are stopped without the lock held as a job may still
+    # be using the pool
+    if pool is not None:
+        pool.stop(SHUTDOWN_TIMEOUT)
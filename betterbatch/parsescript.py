@@ -11,12 +11,23 @@ import ConfigParser
 import copy
 import threading
 import time
+import Queue
+import cPickle as pickle
+import bisect
+from collections import deque
 
 import yaml
 
 from . import built_in_commands
 from . import cmd_line
-from .tools import which
+from . import lexer
+from . import parallel
+from . import pathindex
+from . import persisted
+from . import persistent_shell
+from . import scriptcache
+from . import statedb
+from . import uptodate
 
 PARAM_FILE = os.path.join(os.path.dirname(__file__), "param_counts.ini")
 
@@ -85,6 +96,9 @@ class CommandPathNotFoundError(RuntimeError):
         self.command_path = command_path
         self.string = string
 
+    def __reduce__(self):
+        return (self.__class__, (self.command_path, self.string))
+
 
 class UndefinedVariableError(RuntimeError):
     "Error raised when a variable is used that has not been defined"
@@ -96,6 +110,9 @@ class UndefinedVariableError(RuntimeError):
         self.variable = variable
         self.string = string
 
+    def __reduce__(self):
+        return (self.__class__, (self.variable, self.string))
+
 
 class ErrorCollection(RuntimeError):
     "Class used to track many errors "
@@ -104,6 +121,9 @@ class ErrorCollection(RuntimeError):
         RuntimeError.__init__(self, "%d errors" % len(errors))
         self.errors = errors
 
+    def __reduce__(self):
+        return (self.__class__, (self.errors,))
+
     def LogErrors(self):
         "Log all the errors in a user friendly format"
 
@@ -163,6 +183,27 @@ class EndExecution(Exception):
         self.msg = msg
         self.ret = ret
 
+    def __reduce__(self):
+        return (self.__class__, (self.ret, self.msg))
+
+
+def ReadScriptText(script_file):
+    "Return the contents of the script file"
+    f = open(script_file, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def WarnIfTabs(yaml_data, yaml_file):
+    "Log a warning if the script contains tabs (they are replaced by spaces)"
+    if "\t" in yaml_data:
+        LOG.warning(
+            "WARNING: Script contained one or more tab (\\t) characters.\n"
+            "         They have been replaced by spaces for processing:\n"
+            "         '%s'" % yaml_file)
+
 
 def ParseYAMLFile(yaml_file):
     """Parse a single YAML file
@@ -170,26 +211,36 @@ def ParseYAMLFile(yaml_file):
     Most of the work of this function is to convert various different errors
     into RuntimeErrors
     """
+    # allow IOErrors to propogate up - they can be handled better at a
+    # higher level
+    return ParseYAMLText(ReadScriptText(yaml_file), yaml_file)
+
+
+def ParseYAMLText(yaml_data, yaml_file):
+    "Parse the text of the script file yaml_file"
+    # replace tabs with spaces
+    # and log a warning if we changed the file
+    WarnIfTabs(yaml_data, yaml_file)
+    yaml_data = yaml_data.replace("\t", "    ")
+
+    # ensure that all opening braces are also closed
+    if yaml_data.count('{{{') != yaml_data.count('}}}'):
+        raise RuntimeError(
+            "Mismatched opening {{{ and closing }}} in '%s'" % yaml_file)
+
+    # most scripts can be read without the YAML parser
     try:
-        # read the YAML contents
-        f = open(yaml_file, "rb")
-        yaml_data = f.read()
-        f.close()
+        return lexer.ParseScriptText(yaml_data)
+    except lexer.UnsupportedSyntax:
+        return ParseYAMLTextWithYAML(yaml_data, yaml_file)
 
-        # replace tabs with spaces
-        # and log a warning if we changed the file
-        if "\t" in yaml_data:
-            yaml_data = yaml_data.replace("\t", "    ")
-            LOG.warning(
-                "WARNING: Script contained one or more tab (\\t) characters.\n"
-                "         They have been replaced by spaces for processing:\n"
-                "         '%s'" % yaml_file)
 
-        # ensure that all opening braces are also closed
-        if yaml_data.count('{{{') != yaml_data.count('}}}'):
-            raise RuntimeError(
-                "Mismatched opening {{{ and closing }}} in '%s'" % yaml_file)
+def ParseYAMLTextWithYAML(yaml_data, yaml_file):
+    """Parse the (tab free) script text using the YAML parser
 
+    The text is pre-processed so that YAML reads it the way BetterBatch
+    expects"""
+    try:
         # only colons at the end of lines to be treated as YAML mappings
         re_non_end_colon = re.compile(r":( *)(?!\s*$)", re.MULTILINE)
         yaml_data = re_non_end_colon.sub(r"+++++colon+++++\1", yaml_data)
@@ -208,19 +259,7 @@ def ParseYAMLFile(yaml_file):
         yaml_data = blocks_to_preformat.sub(r"\1- |\n\1    \3", yaml_data)
 
         # allow new-lines in {{{ }}} quoted strings
-        brace_quoted = re.compile(r"\{\{\{.*?\}\}\}", re.DOTALL)
-        for quoted in brace_quoted.finditer(yaml_data):
-            quoted_text = quoted.group(0)
-
-            #  we keep the same length with these replacements
-            quoted_text = quoted_text.replace("\r\n", "  ")
-            quoted_text = quoted_text.replace("\n", " ")
-            quoted_text = quoted_text.replace("\r", " ")
-
-            yaml_data = (
-                yaml_data[:quoted.start()] +
-                quoted_text +
-                yaml_data[quoted.end():])
+        yaml_data = lexer.FoldBraceNewlines(yaml_data)
 
         # Parse the yaml data
         script_data = yaml.load(yaml_data)
@@ -252,11 +291,6 @@ def ParseYAMLFile(yaml_file):
 
         return script_data
 
-    # allow IOErrors to propogate up - they can be handled better at a
-    # higher level
-    #except IOError, e:
-    #    raise RuntimeError(e)
-
     except yaml.parser.ScannerError, e:
         raise RuntimeError("%s - %s" % (yaml_file, e))
 
@@ -325,6 +359,14 @@ def SplitStatementAndData(step):
     return parts
 
 
+# a variable reference e.g. <var>
+VARIABLE_REFERENCE_RE = re.compile("""
+        (\<
+            ([^\>\<]+)
+        \>)
+    """, re.X)
+
+
 def FindVariableReferences(text):
     """Find the variable references in the string
 
@@ -334,14 +376,8 @@ def FindVariableReferences(text):
     >>> {'var1': ['<var1>', < var1>], 'var2': ['<  var2 >']}
     """
 
-    variable_reference_re = re.compile("""
-            (\<
-                ([^\>\<]+)
-            \>)
-        """, re.X)
-
     # find all the variable references
-    found = variable_reference_re.findall(text)
+    found = VARIABLE_REFERENCE_RE.findall(text)
 
     variables_referenced = {}
 
@@ -358,32 +394,527 @@ def FindVariableReferences(text):
     return variables_referenced
 
 
+def LoopVarMatches(parts, var):
+    """Return True if var matches the loop variable reference
+
+    parts is the reference (wrapped in start_ and _end) split on __loopvar__
+    """
+    test_var = "start_%s_end" % var
+    other_parts = []
+    last_match_end = 0
+    for part in parts:
+        # ensure to start where teh last one was found
+        found = test_var.find(part, last_match_end)
+        if found == -1:
+            return False
+        other_parts.append(test_var[last_match_end:found])
+        last_match_end = found + len(part)
+
+    # if all references were the same
+    return len(set([p for p in other_parts if p])) == 1
+
+
 def FindVariableMatchingLoopVar(var_name, variables):
     """The variable name contains a reference to  __loopvar__
-    So we want to find the first variable that matches this value"""
+    So we want to find the first variable that matches this value
+
+    If variables is a VariableStore only the variables that could match are
+    checked (in the order of the index)"""
 
     parts = ("start_%s_end" % var_name).split("__loopvar__")
-    for var in variables:
-        test_var = "start_%s_end" % var
-        other_parts = []
-        matched_parts = []
-        last_match_end = 0
-        for part in parts:
-            # ensure to start where teh last one was found
-            found = test_var.find(part, last_match_end)
-            if found == -1:
-                break
-            other_parts.append(test_var[last_match_end:found])
-            matched_parts.append(part)
-            last_match_end = found + len(part)
+    if isinstance(variables, VariableStore):
+        candidates = variables.names_matching(
+            parts[0][len("start_"):], parts[-1][:-len("_end")])
+    else:
+        candidates = variables
 
-        # if we are out of the loop because it wasn't found
-        if found == -1:
+    for var in candidates:
+        if LoopVarMatches(parts, var):
+            return var
+
+
+# the compiled templates of texts that have been rendered
+_TEMPLATES = {}
+_MAX_TEMPLATES = 10000
+
+
+class _FullReplaceNeeded(Exception):
+    "The text can not be rendered from its compiled template"
+
+
+def EscapeAngleBrackets(text):
+    "Hide doubled << and >> so that they are not taken as references"
+    text = text.replace("<<", "{{_LT_}}")
+
+    # We replace greater than >> a bit differently - because if there are
+    # an odd number of greater than signs in a row we want to split from
+    # the end not from the start
+    return "{{_GT_}}".join(text.rsplit(">>"))
+
+
+def UnescapeAngleBrackets(text):
+    "Convert escaped << and >> to < and >"
+    text = text.replace("{{_LT_}}", "<")
+    return text.replace("{{_GT_}}", ">")
+
+
+def CompileVariableReferences(text):
+    """Split the text into literal text and variable references
+
+    Returns a list [literal, name, literal, name, ..., literal] where the
+    literal text is still escaped, or None if the text contains a < or >
+    that is not part of a reference (these need the full replacement)."""
+    template = _TEMPLATES.get(text)
+    if template is not None or text in _TEMPLATES:
+        return template
+
+    parts = VARIABLE_REFERENCE_RE.split(EscapeAngleBrackets(text))
+
+    # split() returns the whole reference and the name for each reference
+    template = [parts[0]]
+    for i in range(1, len(parts), 3):
+        template.append(parts[i + 1].strip().lower())
+        template.append(parts[i + 2])
+
+    for literal in template[::2]:
+        if "<" in literal or ">" in literal:
+            template = None
+            break
+
+    if len(_TEMPLATES) >= _MAX_TEMPLATES:
+        _TEMPLATES.clear()
+    _TEMPLATES[text] = template
+    return template
+
+
+def RenderCompiledReferences(text, variables, depth=0):
+    """Replace the variable references in text using its compiled template
+
+    Raises _FullReplaceNeeded for anything where the result of the full
+    replacement could be different (undefined variables, loop variables,
+    values containing < or >, very deep references)"""
+    template = CompileVariableReferences(text)
+    if template is None or depth > 100:
+        raise _FullReplaceNeeded()
+
+    if len(template) == 1:
+        return UnescapeAngleBrackets(template[0])
+
+    parts = list(template)
+    for i in range(1, len(parts), 2):
+        if isinstance(variables, VariableStore):
+            parts[i] = variables.resolved(parts[i])
             continue
 
-        # if all references were the same
-        if len(set([p for p in other_parts if p])) == 1:
-            return var
+        value = variables.get(parts[i])
+        if not isinstance(value, basestring):
+            raise _FullReplaceNeeded()
+
+        value = RenderCompiledReferences(value, variables, depth + 1)
+        if "<" in value or ">" in value:
+            raise _FullReplaceNeeded()
+        parts[i] = value
+
+    return UnescapeAngleBrackets("".join(parts))
+
+
+class VariableNameIndex(object):
+    """Sorted variable names, for finding loop variable matches quickly
+
+    LoopVarMatches() checks "start_<name>_end" so the names are indexed
+    as "<name>_end" (sorted) and "start_<name>" (reversed and sorted)"""
+
+    def __init__(self, names=()):
+        self.names = sorted(name + "_end" for name in names)
+        self.reversed_names = sorted(
+            ("start_" + name)[::-1] for name in names)
+        self.unusual_names = set(
+            name for name in names if self.is_unusual_name(name))
+
+    def is_unusual_name(self, name):
+        """Return True if the name could match a loop variable reference
+        without having the same prefix and suffix (see LoopVarMatches)"""
+        return ("start_" in name or "_end" in name or
+            name.startswith("end") or name.endswith("start"))
+
+    def add(self, name):
+        "Add a new variable name to the index"
+        bisect.insort(self.names, name + "_end")
+        bisect.insort(self.reversed_names, ("start_" + name)[::-1])
+        if self.is_unusual_name(name):
+            self.unusual_names.add(name)
+
+    def remove(self, name):
+        "Remove a variable name from the index"
+        del self.names[bisect.bisect_left(self.names, name + "_end")]
+        del self.reversed_names[bisect.bisect_left(
+            self.reversed_names, ("start_" + name)[::-1])]
+        self.unusual_names.discard(name)
+
+    def copy(self):
+        "Return a copy of the index"
+        index = VariableNameIndex()
+        index.names = list(self.names)
+        index.reversed_names = list(self.reversed_names)
+        index.unusual_names = set(self.unusual_names)
+        return index
+
+    def matching(self, prefix, suffix):
+        """Yield the variable names that may match a loop variable reference
+
+        These are the names where "<name>_end" starts with prefix and
+        "start_<name>" ends with suffix, and then any with unusual names that
+        have to be checked anyway."""
+        start, end = _PrefixRange(self.names, prefix)
+        r_start, r_end = _PrefixRange(self.reversed_names, suffix[::-1])
+
+        # go through the smaller of the two ranges
+        if end - start <= r_end - r_start:
+            for i in xrange(start, end):
+                name = self.names[i][:-len("_end")]
+                if ("start_" + name).endswith(suffix):
+                    yield name
+        else:
+            for i in xrange(r_start, r_end):
+                name = self.reversed_names[i][::-1][len("start_"):]
+                if (name + "_end").startswith(prefix):
+                    yield name
+
+        for name in list(self.unusual_names):
+            if not ((name + "_end").startswith(prefix) and
+                    ("start_" + name).endswith(suffix)):
+                yield name
+
+
+# marks a variable deleted in a scope that is still set in an outer layer
+_DELETED = object()
+_MISSING = object()
+
+
+class VariableLayer(object):
+    """Variables shared by scopes - this is never changed once created
+
+    values can include _DELETED for variables that are removed in this layer
+    but set in one of the parent layers"""
+
+    def __init__(self, values, parent):
+        self.values = values
+        self.parent = parent
+        self._index = None
+
+    def index(self):
+        "Return the index of the names in this layer (built when needed)"
+        if self._index is None:
+            self._index = VariableNameIndex(self.values)
+        return self._index
+
+
+class VariableStore(object):
+    """The variables of a script, with their fully resolved values cached
+
+    The variables that each resolved value depends on are recorded, so that
+    setting or removing a variable only drops the resolved values that used
+    it. Only values that can be rendered from their compiled template are
+    cached - anything else is replaced in full each time it is used.
+
+    New scopes (function calls, parallel steps) do not copy the variables.
+    The variables set so far are moved to a VariableLayer that is shared by
+    the old and new scope, and each stores its own changes on top of it."""
+
+    # a layer is merged with its parent when the parent is not much bigger
+    # which keeps the number of layers low
+    layer_merge_ratio = 2
+
+    def __init__(self, *args, **kwargs):
+        # the variables set in this scope
+        self._values = dict(*args, **kwargs)
+        self._parent = None
+        self._resolved = {}
+        self._dependents = {}
+        self._resolving = set()
+        self._index = VariableNameIndex(self._values)
+
+    def _lookup(self, name):
+        "Return the value of the variable or _MISSING"
+        value = self._values.get(name, _MISSING)
+        layer = self._parent
+        while value is _MISSING and layer is not None:
+            value = layer.values.get(name, _MISSING)
+            layer = layer.parent
+
+        if value is _DELETED:
+            return _MISSING
+        return value
+
+    def _flatten(self):
+        "Return a dictionary of all the variables"
+        layers = []
+        layer = self._parent
+        while layer is not None:
+            layers.append(layer.values)
+            layer = layer.parent
+
+        if not layers:
+            return dict(self._values)
+
+        values = {}
+        for layer_values in reversed(layers):
+            values.update(layer_values)
+        values.update(self._values)
+        for name, value in values.items():
+            if value is _DELETED:
+                del values[name]
+        return values
+
+    def _freeze(self):
+        "Move the variables set in this scope to a new shared layer"
+        if not self._values:
+            return
+
+        values = self._values
+        parent = self._parent
+        while parent is not None and \
+                len(parent.values) <= len(values) * self.layer_merge_ratio:
+            merged = dict(parent.values)
+            merged.update(values)
+            values = merged
+            parent = parent.parent
+
+        if parent is None:
+            for name, value in values.items():
+                if value is _DELETED:
+                    del values[name]
+
+        self._parent = VariableLayer(values, parent)
+        self._values = {}
+        self._index = VariableNameIndex()
+
+    def scope(self):
+        """Return a new scope that starts with the current variables
+
+        Changes to either scope are not seen in the other"""
+        self._freeze()
+        store = VariableStore()
+        store._parent = self._parent
+        return store
+
+    def changes(self):
+        """Return the variables set in this scope (not in the parent layers)
+
+        Variables removed in this scope have the value _DELETED"""
+        return dict(self._values)
+
+    def names_matching(self, prefix, suffix):
+        "Yield the variable names that may match a loop variable reference"
+        indexes = [self._index]
+        layer = self._parent
+        while layer is not None:
+            indexes.append(layer.index())
+            layer = layer.parent
+
+        if len(indexes) == 1:
+            for name in self._index.matching(prefix, suffix):
+                if self._lookup(name) is not _MISSING:
+                    yield name
+            return
+
+        seen = set()
+        for index in indexes:
+            for name in index.matching(prefix, suffix):
+                if name not in seen:
+                    seen.add(name)
+                    if self._lookup(name) is not _MISSING:
+                        yield name
+
+    def resolved(self, name):
+        """Return the fully resolved value of the variable
+
+        Raises _FullReplaceNeeded if the value can not be resolved from
+        its compiled template (including when it references itself)"""
+        value = self._resolved.get(name)
+        if value is not None:
+            return value
+
+        if name in self._resolving:
+            # a loop e.g. x -> y -> x, the full replacement reports it
+            raise _FullReplaceNeeded()
+
+        value = self._lookup(name)
+        if not isinstance(value, basestring):
+            raise _FullReplaceNeeded()
+        template = CompileVariableReferences(value)
+        if template is None:
+            raise _FullReplaceNeeded()
+
+        parts = list(template)
+        self._resolving.add(name)
+        try:
+            for i in range(1, len(parts), 2):
+                self._dependents.setdefault(parts[i], set()).add(name)
+                parts[i] = self.resolved(parts[i])
+        finally:
+            self._resolving.discard(name)
+
+        value = UnescapeAngleBrackets("".join(parts))
+        if "<" in value or ">" in value:
+            raise _FullReplaceNeeded()
+
+        self._resolved[name] = value
+        return value
+
+    def invalidate(self, name):
+        "Drop the resolved value of the variable and of all that use it"
+        to_drop = [name]
+        while to_drop:
+            name = to_drop.pop()
+            self._resolved.pop(name, None)
+            to_drop.extend(self._dependents.pop(name, ()))
+
+    def __getitem__(self, name):
+        value = self._lookup(name)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        value = self._lookup(name)
+        if value is _MISSING:
+            return default
+        return value
+
+    def __contains__(self, name):
+        return self._lookup(name) is not _MISSING
+
+    has_key = __contains__
+
+    def __setitem__(self, name, value):
+        if name not in self._values:
+            self._index.add(name)
+        self._values[name] = value
+        self.invalidate(name)
+
+    def __delitem__(self, name):
+        if self._lookup(name) is _MISSING:
+            raise KeyError(name)
+
+        if self._parent is not None:
+            # it may still be set in one of the layers
+            self._values[name] = _DELETED
+        else:
+            del self._values[name]
+            self._index.remove(name)
+        self.invalidate(name)
+
+    def __len__(self):
+        if self._parent is None:
+            return len(self._values)
+        return len(self._flatten())
+
+    def __iter__(self):
+        if self._parent is None:
+            return iter(self._values)
+        return iter(self._flatten())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return self._flatten().values()
+
+    def items(self):
+        return self._flatten().items()
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, VariableStore):
+            other = other._flatten()
+        return self._flatten() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._flatten())
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def setdefault(self, name, value=None):
+        if name not in self:
+            self[name] = value
+        return self[name]
+
+    def pop(self, name, *default):
+        value = self._lookup(name)
+        if value is _MISSING:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        del self[name]
+        return value
+
+    def popitem(self):
+        for name in self:
+            return name, self.pop(name)
+        raise KeyError("popitem(): dictionary is empty")
+
+    def clear(self):
+        self._values = {}
+        self._parent = None
+        self._resolved.clear()
+        self._dependents.clear()
+        self._index = VariableNameIndex()
+
+    def copy(self):
+        "Return a copy of the variables (see scope())"
+        return self.scope()
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        # the values are strings, so they do not need to be copied
+        return self.scope()
+
+    def __reduce__(self):
+        return (VariableStore, (self._flatten(), ))
+
+
+def NewScope(variables):
+    """Return the variables to use for a new scope
+
+    Changes to the new scope are not seen in variables (and vice versa)"""
+    if isinstance(variables, VariableStore):
+        return variables.scope()
+    return VariableStore(variables)
+
+
+def _PrefixRange(names, prefix):
+    "Return the start and end of the names starting with prefix"
+    start = bisect.bisect_left(names, prefix)
+    if not prefix:
+        return start, len(names)
+
+    # the first name after all those that start with prefix
+    try:
+        after = prefix[:-1] + type(prefix)(chr(ord(prefix[-1]) + 1))
+    except ValueError:
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return start, end
+
+    return start, bisect.bisect_left(names, after)
 
 
 def ReplaceVariableReferences(
@@ -393,6 +924,22 @@ def ReplaceVariableReferences(
     If there are any variables references in a replaced variable those will
     also be replaced"""
 
+    if not loop:
+        try:
+            return RenderCompiledReferences(text, variables)
+        except _FullReplaceNeeded:
+            pass
+
+    return ReplaceAllVariableReferences(text, variables, loop, ignore_errors)
+
+
+def ReplaceAllVariableReferences(
+    text, variables, loop=None, ignore_errors = False):
+    """Replace all variable references in the string, pass by pass
+
+    This handles all cases, including values that contain references once
+    they are replaced e.g. <var.<key> >"""
+
     if loop is None:
         loop = []
 
@@ -403,12 +950,7 @@ def ReplaceVariableReferences(
     # they are not supposed to be around a variable reference.
     # Replacing them like this - makes finding the acutal variable
     # references much easier
-    text = text.replace("<<", "{{_LT_}}")
-
-    # We replace greater than >> a bit differently - because if there are
-    # an odd number of greater than signs in a row we want to split from
-    # the end not from the start
-    text = "{{_GT_}}".join(text.rsplit(">>"))
+    text = EscapeAngleBrackets(text)
 
     var_refs = FindVariableReferences(text)
     for variable, refs_to_replace in var_refs.items():
@@ -427,10 +969,10 @@ def ReplaceVariableReferences(
                 continue
 
         # ensure that we are not in a variable loop e.g x -> y -> x
-        # a loop of 1 is OK e.g. x = <x>_ + 1
-        if len(loop) > 100:
+        if variable in loop:
             errors.append("Loop found in variable definition "
-                "'%s', variables %s" % (original_text, list(set(loop))))
+                "'%s', variables %s" % (
+                    original_text, loop[loop.index(variable):] + [variable]))
             continue
 
         loop.append(variable)
@@ -465,10 +1007,7 @@ def ReplaceVariableReferences(
             text = ReplaceVariableReferences(
                 text, variables, ignore_errors = ignore_errors)
 
-    text = text.replace("{{_LT_}}", "<")
-    text = text.replace("{{_GT_}}", ">")
-
-    return text
+    return UnescapeAngleBrackets(text)
 
 
 def ParseExecSectionTokens(tokens, exe_sections, cur_block=None):
@@ -510,9 +1049,112 @@ def TokenizeExecSections(text):
     return EXECUTABLE_SECTION.split(text)
 
 
+def RunExecutableSection(command, variables, phase, text):
+    "Run the command of an executable section and return its output"
+    step = ParseStep(command)
+    if isinstance(step, FunctionCall):
+        output = step.call(variables, phase)
+        if output is None:
+            raise RuntimeError(
+                "Function call with no return statement, "
+                "No value to retrieve:\n\t'%s'" % text)
+    else:
+        step.execute(variables, phase)
+        output = step.output
+
+    # Escape any greater/less than characters in the output of the
+    # command
+    output = output.strip()
+    output = output.replace("<", "<<")
+    output = output.replace(">", ">>")
+    return output
+
+
+class _RunningSection(object):
+    "An executable section that is being run by a thread"
+
+    def __init__(self):
+        self.thread = threading.currentThread()
+        self.finished = threading.Event()
+
+
+class ExecSectionCache(object):
+    """Output of executable sections with the {*cache*} qualifier
+
+    Each command is run once per run (in each folder) - threads that need
+    the output of a command that another thread is running wait for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def output(self, command, run):
+        "Return the output of the command - calling run() only if needed"
+        key = (os.getcwd(), command)
+        running = None
+        while True:
+            self.lock.acquire()
+            try:
+                entry = self.entries.get(key)
+                if entry is None:
+                    running = _RunningSection()
+                    self.entries[key] = running
+                    self.misses += 1
+                    break
+                if not isinstance(entry, _RunningSection):
+                    self.hits += 1
+                    LOG.debug("Using cached output of: '%s'" % command)
+                    return entry
+                if entry.thread is threading.currentThread():
+                    # the command needs its own output (e.g. a recursive
+                    # function) - so it cannot be cached (and is run after
+                    # releasing the lock as it may use the cache too)
+                    break
+            finally:
+                self.lock.release()
+            entry.finished.wait()
+
+        if running is None:
+            return run()
+
+        try:
+            output = run()
+        except:
+            self.lock.acquire()
+            try:
+                del self.entries[key]
+            finally:
+                self.lock.release()
+            running.finished.set()
+            raise
+
+        self.lock.acquire()
+        try:
+            self.entries[key] = output
+        finally:
+            self.lock.release()
+        running.finished.set()
+        return output
+
+    def log_stats(self):
+        "Log how often the cache was used"
+        if self.hits or self.misses:
+            LOG.debug("Executable section cache: %d hits, %d misses" % (
+                self.hits, self.misses))
+
+
+# the cached output of executable sections for the current run
+EXEC_SECTION_CACHE = ExecSectionCache()
+
+
 def ReplaceExecutableSections(text, variables, phase="run"):
     """If variable has {{{cmd}}} - execute 'cmd' and update value with output
     """
+    # nothing to execute
+    if "{{{" not in text and "--#" not in text:
+        return text
 
     # this is necessary - as otherwise {{{{* or *}}}} will not be interpreted
     # correctly
@@ -547,18 +1189,14 @@ def ReplaceExecutableSections(text, variables, phase="run"):
         command = command.replace("--#QUAL_#--", "{*")
         command = command.replace("--#_QUAL#--", "*}")
 
-        step = ParseStep(command)
-        step.execute(variables, phase)
-        if not hasattr(step, 'output') and isinstance(step, FunctionCall):
-            raise RuntimeError(
-                "Function call with no return statement, "
-                "No value to retrieve:\n\t'%s'" % text)
-
-        # Escape any greater/less than characters in the output of the
-        # command
-        output = step.output.strip()
-        output = output.replace("<", "<<")
-        output = output.replace(">", ">>")
+        if phase != "test" and "{*" in command and \
+                'cache' in ParseQualifiers(command)[1]:
+            output = EXEC_SECTION_CACHE.output(
+                command,
+                lambda command = command: RunExecutableSection(
+                    command, variables, phase, text))
+        else:
+            output = RunExecutableSection(command, variables, phase, text)
 
         # ensure that the output is stored at teh correct position in the
         # list (a bit more complicated as we are going backwards)
@@ -696,7 +1334,7 @@ def ParseIfStep(step, statements, clean_keys):
                     raise RuntimeError(
                         "Only one of the if/and/or "
                         "statements can have steps: %s" % step)
-                if_steps = ParseSteps(steps)
+                if_steps = UnparsedSteps(steps)
 
             # check if NOT is applied to the condition
             negative_condition = False
@@ -707,7 +1345,7 @@ def ParseIfStep(step, statements, clean_keys):
             conditions[-1][1].negative_condition = negative_condition
 
         elif key == 'else':
-            else_steps = ParseSteps(steps)
+            else_steps = UnparsedSteps(steps)
 
         else:
             raise RuntimeError(
@@ -718,7 +1356,7 @@ def ParseIfStep(step, statements, clean_keys):
                 "  else:\n"
                 "    - ELSE_STEPS")
 
-    if not if_steps + else_steps:
+    if not (if_steps or else_steps):
         raise RuntimeError(
             "IF statement has no 'if_true' or 'else' statements '%s'" %
                 conditions)
@@ -733,7 +1371,7 @@ def ParseForStep(step, statements):
             "For statements should not have more than one 'key': %s" %
                 statements)
     loop_info, steps = statements[0][1:]
-    steps = ParseSteps(steps)
+    steps = UnparsedSteps(steps)
 
     if not steps:
         return None
@@ -748,10 +1386,15 @@ def ParseParallelStep(step, statements):
             "Parallel blocks can have more only one parent: %s" %
                 statements)
     # just get the steps
-    steps = statements[0][-1]
-    steps = ParseSteps(steps)
+    dummy, key_data, steps = statements[0]
+    steps = UnparsedSteps(steps)
 
-    return ParallelSteps(step, steps)
+    qualifiers = ParseQualifiers(key_data)[1]
+    return ParallelSteps(
+        step,
+        steps,
+        MaxJobsQualifier(qualifiers),
+        'processes' in qualifiers)
 
 
 def ParseFunctionNameAndArgs(name_args, def_or_call):
@@ -809,7 +1452,7 @@ def ParseFunctionDefinition(step, statements):
     dummy, name_args, steps = statements[0]
     name, args = ParseFunctionNameAndArgs(name_args, def_or_call="definition")
 
-    steps = ParseSteps(steps)
+    steps = UnparsedSteps(steps)
 
     return FunctionDefinition(step, name, args, steps)
 
@@ -852,6 +1495,105 @@ def ParseComplexStep(step):
             clean_keys)
 
 
+def FindFunctionDefinitions(raw_steps):
+    """Return the function definitions in the raw steps of a block
+
+    Function definitions in the blocks nested in the block are included"""
+    if not isinstance(raw_steps, list):
+        return []
+
+    functions = []
+    for raw_step in raw_steps:
+        if not isinstance(raw_step, dict):
+            continue
+
+        clean_keys = [
+            SplitStatementAndData(key)[0].strip().lower() for key in raw_step]
+        if 'function' in clean_keys:
+            functions.append(ParseComplexStep(raw_step))
+
+        for sub_steps in raw_step.values():
+            functions.extend(FindFunctionDefinitions(sub_steps))
+    return functions
+
+
+class UnparsedSteps(object):
+    """Steps of a block (if, for, function, etc) that have not been parsed yet
+
+    Blocks are only parsed when they are first needed - so for example
+    functions that are never called are never parsed. The function
+    definitions in the block are parsed (and registered) straight away so
+    that they can be called before the block is parsed."""
+
+    def __init__(self, raw_steps):
+        self.raw_steps = raw_steps
+
+        # the function definitions in the block (None if not searched for).
+        # The blocks nested in a block are searched with it - so they do not
+        # need to search their own steps
+        self.functions = None
+        if not getattr(_FUNCTION_REGISTRATION, 'in_block', False):
+            self.functions = self.find_functions()
+
+    def find_functions(self):
+        "Return the function definitions in the block and nested blocks"
+        prev_in_block = getattr(_FUNCTION_REGISTRATION, 'in_block', False)
+        _FUNCTION_REGISTRATION.in_block = True
+        try:
+            return FindFunctionDefinitions(self.raw_steps)
+        finally:
+            _FUNCTION_REGISTRATION.in_block = prev_in_block
+
+    def __nonzero__(self):
+        "Return True if there are any steps (the same as the parsed list)"
+        if self.raw_steps is None:
+            return False
+        if isinstance(self.raw_steps, basestring):
+            return True
+        for step in self.raw_steps:
+            if step is not None:
+                return True
+        return False
+
+    def parse(self):
+        "Return the parsed steps"
+        # the functions in the block were registered when it was created
+        # (a function could have been defined again since then)
+        prev_state = (
+            getattr(_FUNCTION_REGISTRATION, 'deferred', False),
+            getattr(_FUNCTION_REGISTRATION, 'in_block', False))
+        _FUNCTION_REGISTRATION.deferred = True
+        _FUNCTION_REGISTRATION.in_block = True
+        try:
+            return ParseSteps(self.raw_steps)
+        finally:
+            (_FUNCTION_REGISTRATION.deferred,
+                _FUNCTION_REGISTRATION.in_block) = prev_state
+
+
+class LazySteps(object):
+    """Step attribute that parses UnparsedSteps when first accessed
+
+    The parsed steps replace the unparsed steps on the instance so they are
+    only parsed once"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        steps = instance.__dict__[self.name]
+        if isinstance(steps, UnparsedSteps):
+            steps = steps.parse()
+            instance.__dict__[self.name] = steps
+        return steps
+
+    def __set__(self, instance, steps):
+        instance.__dict__[self.name] = steps
+
+
 class Step(object):
     "Represent a generic step - should never actually be instantiated"
 
@@ -860,6 +1602,13 @@ class Step(object):
         #self.referenced_variables = FindVariableReferences(raw_step)
         self.step_type, self.step_data = SplitStatementAndData(raw_step)
 
+    def validate(self, variables):
+        """Check the step without running it
+
+        This must not change the step (only the variables), so that the
+        same steps can be checked and then run."""
+        self.execute(variables, "test")
+
     def __str__(self):
         return unicode(self.raw_step).encode('mbcs')
 
@@ -959,9 +1708,14 @@ class VariableDefinition(Step):
         """
 
         new_val = self.value
+        persist_seconds = self.persist_seconds()
         if 'delayed' not in self.qualifiers:
             new_val = ReplaceVariableReferences(new_val, variables)
-            new_val = ReplaceExecutableSections(new_val, variables, phase)
+            if persist_seconds is not None and phase != "test":
+                new_val = self.persisted_value(
+                    new_val, variables, phase, persist_seconds)
+            else:
+                new_val = ReplaceExecutableSections(new_val, variables, phase)
 
         #Ensure that all qualifiers are copied
         new_val = VariableValue(new_val)
@@ -974,10 +1728,55 @@ class VariableDefinition(Step):
 
         variables[self.name] = new_val
 
+    def persist_seconds(self):
+        "Return how long to keep the value for {*persist=TTL*} (or None)"
+        ttl = QualifierValue(self.qualifiers, "persist")
+        if ttl is None:
+            return None
+        if 'delayed' in self.qualifiers:
+            raise RuntimeError(
+                "{*persist=...*} cannot be used with {*delayed*}: '%s'" %
+                    self.raw_step)
+        return persisted.ParseTimeToLive(ttl)
+
+    def persisted_value(self, text, variables, phase, seconds):
+        "Return the value stored by an earlier run - or compute and store it"
+        environment_names = [
+            name.strip() for name in
+                (QualifierValue(self.qualifiers, "persist_env") or "").split(",")
+                    if name.strip()]
+
+        value, stored = persisted.Value(
+            text,
+            environment_names,
+            seconds,
+            lambda: ReplaceExecutableSections(text, variables, phase))
+        if stored:
+            LOG.debug("Using the value of '%s' from an earlier run" % self.name)
+        return value
+
     def __repr__(self):
         return '"%s"' % self.value
 
 
+class LoopVariableBinding(VariableDefinition):
+    """Set the variable of a for loop to one of the values of the loop
+
+    This is the same as the step "set variable = value" - but the step does
+    not need to be built and parsed for every value"""
+
+    def __init__(self, variable, value):
+        self.raw_step = "set %s = %s" % (variable, value)
+        self.step_type = "set"
+
+        self.qualifiers = []
+        if "{*" in value:
+            value, self.qualifiers = ParseQualifiers(value)
+
+        self.name = variable
+        self.value = value.strip()
+
+
 class Qualifier(str):
     def __hash__(self):
         return hash(self.lower().strip())
@@ -1013,6 +1812,64 @@ def ParseQualifiers(text):
     return text, qualifiers
 
 
+def QualifierValue(qualifiers, name):
+    "Return the value of a qualifier like {*name=value*} (None if not there)"
+    for qualifier in qualifiers:
+        if "=" in qualifier:
+            key, value = qualifier.split("=", 1)
+            if key.strip().lower() == name:
+                return value.strip()
+    return None
+
+
+# Qualifiers of command steps that are only used by BetterBatch (they are
+# not passed to the command) - e.g. {*reads=...*}
+STEP_ONLY_QUALIFIERS = [
+    'reads', 'writes', 'inputs', 'outputs', 'hash', 'cache']
+
+
+def CommandQualifiers(qualifiers):
+    "Return the qualifiers of the step that are passed to the command"
+    return [qualifier for qualifier in qualifiers
+        if qualifier.split("=", 1)[0].strip().lower() not in
+            STEP_ONLY_QUALIFIERS]
+
+
+def MaxJobsQualifier(qualifiers):
+    "Return the value of the {*maxjobs=N*} qualifier (None if not there)"
+    max_jobs = QualifierValue(qualifiers, "maxjobs")
+    if max_jobs is None:
+        return None
+
+    try:
+        max_jobs = int(max_jobs)
+    except ValueError:
+        max_jobs = 0
+    if max_jobs < 1:
+        raise RuntimeError(
+            "maxjobs must be a number greater than 0: '{*%s*}'" %
+                ", ".join(qualifiers))
+    return max_jobs
+
+
+def UpToDateCheckForStep(qualifiers, command, variables, phase):
+    """Return the check for the {*inputs=...*} and {*outputs=...*} qualifiers
+
+    Returns None if neither is used"""
+    inputs = QualifierValue(qualifiers, "inputs")
+    outputs = QualifierValue(qualifiers, "outputs")
+    if inputs is None and outputs is None:
+        return None
+
+    inputs = RenderVariableValue(inputs or "", variables, phase)
+    outputs = RenderVariableValue(outputs or "", variables, phase)
+    return uptodate.UpToDateCheck(
+        command,
+        uptodate.SplitPatterns(inputs),
+        uptodate.SplitPatterns(outputs),
+        'hash' in qualifiers)
+
+
 def ValidateCommandPath(command, qualifiers = None):
     "Check command path and raise CommandPathNotFoundError if path not found"
 
@@ -1027,21 +1884,17 @@ def ValidateCommandPath(command, qualifiers = None):
     if command_path.lower() in built_in_commands.SHELL_COMMANDS:
         return
 
-    try:
-        if not os.path.exists(command_path):
-            # If the path does not exist
-            path_to_command, command_name = os.path.split(command_path)
-            paths = os.environ['path'].split(os.pathsep)
-            # ensure that the path to the command is include (if it is
-            # given)
-            if path_to_command:
-                paths.append(path_to_command)
-            # if which.which() cannot find it on the path,
-            # which.which() raises an error
-            which.which(command_name, paths)
-
-    except which.WhichError:
-        raise CommandPathNotFoundError(command_path, command)
+    if not os.path.exists(command_path):
+        # If the path does not exist
+        path_to_command, command_name = os.path.split(command_path)
+        paths = os.environ['path'].split(os.pathsep)
+        # ensure that the path to the command is include (if it is
+        # given)
+        if path_to_command:
+            paths.append(path_to_command)
+        # the folders are listed once per run (see pathindex)
+        if pathindex.FindCommand(command_name, paths) is None:
+            raise CommandPathNotFoundError(command_path, command)
 
 
 def ObfuscateHiddenVariables(text, variables):
@@ -1136,18 +1989,36 @@ class CommandStep(Step):
             #if "__echo_all_output__" in variables:
             #    LOG.info("-> " + command_text)
 
+        # copy the qualifiers as the same step may run in several threads
+        qualifiers = CommandQualifiers(self.qualifiers)
         if cmd == "echo" or "__echo_all_output__" in variables:
-            self.qualifiers.append('echo')
+            qualifiers.append('echo')
 
         cmd_log_string = ObfuscateHiddenVariables(cmd_log_string, variables)
+
+        up_to_date = UpToDateCheckForStep(
+            self.qualifiers, command_text, variables, phase)
+        if up_to_date is not None:
+            reason = up_to_date.skip_reason()
+            if reason:
+                LOG.info("Skipping command %s - %s" % (cmd_log_string, reason))
+                # do not leave the result of an earlier run
+                self.ret, self.output = 0, ""
+                variables['__last_return__'] = '0'
+                return
+
         #cmd_log_string = self.command_as_string_for_log(cmd, params)
         LOG.debug("Executing command %s" % cmd_log_string)
         try:
             # call the function and get the output and the return value
-            self.ret, self.output = func(params, self.qualifiers)
+            self.ret, self.output = func(params, qualifiers)
             variables['__last_return__'] = str(self.ret)
         except KeyboardInterrupt:
             variables['__last_return__'] = 'cancelled'
+            if not isinstance(threading.currentThread(), threading._MainThread):
+                # only the main thread can ask the user (pooled steps
+                # leave it to the main thread to stop the script)
+                raise
             while 1:
                 LOG.error(
                     "Step cancelled - Terminate script execution? [Y/n]")
@@ -1173,6 +2044,45 @@ class CommandStep(Step):
         elif indented_output != "\n":
             LOG.debug("Output from command:\n%s" % indented_output)
 
+        if up_to_date is not None and not self.ret:
+            up_to_date.record()
+
+
+    def stream_output(self, variables):
+        """Start the command and yield the lines of output as they are written
+
+        Returns None if the output cannot be streamed (the command is run in
+        process). The return value is checked after the last line."""
+        command_text = RenderVariableValue(self.step_data, variables, "run")
+        parts = SplitStatementAndData(command_text)
+        cmd = parts[0].strip().lower()
+
+        qualifiers = CommandQualifiers(self.qualifiers)
+        if cmd in built_in_commands.NAME_ACTION_MAPPING:
+            func = built_in_commands.NAME_ACTION_MAPPING[cmd]
+            if not isinstance(func, built_in_commands.ExternalCommand):
+                return None
+            command_text = func.command_line(parts[1], qualifiers)
+            cmd_log_string = self.command_as_string_for_log(cmd, parts[1])
+        else:
+            cmd_log_string = self.command_as_string_for_log("", command_text)
+
+        cmd_log_string = ObfuscateHiddenVariables(cmd_log_string, variables)
+        output = built_in_commands.StreamedCommand(command_text, qualifiers)
+
+        def Lines():
+            "Yield the lines and then check the return value"
+            LOG.debug("Streaming output of command %s" % cmd_log_string)
+            for line in output:
+                yield line
+
+            variables['__last_return__'] = str(output.returncode)
+            if output.returncode and not 'nocheck' in qualifiers:
+                raise RuntimeError(
+                    'Non zero return (%d) CMD: %s' %
+                        (output.returncode, cmd_log_string))
+        return Lines()
+
 
 class EchoStep(Step):
     "Request end execution of the script"
@@ -1204,73 +2114,162 @@ class EchoStep(Step):
 class ParallelSteps(Step):
     "An set of command steps to be executed in parallel"
 
-    def __init__(self, raw_step, steps):
+    steps = LazySteps('steps')
+
+    # maximum number of the steps to run at the same time (None for as
+    # many as the shared pool allows)
+    max_jobs = None
+
+    # run each step in a worker process rather than a thread
+    processes = False
+
+    def __init__(self, raw_step, steps, max_jobs = None, processes = False):
 
         self.raw_step = raw_step
 
         self.steps = steps
+        self.max_jobs = max_jobs
+        self.processes = processes
 
     def execute(self, variables, phase):
         "Run this step"
 
         # Test the steps
         ExecuteSteps(self.steps, variables, "test")
-        threads = []
-
-        class ThreadStepRunner(threading.Thread):
-            "Run a step in a separate thread"
-            def __init__(self, step, variables):
-                threading.Thread.__init__(self)
-                self.step = step
-                self.variables = variables
-                self.exception = None
-
-            def run(self):
-                "Run the thread and store any exceptions for later retrieval"
-                try:
-                    self.step.execute(self.variables, phase)
-                except Exception, e:
-                    self.exception = e
+        if phase == "test":
+            return
 
-        # start all the threads
-        for step in self.steps:
-            if phase != "test":
-                LOG.debug("starting step in new thread: '%s'" % step)
+        self.run_steps(self.steps, variables, phase)
 
-            # define variables immediately
-            if isinstance(step, VariableDefinition):
+    def run_steps(self, steps, variables, phase):
+        """Run the steps in parallel
+
+        steps can be any iterable, the steps are started as they are
+        produced (while the earlier ones are running)"""
+        processes = self.processes
+        if processes and not parallel.ProcessesAvailable():
+            LOG.warning(
+                "Steps cannot be run in separate processes here "
+                "- running them in threads")
+            processes = False
+
+        def StepRunner(step, variables):
+            "Return a job that runs the step"
+            def Run():
+                LOG.debug("starting step in parallel: '%s'" % step)
                 step.execute(variables, phase)
-            else:
-                # otherwise add the step to be executed with the
-                # current values of the variables
-                t = ThreadStepRunner(step, copy.deepcopy(variables))
-                t.start()
-                threads.append(t)
-
-        # wait for the threads to finish
-        errs = []
-        while threads:
-            for t in threads:
-                # Try to joiin the thread, but timeout very quickly
-                t.join(.01)
-
-                # if the thread has finished, print a message and
-                # remove it
-                if not t.isAlive():
-                    if phase != "test":
-                        LOG.debug("Thread finished: '%s'" % t.step)
-                    threads.remove(t)
-                    if t.exception:
-                        errs.append(t.exception)
-
-        # check if any threads
+                LOG.debug("Parallel step finished: '%s'" % step)
+
+            def RunInProcess():
+                LOG.debug("starting step in a new process: '%s'" % step)
+                error, records = parallel.RunInProcess(
+                    ExecuteStepInProcess,
+                    step,
+                    variables,
+                    phase,
+                    FunctionDefinition.all_functions)
+                for record in records:
+                    LOG.handle(record)
+                if error is not None:
+                    raise error
+                LOG.debug("Process finished: '%s'" % step)
+
+            if processes:
+                return RunInProcess
+            return Run
+
+        def Jobs():
+            "Yield the jobs to run the steps"
+            for step in steps:
+                # define variables immediately
+                if isinstance(step, VariableDefinition):
+                    step.execute(variables, phase)
+                else:
+                    # otherwise add the step to be executed with the
+                    # current values of the variables
+                    yield StepRunner(step, NewScope(variables))
+
+        errs = parallel.RunJobs(Jobs(), self.max_jobs)
         if errs:
             raise ErrorCollection(errs)
 
 
+class RecordCollector(logging.Handler):
+    "Keep log records (so that they can be logged by another process)"
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # ensure that the record can be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+# the handler of the log in a worker process (see ConfigWorkerProcessLogging)
+_WORKER_LOG_COLLECTOR = None
+
+
+def ConfigWorkerProcessLogging():
+    """Set up the logger of a worker process (called when it starts)
+
+    The records are collected to be logged by the parent process"""
+    global LOG, _WORKER_LOG_COLLECTOR
+    _WORKER_LOG_COLLECTOR = RecordCollector()
+
+    LOG = logging.getLogger("betterbatch")
+    LOG.setLevel(logging.DEBUG)
+    LOG.propagate = False
+    # the handlers of the parent (if the process was forked) are not used
+    LOG.handlers = [_WORKER_LOG_COLLECTOR]
+
+parallel.AddProcessInitializer(ConfigWorkerProcessLogging)
+
+
+def ExecuteStepInProcess(step, variables, phase, functions):
+    """Run the step of a {*processes*} parallel block in a worker process
+
+    The current directory and pushed directories are reset after the step
+    as the process is re-used. Returns the error raised by the step (or None)
+    and the log records to be logged by the parent process."""
+    collector = _WORKER_LOG_COLLECTOR
+    if collector is None:
+        raise RuntimeError("Steps can only be run in worker processes")
+
+    FunctionDefinition.all_functions.update(functions)
+    cwd = os.getcwd()
+    pushed_dirs = list(built_in_commands.PUSH_DIRECTORY_LIST)
+    error = None
+    try:
+        try:
+            step.execute(variables, phase)
+        except Exception, e:
+            error = e
+            try:
+                pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                error = RuntimeError(str(e))
+    finally:
+        os.chdir(cwd)
+        built_in_commands.PUSH_DIRECTORY_LIST[:] = pushed_dirs
+
+    records, collector.records = collector.records, []
+    return error, records
+
+
 class ForStep(Step):
     "One or more steps repeated"
 
+    steps = LazySteps('steps')
+
+    max_jobs = None
+
     def __init__(self, raw_step, loop_condition, steps):
 
         self.steps = steps
@@ -1282,41 +2281,129 @@ class ForStep(Step):
         self.variable, self.command = [
             part.strip() for part in loop_condition.split(' in ', 1)]
         self.variable = self.variable.lower()
+        self.max_jobs = MaxJobsQualifier(self.qualifiers)
+
+        # ensure that the variable name is valid
+        try:
+            ParseVariableDefinition("%s = " % self.variable)
+        except RuntimeError, e:
+            raise RuntimeError(str(e) % self.raw_step)
+
+    def streamed_values(self, variables):
+        """Return the loop values as the loop command writes them
+
+        Returns None if the loop is not over the output of a single command
+        that can be streamed"""
+        section = re.match(r"^\{\{\{(.*)\}\}\}$", self.command.strip(), re.S)
+        if not section or "{{{" in section.group(1):
+            return None
+
+        step = ParseStep(section.group(1).strip())
+        if not isinstance(step, CommandStep):
+            return None
+
+        lines = step.stream_output(variables)
+        if lines is None:
+            return None
+
+        return StreamedLoopValues(lines)
 
     def execute(self, variables, phase):
         "Run this step"
 
+        if phase != "test" and 'stream' in self.qualifiers:
+            values = self.streamed_values(variables)
+            if values is not None:
+                self.run_loop(values, variables, phase, streamed = True)
+                return
+            LOG.debug(
+                "Output of loop command cannot be streamed: '%s'" %
+                    self.command)
+
         cmd_output = RenderVariableValue(self.command, variables, phase)
 
         if not cmd_output.strip():
             return
 
-        # split the variables
-        values = cmd_output.split("\n")
-
-        # unloop the loop
-        loop_steps = []
         if phase != "test":
-            for val in values:
-                # create a variableDefinition for this
-                loop_steps.append(
-                    VariableDefinition(
-                        "set %s = %s" % (self.variable, val)))
-                loop_steps.extend(self.steps)
+            values = IterLines(cmd_output)
         else:
-            loop_steps.append(
-                VariableDefinition("set %s = __LOOPVAR__" % self.variable))
-            loop_steps.extend(self.steps)
+            values = ["__LOOPVAR__"]
+
+        self.run_loop(values, variables, phase)
+
+    def run_loop(self, values, variables, phase, streamed = False):
+        """Run the steps of the loop for each of the values
+
+        If streamed then the values are still being produced - parallel
+        steps are started without first checking the steps for all the
+        values"""
+        # the steps for each value are only created when they are reached
+        loop_steps = self.loop_steps(values)
 
         if 'parallel' in self.qualifiers:
-            loop_steps = [ParallelSteps(self.raw_step, loop_steps)]
+            parallel_step = ParallelSteps(
+                self.raw_step,
+                [],
+                self.max_jobs,
+                'processes' in self.qualifiers)
+            if streamed:
+                parallel_step.run_steps(loop_steps, variables, phase)
+                return
+            parallel_step.steps = list(loop_steps)
+            loop_steps = [parallel_step]
 
         ExecuteSteps(loop_steps, variables, phase)
 
+    def loop_steps(self, values):
+        "Yield the steps to run for the values (setting the loop variable)"
+        for value in values:
+            yield LoopVariableBinding(self.variable, value)
+            for step in self.steps:
+                yield step
+
+
+def StreamedLoopValues(lines):
+    """Yield the loop values for the lines of output of a command
+
+    The values are the same as if the whole output had been captured - the
+    output is stripped (so leading and trailing empty lines are skipped) and
+    angle brackets are escaped."""
+    empty_lines = 0
+    started = False
+    for line in lines:
+        if not line.strip():
+            if started:
+                empty_lines += 1
+            continue
+
+        # only empty lines between other lines are values
+        for i in range(empty_lines):
+            yield ""
+        empty_lines = 0
+        started = True
+
+        yield line.replace("<", "<<").replace(">", ">>")
+
+
+def IterLines(text):
+    "Yield the lines of text one at a time (rather than splitting it all)"
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
 
 class IfStep(Step):
     "An IF block"
 
+    if_steps = LazySteps('if_steps')
+    else_steps = LazySteps('else_steps')
+
     def __init__(self, raw_step, conditions, if_steps, else_steps):
 
         self.raw_step = raw_step
@@ -1341,7 +2428,7 @@ class IfStep(Step):
                     "Only DEFINED, COMPARE and EXISTS are "
                     "allowed in If statement conditions: '%s'" % condition)
 
-            condition.execute(variables, 'test')
+            condition.validate(variables)
 
             if isinstance(condition, VariableDefinedCheck):
                 if condition.variable not in variables:
@@ -1383,7 +2470,6 @@ class IfStep(Step):
         # due to a 'defined' check which would upset the 'else' checks
         if phase == 'test':
             self.__test_step(variables)
-            self.output = ''
             return
 
         for cond_type, condition in self.conditions:
@@ -1429,6 +2515,8 @@ class FunctionDefinition(Step):
 
     all_functions = {}
 
+    steps = LazySteps('steps')
+
     def __init__(self, raw_step, name, args, steps):
 
         self.raw_step = raw_step
@@ -1447,7 +2535,7 @@ class FunctionDefinition(Step):
             arg[0] for arg in self.args if arg[1] == None]
 
         # keep a record of the function so that we can reference it
-        FunctionDefinition.all_functions[name.lower()] = self
+        RegisterFunction(self)
 
     def execute(self, variables, phase):
         """Nothing needs to be done here as both testing and execution
@@ -1460,8 +2548,8 @@ class FunctionDefinition(Step):
             LOG.debug(
                 "Function call: '%s' with args %s" % (self.name, arg_values))
 
-        # make a copy of the variables
-        vars_copy = copy.deepcopy(variables)
+        # the function gets its own scope for variables
+        vars_copy = NewScope(variables)
         vars_copy.update(arg_values)
 
         steps = ExecuteSteps(self.steps, vars_copy, phase)
@@ -1495,6 +2583,13 @@ class FunctionCall(Step):
                 self.keyword_args[arg_name] = arg_value
 
     def execute(self, variables, phase):
+        "Call the function - the returned value (if any) is the output"
+        output = self.call(variables, phase)
+        if output is not None and phase != "test":
+            self.output = output
+
+    def call(self, variables, phase):
+        "Call the function and return the value it returned (or None)"
         # ensure that the function name exists
         if not self.name.lower() in FunctionDefinition.all_functions:
             raise RuntimeError(
@@ -1551,16 +2646,17 @@ class FunctionCall(Step):
 
                 args_to_pass[arg_name] = arg_value
 
-        # If there was a return then set our output value
+        # If there was a return then pass back the returned value
         try:
             function.call_function(args_to_pass, variables, phase)
         except FunctionReturnWrapper, e:
-            self.output = e.ret.output
+            return e.output
+        return None
 
 
 class FunctionReturnWrapper(Exception):
-    def __init__(self, ret):
-        self.ret = ret
+    def __init__(self, output):
+        self.output = output
 
 
 class FunctionReturn(Step):
@@ -1571,12 +2667,13 @@ class FunctionReturn(Step):
         self.value, self.qualifiers = ParseQualifiers(step_data)
 
     def execute(self, variables, phase):
-        self.output = RenderVariableValue(self.value, variables, phase)
+        output = RenderVariableValue(self.value, variables, phase)
         if phase != "test":
+            self.output = output
             message = "Returning from function: %s" % self.output
             LOG.debug(message)
-        # throw ourselves up the stack!
-        raise FunctionReturnWrapper(self)
+        # throw the value up the stack!
+        raise FunctionReturnWrapper(output)
 
 
 class ExecutionEndStep(Step):
@@ -1631,8 +2728,13 @@ class IncludeStep(Step):
 
         # load the steps no matter
         try:
-            self.steps = LoadScriptFile(filename)
+            steps = None
+            if INCLUDE_PREFETCHER is not None:
+                steps = INCLUDE_PREFETCHER.take(filename)
+            if steps is None:
+                steps = LoadIncludeFile(filename)
         except Exception, e:
+            steps = []
             # if not testing or
             # it's not an IO error
             # or it is not optional - raise the error
@@ -1665,7 +2767,9 @@ class IncludeStep(Step):
             variables["__script_dir__"], variables["__script_filename__"] = \
                 os.path.split(filename)
 
-            self.steps = ExecuteSteps(self.steps, variables, phase)
+            steps = ExecuteSteps(steps, variables, phase)
+            if phase != "test":
+                self.steps = steps
         except Exception, e:
             if phase != "test":
                 raise
@@ -1729,24 +2833,31 @@ class VariableDefinedCheck(Step):
         "Run this step"
 
         self.output = ''
+        self.ret = self.check(variables, phase)
+
+    def validate(self, variables):
+        "Check the variable reference (without storing the result)"
+        self.check(variables, "test")
+
+    def check(self, variables, phase):
+        "Return 0 if the variable is defined, 1 if it is not"
         try:
             key = RenderVariableValue(self.variable, variables, phase)
         except RuntimeError, e:
             if phase != "test":
                 raise
             else:
-                self.ret = 1
-                return
+                return 1
 
         if key.lower() in variables:
             if phase != "test":
                 LOG.debug("Variable is defined: %s : '%s'" %
                     (key, variables[key.lower()]))
-            self.ret = 0
+            return 0
         else:
             if phase != "test":
                 LOG.debug("Variable is not defined: '%s'" % key)
-            self.ret = 1
+            return 1
 
 
 
@@ -1778,10 +2889,91 @@ STATEMENT_HANDLERS = {
     'end': ExecutionEndStep, }
 
 
+# Functions parsed in a thread where this is set are not registered (the
+# steps are registered later when they are used)
+_FUNCTION_REGISTRATION = threading.local()
+
+
+def RegisterFunction(function):
+    "Make the function available to be called"
+    if getattr(_FUNCTION_REGISTRATION, 'deferred', False):
+        return
+    FunctionDefinition.all_functions[function.name.lower()] = function
+
+
+def RegisterFunctions(steps):
+    """Make the functions defined in steps available to be called
+
+    Functions register themselves when they are parsed, this is needed when
+    the steps were created some other way (e.g. loaded from the cache)"""
+    for step in steps:
+        for attr in ('steps', 'if_steps', 'else_steps'):
+            sub_steps = step.__dict__.get(attr)
+            if isinstance(sub_steps, list):
+                RegisterFunctions(sub_steps)
+            elif isinstance(sub_steps, UnparsedSteps):
+                functions = sub_steps.functions
+                if functions is None:
+                    # a block in a block that has been parsed
+                    functions = sub_steps.find_functions()
+                for function in functions:
+                    RegisterFunction(function)
+
+        if isinstance(step, FunctionDefinition):
+            RegisterFunction(step)
+
+
+def ParseBlocks(steps):
+    """Parse the steps of all the blocks in steps (and nested blocks)
+
+    Blocks that cannot be parsed are left to raise the error when they are
+    used"""
+    for step in steps:
+        for attr in ('steps', 'if_steps', 'else_steps'):
+            sub_steps = step.__dict__.get(attr)
+            if isinstance(sub_steps, UnparsedSteps):
+                try:
+                    sub_steps = sub_steps.parse()
+                except Exception:
+                    continue
+                step.__dict__[attr] = sub_steps
+            if isinstance(sub_steps, list):
+                ParseBlocks(sub_steps)
+
+
 def LoadScriptFile(filepath):
     "Load the script file and check that variable references work"
 
-    steps = ParseYAMLFile(filepath)
+    script_text = ReadScriptText(filepath)
+
+    cache_key = scriptcache.CacheKey(filepath, script_text)
+    steps = scriptcache.Load(filepath, cache_key)
+    if steps is not None:
+        LOG.debug("Using cached steps for: '%s'" % filepath)
+        WarnIfTabs(script_text, filepath)
+        RegisterFunctions(steps)
+        return steps
+
+    steps = ParseYAMLText(script_text, filepath)
+
+    if not steps:
+        steps = []
+
+    elif not isinstance(steps, list):
+        raise RuntimeError(
+            "Error parsing script file. Expected list of steps got "
+            "'%s'. file: '%s'" % (type(steps).__name__, filepath))
+
+    else:
+        steps = ParseSteps(steps)
+
+    scriptcache.Store(filepath, cache_key, steps)
+    return steps
+
+
+def ParseScriptChunk(text, filepath):
+    "Parse part of a script file that contains complete top level steps"
+    steps = ParseYAMLText(text, filepath)
 
     if not steps:
         return []
@@ -1794,6 +2986,288 @@ def LoadScriptFile(filepath):
     return ParseSteps(steps)
 
 
+def StreamScriptChunks(filepath, warn_tabs = True):
+    """Yield the text of each top level step of the script file
+
+    Lines before the first step (e.g. comments) are part of the first text"""
+    script = open(filepath, "rb")
+    try:
+        chunk = []
+        open_braces = 0
+        tabs_found = False
+        for line in script:
+            if "\t" in line:
+                if not tabs_found and warn_tabs:
+                    WarnIfTabs(line, filepath)
+                    tabs_found = True
+                line = line.replace("\t", "    ")
+
+            # a new top level step (that is not inside a {{{ }}} section)
+            if (chunk and not open_braces and line.startswith("-") and
+                    line[1:2] in (" ", "\r", "\n", "")):
+                yield "".join(chunk)
+                chunk = []
+
+            chunk.append(line)
+            open_braces += line.count("{{{") - line.count("}}}")
+
+        yield "".join(chunk)
+    finally:
+        script.close()
+
+
+def StreamScriptFile(filepath):
+    """Yield the top level steps of the script file one at a time
+
+    Each top level step is read and parsed only when it is needed, so the
+    whole script never has to be held in memory"""
+    for chunk in StreamScriptChunks(filepath):
+        for step in ParseScriptChunk(chunk, filepath):
+            yield step
+
+
+# a line that could start a function definition
+FUNCTION_DEFINITION_LINE_RE = re.compile(r"^[ \t]*-[ \t]*function\s", re.I | re.M)
+
+
+def RegisterStreamedFunctions(filepath):
+    """Register the functions defined in the script file before streaming it
+
+    Only the top level steps that define functions are parsed - so functions
+    can be called before they are defined, as when the script is not
+    streamed"""
+    for chunk in StreamScriptChunks(filepath, warn_tabs = False):
+        if FUNCTION_DEFINITION_LINE_RE.search(chunk):
+            ParseScriptChunk(chunk, filepath)
+
+
+class PrefetchedInclude(object):
+    "The result of loading an include file in the background"
+
+    def __init__(self, filename, variables):
+        self.filename = filename
+        self.variables = variables
+        self.started = False
+        self.finished = threading.Event()
+        self.steps = None
+        self.exc_info = None
+
+
+class IncludePrefetcher(object):
+    """Load include files in background threads
+
+    Only includes where the filename is known when the script is loaded
+    (no variables, or only command line/environment variables) are loaded.
+    The include step takes the loaded steps when it is executed, any errors
+    loading the file are raised there."""
+
+    num_threads = 4
+
+    # how long stop() waits for a file that is being loaded
+    stop_timeout = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.includes = {}
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.stopped = False
+
+    def prefetch_includes(self, steps, variables):
+        "Start loading the includes in steps that can be found now"
+        for step in steps:
+            if not isinstance(step, IncludeStep) or "{{{" in step.filename:
+                continue
+
+            try:
+                filename = ReplaceVariableReferences(step.filename, variables)
+            except RuntimeError:
+                # it uses variables that are not known yet
+                continue
+
+            filename = os.path.abspath(os.path.join(
+                variables['__script_dir__'], filename))
+            self.prefetch(filename, variables)
+
+    def prefetch(self, filename, variables):
+        "Start loading the file in the background"
+        self.lock.acquire()
+        try:
+            if self.stopped or filename in self.includes:
+                return
+            include = PrefetchedInclude(filename, variables)
+            self.includes[filename] = include
+
+            if len(self.threads) < self.num_threads:
+                thread = threading.Thread(target = self.run_thread)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+        self.queue.put(include)
+
+    def run_thread(self):
+        "Load queued include files until stopped"
+        # the functions are registered when the steps are taken
+        _FUNCTION_REGISTRATION.deferred = True
+        while True:
+            include = self.queue.get()
+            if include is None:
+                break
+            self.load(include)
+
+    def load(self, include):
+        "Load the include file - if it has not been started already"
+        self.lock.acquire()
+        try:
+            if include.started:
+                return
+            include.started = True
+        finally:
+            self.lock.release()
+
+        try:
+            include.steps = LoadIncludeFile(include.filename)
+        except Exception:
+            include.exc_info = sys.exc_info()
+        include.finished.set()
+
+        if include.steps:
+            # includes of the include are relative to the include
+            variables = dict(include.variables)
+            variables['__script_dir__'], variables['__script_filename__'] = \
+                os.path.split(include.filename)
+            self.prefetch_includes(include.steps, variables)
+
+    def take(self, filename):
+        """Return the loaded steps of the file or None if not prefetched
+
+        Errors loading the file are raised. The result can only be taken
+        once as the steps are updated when they are executed"""
+        self.lock.acquire()
+        try:
+            include = self.includes.pop(filename, None)
+        finally:
+            self.lock.release()
+        if include is None:
+            return None
+
+        # load it now if no thread has started it yet
+        self.load(include)
+        include.finished.wait()
+
+        if include.exc_info:
+            raise include.exc_info[0], include.exc_info[1], include.exc_info[2]
+
+        RegisterFunctions(include.steps)
+        return include.steps
+
+    def stop(self):
+        "Stop the background threads (files not started are not loaded)"
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            for include in self.includes.values():
+                include.started = True
+            self.includes = {}
+            threads, self.threads = self.threads, []
+        finally:
+            self.lock.release()
+
+        for thread in threads:
+            self.queue.put(None)
+        # do not leave them running while the interpreter exits
+        parallel.JoinThreads(threads, self.stop_timeout)
+
+
+# the prefetcher for the script being executed (if any)
+INCLUDE_PREFETCHER = None
+
+
+class IncludeCache(object):
+    """Parsed include files for the current run
+
+    Entries are keyed on the absolute path, size and modification time of the
+    file. Steps are updated when they are executed so they are stored
+    pickled, and each hit gets its own copy (which is much quicker than
+    parsing the file again). The first time a file is used again the blocks
+    in it are parsed too, so later hits do not parse them again."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename):
+        "Return the steps of the include file - parsing it only if needed"
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            # let the normal loading raise the (IOError) error
+            return LoadScriptFile(filename)
+        key = (stat.st_size, stat.st_mtime)
+
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+        if entry is not None:
+            LOG.debug("Using already loaded steps for: '%s'" % filename)
+            dummy, pickled, blocks_parsed = entry
+            steps = pickle.loads(pickled)
+            if not blocks_parsed:
+                # the file is used more than once - so parse the blocks
+                # once instead of for each copy
+                ParseBlocks(steps)
+                self.store(filename, key, steps, True)
+            RegisterFunctions(steps)
+            return steps
+
+        steps = LoadScriptFile(filename)
+        self.store(filename, key, steps, False)
+        return steps
+
+    def store(self, filename, key, steps, blocks_parsed):
+        "Keep a pickled copy of the steps"
+        try:
+            pickled = pickle.dumps(steps, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return
+
+        self.lock.acquire()
+        try:
+            self.entries[filename] = (key, pickled, blocks_parsed)
+        finally:
+            self.lock.release()
+
+    def log_stats(self):
+        "Log how often the cache was used"
+        if self.hits or self.misses:
+            LOG.debug("Include cache: %d hits, %d misses" % (
+                self.hits, self.misses))
+
+
+# the include cache for the script being executed (if any)
+INCLUDE_CACHE = None
+
+
+def LoadIncludeFile(filename):
+    "Load an include file - using the include cache if there is one"
+    if INCLUDE_CACHE is not None:
+        return INCLUDE_CACHE.load(filename)
+    return LoadScriptFile(filename)
+
+
 #import cmd
 #class Debugger(cmd.Cmd):
 #    prompt = "{%s} "% os.getcwd()
@@ -1847,21 +3321,354 @@ def LoadScriptFile(filepath):
 #    return steps
 
 
+# Set to True (by Main from --auto-parallel) to run the steps of each block
+# that do not depend on each other at the same time
+AUTO_PARALLEL = False
+
+# How many steps past the oldest unfinished step are looked at for steps that
+# can be started
+AUTO_PARALLEL_LOOKAHEAD = 50
+
+# Built in commands that change the state of the whole process
+PROCESS_STATE_COMMANDS = set([
+    'cd', 'chdir', 'pushdir', 'pushd', 'popdir', 'popd', 'add_tools_dir'])
+
+
+class StepAccess(object):
+    """The variables and resources that a step reads and writes
+
+    A barrier step is run on its own - after all the steps before it have
+    finished and before any of the steps after it are started. A step with
+    all_resources set runs a command that does not say what it uses (with
+    {*reads=...*} and {*writes=...*}) so it could use anything."""
+
+    def __init__(self):
+        self.barrier = False
+        self.variables_read = set()
+        self.variables_written = set()
+        self.resources_read = set()
+        self.resources_written = set()
+        self.all_resources = False
+        # commands are run by the pool, other steps are quick to run
+        self.pooled = False
+
+
+def ResourceQualifier(qualifiers, name):
+    "Return the set of resources in a qualifier like {*reads=a, b*}"
+    value = QualifierValue(qualifiers, name)
+    if not value:
+        return set()
+    return set([
+        resource.strip().lower()
+            for resource in value.split(",") if resource.strip()])
+
+
+def FindStepAccess(step, variables):
+    """Return what the step reads and writes
+
+    The variables read include the variables referenced by the current values
+    of the variables it references. Steps that cannot be checked (e.g. if
+    blocks, function calls) are barriers."""
+    access = StepAccess()
+
+    if isinstance(step, CommandStep):
+        cmd = SplitStatementAndData(step.step_data)[0].lower()
+        if "<" in cmd or cmd in PROCESS_STATE_COMMANDS or \
+                'ui' in step.qualifiers:
+            access.barrier = True
+            return access
+        text = step.step_data
+        qualifiers = step.qualifiers
+        access.variables_read.add('__echo_all_output__')
+        access.variables_written.add('__last_return__')
+        runs_command = True
+    elif isinstance(step, VariableDefinition):
+        if 'delayed' in step.qualifiers:
+            # the variables it uses are only known when it is used
+            access.barrier = True
+            return access
+        text = step.value
+        qualifiers = step.qualifiers
+        access.variables_written.add(step.name)
+        runs_command = "{{{" in text
+    elif isinstance(step, EchoStep):
+        # keep messages in order with the commands
+        text = step.message
+        qualifiers = []
+        access.all_resources = True
+        runs_command = False
+    else:
+        access.barrier = True
+        return access
+
+    # the inputs and outputs of a command are resources too
+    up_to_date_files = [QualifierValue(qualifiers, name) or ""
+        for name in ("inputs", "outputs")]
+
+    to_check = [text] + up_to_date_files
+    while to_check:
+        text = to_check.pop()
+        if VARIABLE_REFERENCE_RE.search(VARIABLE_REFERENCE_RE.sub("", text)):
+            # e.g. <map.<key>> - the variable is only known when it is used
+            access.barrier = True
+            return access
+
+        for name in FindVariableReferences(text):
+            if name in access.variables_read:
+                continue
+            access.variables_read.add(name)
+            value = variables.get(name)
+            if getattr(value, 'delayed', False) and "{{{" in value:
+                # its executable sections are run where it is used - and
+                # what those commands use is not known
+                access.all_resources = True
+            if isinstance(value, basestring) and "<" in value:
+                to_check.append(value)
+
+    access.resources_read = ResourceQualifier(qualifiers, "reads") | \
+        ResourceQualifier(qualifiers, "inputs")
+    access.resources_written = ResourceQualifier(qualifiers, "writes") | \
+        ResourceQualifier(qualifiers, "outputs")
+    if runs_command:
+        access.pooled = True
+        if not access.resources_read and not access.resources_written:
+            access.all_resources = True
+    return access
+
+
+class ScheduledStep(object):
+    "A step of a StepScheduler that has not been committed yet"
+
+    def __init__(self, index, step, access, after):
+        self.index = index
+        self.step = step
+        self.access = access
+        # the index of the last step that has to be committed first
+        self.after = after
+        self.scope = None
+        self.started = False
+        self.done = False
+        # sys.exc_info() of the error raised by the step
+        self.error = None
+
+
+class StepScheduler(object):
+    """Run steps - starting steps that do not depend on earlier steps
+    that are still running
+
+    Each step that runs at the same time as earlier steps uses its own
+    scope. The variables it sets are committed (copied to the variables of
+    the block) in the order of the steps, and a step is only started once the
+    steps that it depends on are committed. So the variables are set in the
+    same order as when running the steps one after the other, and the error
+    raised is the one from the first step that failed."""
+
+    def __init__(self, steps, variables):
+        self.steps = iter(steps)
+        self.variables = variables
+        self.condition = threading.Condition()
+        # the steps that have not been committed yet (in order)
+        self.queue = deque()
+        # all the steps before this index have been committed
+        self.committed = 0
+        self.next_index = 0
+        self.barrier = None
+        self.exhausted = False
+        self.failure = None
+        self._reset_dependencies()
+
+    def _reset_dependencies(self):
+        "Forget the writers of variables and resources (all are committed)"
+        self.variable_writers = {}
+        self.resource_writers = {}
+        self.resource_readers = {}
+        self.last_all_resources = -1
+        self.since_all_resources = []
+
+    def _add(self, step, access):
+        "Add the step and find the steps that it depends on"
+        index = self.next_index
+        self.next_index += 1
+
+        if access.barrier:
+            self.barrier = (index, step)
+            return
+
+        deps = [self.variable_writers.get(name, -1)
+            for name in access.variables_read]
+
+        if access.all_resources:
+            deps.append(self.last_all_resources)
+            deps.extend(self.since_all_resources)
+            self.last_all_resources = index
+            self.since_all_resources = []
+            self.resource_writers = {}
+            self.resource_readers = {}
+        elif access.resources_read or access.resources_written:
+            deps.append(self.last_all_resources)
+            for name in access.resources_read:
+                deps.append(self.resource_writers.get(name, -1))
+                self.resource_readers.setdefault(name, []).append(index)
+            for name in access.resources_written:
+                deps.append(self.resource_writers.get(name, -1))
+                deps.extend(self.resource_readers.pop(name, []))
+                self.resource_writers[name] = index
+            self.since_all_resources.append(index)
+
+        for name in access.variables_written:
+            self.variable_writers[name] = index
+
+        after = max([dep for dep in deps if dep != index] + [-1])
+        self.queue.append(ScheduledStep(index, step, access, after))
+
+    def _pull(self):
+        "Read the next step"
+        try:
+            step = self.steps.next()
+        except StopIteration:
+            self.exhausted = True
+            return
+        self._add(step, FindStepAccess(step, self.variables))
+
+    def _commit(self):
+        "Commit the finished steps that are next in order"
+        self.condition.acquire()
+        try:
+            while self.queue and self.queue[0].done:
+                entry = self.queue.popleft()
+                if entry.scope is not None:
+                    for name, value in entry.scope.changes().items():
+                        if value is _DELETED:
+                            self.variables.pop(name, None)
+                        else:
+                            self.variables[name] = value
+                self.committed = entry.index + 1
+                if entry.error is not None:
+                    self.failure = entry.error
+                    return
+        finally:
+            self.condition.release()
+
+    def _next_ready(self):
+        "Return the first step that can be started (or None)"
+        for entry in self.queue:
+            if not entry.started and entry.after < self.committed:
+                return entry
+        return None
+
+    def _run(self, entry):
+        "Run the step (in this thread or a worker) and mark it as done"
+        try:
+            try:
+                entry.step.execute(entry.scope, "run")
+            except Exception:
+                entry.error = sys.exc_info()
+        finally:
+            self.condition.acquire()
+            try:
+                entry.done = True
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+    def _wait(self):
+        "Wait for one of the running steps to finish"
+        self.condition.acquire()
+        try:
+            while not self.queue[0].done:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def jobs(self):
+        "Yield the jobs that run steps in the pool (as they can be started)"
+        while self.failure is None:
+            self._commit()
+            if self.failure is not None:
+                break
+
+            entry = self._next_ready()
+            if entry is not None:
+                entry.started = True
+                if entry.index == self.committed and not entry.access.pooled:
+                    # nothing else is waiting to be committed
+                    entry.scope = None
+                    self._run_in_variables(entry)
+                    continue
+
+                entry.scope = NewScope(self.variables)
+                if entry.access.pooled:
+                    LOG.debug("Starting step (%d waiting or running): '%s'" % (
+                        len(self.queue), entry.step.raw_step))
+                    yield lambda entry = entry: self._run(entry)
+                else:
+                    self._run(entry)
+                continue
+
+            if self.barrier is None and not self.exhausted and \
+                    len(self.queue) < AUTO_PARALLEL_LOOKAHEAD:
+                try:
+                    self._pull()
+                except Exception:
+                    self.failure = sys.exc_info()
+                continue
+
+            if self.queue:
+                self._wait()
+                continue
+
+            if self.barrier is None:
+                # all the steps have been run
+                break
+
+            # the steps before the barrier have all been committed
+            index, step = self.barrier
+            self.barrier = None
+            try:
+                step.execute(self.variables, "run")
+            except Exception:
+                self.failure = sys.exc_info()
+            self.committed = index + 1
+            self._reset_dependencies()
+
+    def _run_in_variables(self, entry):
+        "Run the step in the variables of the block and commit it"
+        try:
+            entry.step.execute(self.variables, "run")
+        except Exception:
+            entry.error = sys.exc_info()
+        entry.done = True
+
+    def run(self):
+        "Run all the steps - raising the error of the first that fails"
+        errors = parallel.RunJobs(self.jobs())
+        if self.failure is not None:
+            raise self.failure[0], self.failure[1], self.failure[2]
+        if errors:
+            raise ErrorCollection(errors)
+
+
 def ExecuteSteps(steps_, variables, phase):
     "Execute the steps"
 
+    if phase == "run" and AUTO_PARALLEL and \
+            isinstance(variables, VariableStore) and not parallel.InWorker():
+        StepScheduler(steps_, variables).run()
+        return steps_
+
     errors = []
 
-    if phase == "test":
-        steps = copy.deepcopy(steps_)
-    else:
-        steps = steps_
+    # checking does not change the steps, so they do not need to be copied
+    steps = steps_
 
     function_return = None
 
     for step in steps:
         try:
-            step.execute(variables, phase)
+            if phase == "test":
+                step.validate(variables)
+            else:
+                step.execute(variables, phase)
 
         except FunctionReturnWrapper, e:
             # we do not return immediately if we are testing - as we
@@ -1900,7 +3707,7 @@ def PopulateVariables(script_file, cmd_line_vars):
             del cmd_line_vars[var]
             cmd_line_vars[var_lower] = val
 
-    ApplyCommandLineVarsStep.cmd_line_vars = copy.deepcopy(cmd_line_vars)
+    ApplyCommandLineVarsStep.cmd_line_vars = dict(cmd_line_vars)
 
     for key, value in dict(os.environ).items():
         cmd_line_vars["shell." + key.lower()] = value
@@ -1912,7 +3719,7 @@ def PopulateVariables(script_file, cmd_line_vars):
         '__working_dir__': os.path.abspath(os.getcwd()),
         '__logfile__': ''})
 
-    return cmd_line_vars
+    return VariableStore(cmd_line_vars)
 
 
 def ValidateArgumentCounts(steps, count_db):
@@ -2009,35 +3816,100 @@ def ReadParamRestrictions(param_file):
     return counts_db
 
 
-def ExecuteScriptFile(file_path, cmd_vars, check=False):
+def UsageShownForMissingVariables(errs, variables, orig_cmd_vars):
+    """Print the usage if the script failed because of undefined variables
+
+    This is only done if the usage variable is set, there were no variables
+    passed on the command line and at least one error was an undefined
+    variable. Returns True if the usage was printed."""
+    any_undefined_vars = any(
+        [isinstance(e, UndefinedVariableError) for e in errs.errors])
+    if ('usage' in variables and
+        any_undefined_vars and
+        not orig_cmd_vars):
+        LOG.info(
+            ReplaceVariableReferences(
+                variables['usage'],
+                variables,
+                ignore_errors = True))
+        return True
+
+    return False
+
+
+def StreamExecuteScriptFile(file_path, variables, orig_cmd_vars):
+    """Check and execute each top level step as soon as it has been read
+
+    Returns no steps as they are not kept"""
+    arg_counts_db = ReadParamRestrictions(PARAM_FILE)
+
+    RegisterStreamedFunctions(file_path)
+    for step in StreamScriptFile(file_path):
+        variables_copy = NewScope(variables)
+        try:
+            steps = ExecuteSteps([step], variables_copy, "test")
+        except ErrorCollection, errs:
+            if UsageShownForMissingVariables(
+                    errs, variables_copy, orig_cmd_vars):
+                # return empty steps & variables to stop the script
+                return [], {}
+            raise
+
+        ValidateArgumentCounts(steps, arg_counts_db)
+        ExecuteSteps(steps, variables, 'run')
+
+    return [], variables
+
+
+def ExecuteScriptFile(file_path, cmd_vars, check=False, stream=False):
     "Load and execute the script file"
-    orig_cmd_vars = copy.deepcopy(cmd_vars)
+    orig_cmd_vars = dict(cmd_vars)
     variables = PopulateVariables(file_path, cmd_vars)
     LOG.debug("Environment:" % variables)
 
+    global EXEC_SECTION_CACHE
+    EXEC_SECTION_CACHE = ExecSectionCache()
+
+    # when only checking all the steps need to be checked anyway
+    if stream and not check:
+        LOG.debug("STREAMING STEPS")
+        try:
+            return StreamExecuteScriptFile(
+                file_path, variables, orig_cmd_vars)
+        finally:
+            parallel.Shutdown()
+            persistent_shell.CloseAll()
+            pathindex.Save()
+            EXEC_SECTION_CACHE.log_stats()
+
     steps = LoadScriptFile(file_path)
 
+    global INCLUDE_PREFETCHER, INCLUDE_CACHE
+    INCLUDE_CACHE = IncludeCache()
+    INCLUDE_PREFETCHER = IncludePrefetcher()
+    INCLUDE_PREFETCHER.prefetch_includes(steps, NewScope(variables))
+    try:
+        return CheckAndExecuteSteps(steps, variables, orig_cmd_vars, check)
+    finally:
+        parallel.Shutdown()
+        persistent_shell.CloseAll()
+        pathindex.Save()
+        INCLUDE_PREFETCHER.stop()
+        INCLUDE_PREFETCHER = None
+        INCLUDE_CACHE.log_stats()
+        INCLUDE_CACHE = None
+        EXEC_SECTION_CACHE.log_stats()
+
+
+def CheckAndExecuteSteps(steps, variables, orig_cmd_vars, check):
+    "Check and then execute the steps of the script"
     LOG.debug("TESTING STEPS")
 
-    variables_copy = copy.deepcopy(variables)
-    steps_copy = copy.deepcopy(steps)
+    variables_copy = NewScope(variables)
     try:
-        steps = ExecuteSteps(steps_copy, variables_copy, "test")
+        steps = ExecuteSteps(steps, variables_copy, "test")
     except ErrorCollection, errs:
-        # if the following conditions are True
-        #   - usage variable is set
-        #   - there were no variables passed on command line
-        #   - there is at least one
-        any_undefined_vars = any(
-            [isinstance(e, UndefinedVariableError) for e in errs.errors])
-        if ('usage' in variables_copy and
-            any_undefined_vars and
-            not orig_cmd_vars):
-            LOG.info(
-                ReplaceVariableReferences(
-                    variables_copy['usage'],
-                    variables_copy,
-                    ignore_errors = True))
+        if UsageShownForMissingVariables(errs, variables_copy, orig_cmd_vars):
             # return empty steps & variables to stop the script
             return [], {}
         else:
@@ -2105,7 +3977,7 @@ def Main():
 
     start_time = time.time()
 
-    global LOG
+    global LOG, AUTO_PARALLEL
     try:
         options = cmd_line.GetValidatedOptions()
     except RuntimeError, e:
@@ -2121,6 +3993,28 @@ def Main():
         for handler in LOG.handlers:
             handler.setLevel(logging.DEBUG)
 
+    scriptcache.ENABLED = not options.no_cache
+    persisted.ENABLED = not options.no_persist
+    parallel.MAX_JOBS = options.jobs
+    persistent_shell.ENABLED = options.persistent_shell
+    AUTO_PARALLEL = options.auto_parallel
+    if scriptcache.ENABLED:
+        pathindex.CACHE_FILE = os.path.join(
+            scriptcache.CacheDirectory(), pathindex.CACHE_FILE_NAME)
+    else:
+        pathindex.CACHE_FILE = None
+    if options.clear_cache:
+        removed = scriptcache.Clear()
+        LOG.info("Removed %d script(s) from the cache: '%s'" % (
+            removed, scriptcache.CacheDirectory()))
+    if options.clear_persisted:
+        removed = persisted.Clear()
+        LOG.info("Removed %d persisted value(s): '%s'" % (
+            removed, statedb.DatabaseFile()))
+    if (options.clear_cache or options.clear_persisted) and \
+            not options.script_file:
+        return
+
     return_value = 0
     LOG.debug("Run Options:" % options)
     try:
@@ -2130,7 +4024,10 @@ def Main():
                 options.variables)
         else:
             steps, vars = ExecuteScriptFile(
-                options.script_file, options.variables, options.check)
+                options.script_file,
+                options.variables,
+                options.check,
+                options.stream)
             if not steps and not vars:
                 options.timed = False
     except ErrorCollection, e:
@@ -0,0 +1,237 @@
+"""Index of the files in the folders on the PATH
+
+Checking that a command exists used to look for every extension in PATHEXT
+in every folder on the PATH - many file system calls per command (and slow
+when the PATH includes network drives). Instead the file names of each
+folder are listed once and kept with the modification time of the folder.
+The folder is only listed again if its modification time changes (which is
+checked at most every RECHECK_SECONDS - or straight away if a command is not
+found, so commands created by the script are always found).
+
+The index can be kept between runs in CACHE_FILE (set by Main when the
+script cache is enabled).
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import cPickle as pickle
+
+# How long the listing of a folder is used before checking if the folder
+# has changed
+RECHECK_SECONDS = 2
+
+# Folders changed this recently when they are listed could change again
+# without their modification time changing (e.g. 2 seconds on FAT)
+MTIME_RESOLUTION = 2
+
+# File to keep the index in between runs (None to not keep it)
+CACHE_FILE = None
+CACHE_FILE_NAME = "path_index.pickle"
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def CommandExtensions():
+    "Return the extensions tried for commands given without an extension"
+    if sys.platform != "win32":
+        return []
+
+    exts = os.environ.get("PATHEXT", "").split(os.pathsep)
+    # If '.exe' is not in exts then PATHEXT is bogus (same as which.py)
+    if ".exe" not in [ext.lower() for ext in exts]:
+        exts = ['.COM', '.EXE', '.BAT']
+    return exts
+
+
+class PathIndex(object):
+    "The names of the files in folders - listed once and re-used"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # normalized folder -> [folder mtime, set of file names, last checked]
+        self.folders = {}
+        self.changed = False
+
+    def file_names(self, folder, recheck = False):
+        """Return the (normcased) names of the files in the folder
+
+        An empty set is returned if the folder does not exist. If recheck is
+        True then the folder is checked for changes even if it was checked
+        less than RECHECK_SECONDS ago."""
+        key = os.path.normcase(os.path.abspath(folder))
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            entry = self.folders.get(key)
+            if entry is not None and not recheck and \
+                    now - entry[2] < RECHECK_SECONDS:
+                return entry[1]
+
+            try:
+                mtime = os.stat(key).st_mtime
+            except OSError:
+                mtime = None
+
+            if entry is not None and entry[0] == mtime:
+                entry[2] = now
+                return entry[1]
+
+            names = set()
+            if mtime is not None:
+                try:
+                    names = set(
+                        [os.path.normcase(name) for name in os.listdir(key)])
+                except OSError:
+                    pass
+
+            if mtime is not None and now - mtime < MTIME_RESOLUTION:
+                # list it again the next time that it is checked
+                self.folders[key] = [-1, names, now]
+            else:
+                self.folders[key] = [mtime, names, now]
+            self.changed = True
+            return names
+        finally:
+            self.lock.release()
+
+    def find(self, command, paths = None):
+        """Return the full path of the command (None if it is not found)
+
+        Finds the same file as which.which(command, paths): the first folder
+        in paths (the PATH if None) with a file named command (or command +
+        an extension from PATHEXT on Windows) that can be executed."""
+        if os.sep in command or (os.altsep and os.altsep in command):
+            return None
+
+        found = self._search(command, paths, False)
+        if found is None:
+            # a folder may have changed since it was last checked
+            found = self._search(command, paths, True)
+        if found is None and sys.platform == "win32":
+            # applications can also be registered under 'App Paths'
+            from .tools import which
+            registered = which._getRegisteredExecutable(command)
+            if registered is not None:
+                found = registered[0]
+        return found
+
+    def _search(self, command, paths, recheck):
+        "Return the full path of the command in the folders of paths"
+        if paths is None:
+            paths = os.environ.get("PATH", "").split(os.pathsep)
+            if sys.platform == "win32":
+                # implied by the Windows shell
+                paths.insert(0, os.curdir)
+
+        exts = [''] + CommandExtensions()
+        for folder in paths:
+            # On windows the folder could be quoted
+            if sys.platform == "win32" and len(folder) >= 2 and \
+                    folder[0] == '"' and folder[-1] == '"':
+                folder = folder[1:-1]
+
+            names = self.file_names(folder, recheck)
+            for ext in exts:
+                if os.path.normcase(command + ext) not in names:
+                    continue
+
+                full_path = os.path.abspath(
+                    os.path.normpath(os.path.join(folder, command + ext)))
+                if os.path.isfile(full_path) and (
+                        sys.platform == "win32" or
+                        os.access(full_path, os.X_OK)):
+                    return full_path
+        return None
+
+    def load(self, cache_file):
+        "Read the folders stored by save() (problems are ignored)"
+        try:
+            stored = open(cache_file, "rb")
+            try:
+                folders = pickle.load(stored)
+            finally:
+                stored.close()
+        except Exception:
+            return
+
+        self.lock.acquire()
+        try:
+            for key, (mtime, names) in folders.items():
+                if key not in self.folders:
+                    # check the folder the first time it is used
+                    self.folders[key] = [mtime, names, 0]
+        finally:
+            self.lock.release()
+
+    def save(self, cache_file):
+        """Store the folders in the cache file if they have changed
+
+        Returns True if the file was written"""
+        self.lock.acquire()
+        try:
+            if not self.changed:
+                return False
+            folders = dict([
+                (key, (entry[0], entry[1]))
+                    for key, entry in self.folders.items()])
+            self.changed = False
+        finally:
+            self.lock.release()
+
+        cache_dir = os.path.dirname(cache_file)
+        temp_path = None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            handle, temp_path = tempfile.mkstemp(
+                dir = cache_dir, suffix = ".tmp")
+            temp_file = os.fdopen(handle, "wb")
+            try:
+                pickle.dump(folders, temp_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                temp_file.close()
+
+            if sys.platform == "win32" and os.path.exists(cache_file):
+                os.remove(cache_file)
+            os.rename(temp_path, cache_file)
+        except (IOError, OSError, pickle.PicklingError, TypeError):
+            # do not leave the temporary file in the cache folder
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return False
+        return True
+
+
+def Index():
+    "Return the index shared by all the commands of the run"
+    global _INDEX
+    _INDEX_LOCK.acquire()
+    try:
+        if _INDEX is None:
+            _INDEX = PathIndex()
+            if CACHE_FILE:
+                _INDEX.load(CACHE_FILE)
+        return _INDEX
+    finally:
+        _INDEX_LOCK.release()
+
+
+def FindCommand(command, paths = None):
+    "Return the full path of the command (see PathIndex.find())"
+    return Index().find(command, paths)
+
+
+def Save():
+    "Keep the index for the next run (if CACHE_FILE is set)"
+    if CACHE_FILE and _INDEX is not None:
+        _INDEX.save(CACHE_FILE)
@@ -0,0 +1,93 @@
+"""Values of variables that are kept between runs
+
+A variable set with {*persist=TTL*} is only computed (its executable sections
+run) if there is no value stored by an earlier run that has not expired. The
+value is stored in the state database (see statedb) keyed on the text of the
+value after the variables have been replaced, and the values of the
+environment variables listed in {*persist_env=NAME, NAME*}.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import time
+import hashlib
+
+from . import statedb
+
+# Set to False (by Main from --no-persist) to compute all values again (the
+# new values are still stored)
+ENABLED = True
+
+statedb.AddTable(
+    "CREATE TABLE IF NOT EXISTS persisted_values ("
+        "key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+# e.g. 30, 30s, 10m, 12h, 7d
+TTL_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$", re.I)
+
+TTL_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def ParseTimeToLive(text):
+    "Return the seconds for a time like 30s, 10m, 12h or 7d"
+    match = TTL_RE.match(text)
+    if not match:
+        raise RuntimeError(
+            "The time to keep a value must be a number of seconds or a number "
+            "followed by s, m, h or d (e.g. 12h): '%s'" % text)
+    number, unit = match.groups()
+    return float(number) * TTL_UNITS[unit.lower()]
+
+
+def Key(text, environment_names):
+    "Return the key for the value of text"
+    parts = [text]
+    for name in sorted(environment_names):
+        parts.append("%s=%s" % (name, os.environ.get(name, "")))
+    return hashlib.sha1("\0".join(parts)).hexdigest()
+
+
+def Lookup(key):
+    "Return the stored value (None if there is none or it has expired)"
+    if not ENABLED:
+        return None
+    rows = statedb.Query(
+        "SELECT value FROM persisted_values WHERE key = ? AND expires > ?",
+        (key, time.time()))
+    if rows:
+        return rows[0][0]
+    return None
+
+
+def Store(key, value, seconds):
+    "Store the value for the given number of seconds"
+    now = time.time()
+    statedb.Update(
+        "DELETE FROM persisted_values WHERE expires <= ?", (now, ))
+    statedb.Update(
+        "INSERT OR REPLACE INTO persisted_values VALUES (?, ?, ?)",
+        (key, value, now + seconds))
+
+
+def Value(text, environment_names, seconds, compute):
+    """Return the stored value for text - or compute() it and store it
+
+    Returns (value, True if the value was stored by an earlier run)"""
+    key = Key(text, environment_names)
+    value = Lookup(key)
+    if value is not None:
+        return value, True
+
+    value = compute()
+    Store(key, value, seconds)
+    return value, False
+
+
+def Clear():
+    "Remove all the stored values and return how many there were"
+    if not os.path.exists(statedb.DatabaseFile()):
+        return 0
+    count = statedb.Query("SELECT COUNT(*) FROM persisted_values")[0][0]
+    statedb.Update("DELETE FROM persisted_values")
+    return count
@@ -0,0 +1,259 @@
+"""Run external commands in a long lived shell instead of a new one each time
+
+Starting a new shell for every command is most of the time taken by short
+commands. With --persistent-shell each thread that runs commands keeps one
+shell process and writes the commands to it. After each command the shell
+writes a marker line with the return value of the command, so the output of
+each command can be told apart.
+
+Before each command the shell changes to the current directory of
+BetterBatch (so cd/pushd/popd work as usual) and the shell is restarted if
+the environment has changed since it was started. Commands are not given
+any input.
+
+A command cannot change the shell for the commands after it. On posix each
+command is run in a sub shell. cmd.exe ignores setlocal outside of batch
+files, so there the shell is restarted if a command changes its environment
+(e.g. 'set VAR=value' or 'path ...').
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import subprocess
+import threading
+import uuid
+
+# Set to True (by Main from --persistent-shell) to run commands in a
+# persistent shell
+ENABLED = False
+
+_LOCAL = threading.local()
+_SHELLS = []
+_SHELLS_LOCK = threading.Lock()
+
+# Commands that change the state of the shell itself (e.g. stop it) are run
+# in a shell of their own
+SHELL_STATE_COMMAND_RE = re.compile(r"(^|[;&|(])\s*@?(exit|exec)\b", re.I)
+
+
+def _QuotePosix(text):
+    "Return the text quoted as one argument for a posix shell"
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def _CmdCanFrame(command):
+    """Return True if the command can be put in brackets for cmd.exe
+
+    An unclosed quote or a closing bracket that is not quoted would make
+    cmd.exe read the lines after the command as part of it"""
+    in_quotes = False
+    for char in command:
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ")" and not in_quotes:
+            return False
+    return not in_quotes
+
+
+class PersistentShell(object):
+    "A shell process that runs one command after another"
+
+    def __init__(self):
+        self.marker = "__bb_done_%s__" % uuid.uuid4().hex
+        self.environment = dict(os.environ)
+        self.owner = os.getpid()
+
+        if sys.platform == "win32":
+            shell_cmd = [os.environ.get("ComSpec", "cmd.exe"), "/q", "/d"]
+        else:
+            shell_cmd = ["/bin/sh"]
+
+        self.proc = subprocess.Popen(
+            shell_cmd,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT)
+
+        # read past anything the shell writes when it starts (e.g. the
+        # banner of cmd.exe)
+        self._write(self._marker_line())
+        self._read_until_marker(False)
+
+        self.shell_environment = None
+        if sys.platform == "win32":
+            self.shell_environment = self._read_shell_environment()
+
+    def _marker_line(self):
+        "Return the shell text that writes the marker and the return value"
+        if sys.platform == "win32":
+            return "echo.\necho %s %%errorlevel%%\n" % self.marker
+        return "printf '\\n%%s %%d\\n' %s \"$?\"\n" % self.marker
+
+    def _command_text(self, command):
+        "Return the shell text that runs the command in the current dir"
+        if sys.platform == "win32":
+            # the brackets make the redirection apply to all the parts of
+            # a command like 'a & b' (see _CmdCanFrame)
+            return 'cd /d "%s"\n(%s) < nul\n' % (os.getcwd(), command)
+
+        # run the command in a sub shell so that it cannot change the
+        # shell for later commands. It is passed to eval as one quoted
+        # argument so that even a command with a syntax error (e.g. an
+        # unclosed quote) cannot take in the lines after it
+        return "cd %s && (eval %s) < /dev/null\n" % (
+            _QuotePosix(os.getcwd()), _QuotePosix(command))
+
+    def _read_shell_environment(self):
+        "Return the environment of the shell (as listed by 'set')"
+        self._write("set\n" + self._marker_line())
+        return self._read_until_marker(False)[1]
+
+    def _write(self, text):
+        "Send the text to the shell"
+        self.proc.stdin.write(text)
+        self.proc.stdin.flush()
+
+    def _read_until_marker(self, echo):
+        "Return (return value, output) of the command that is running"
+        pipe_fd = self.proc.stdout.fileno()
+        output = []
+        data = ""
+        # the marker (and the new line written before it) could be split
+        # between reads - so keep back enough of the data to find it
+        keep = len(self.marker) + 2
+        while True:
+            chunk = os.read(pipe_fd, 65536)
+            if not chunk:
+                # the shell has exited (e.g. the command was 'exit')
+                self.close()
+                output.append(data)
+                if echo:
+                    sys.stdout.write(data)
+                return self.proc.returncode, "".join(output)
+            data += chunk
+
+            marker_pos = data.find(self.marker)
+            if marker_pos == -1:
+                if len(data) > keep:
+                    if echo:
+                        sys.stdout.write(data[:-keep])
+                    output.append(data[:-keep])
+                    data = data[-keep:]
+                continue
+
+            line_end = data.find("\n", marker_pos)
+            if line_end != -1:
+                break
+
+        ret = int(data[marker_pos + len(self.marker):line_end].strip())
+
+        # remove the new line that is written before the marker
+        text = data[:marker_pos]
+        if text.endswith("\r\n"):
+            text = text[:-2]
+        elif text.endswith("\n"):
+            text = text[:-1]
+        if echo:
+            sys.stdout.write(text)
+        output.append(text)
+        return ret, "".join(output)
+
+    def is_usable(self):
+        "Return True if the shell can run the next command"
+        return (
+            self.proc.returncode is None and
+            self.owner == os.getpid() and
+            self.environment == dict(os.environ))
+
+    def run(self, command, echo = False):
+        """Run the command and return (return value, output)
+
+        stderr is included in the output. If echo is True the output is also
+        written to stdout as it is read."""
+        try:
+            self._write(self._command_text(command) + self._marker_line())
+            ret, output = self._read_until_marker(echo)
+
+            # the command ran in the shell itself (there is no sub shell
+            # like on posix) - so do not keep any changes it made
+            if self.shell_environment is not None and \
+                    self.proc.returncode is None and \
+                    self._read_shell_environment() != self.shell_environment:
+                self.close()
+            return ret, output
+        except:
+            # the shell may be part way through the command
+            self.close()
+            raise
+
+    def close(self):
+        "Stop the shell"
+        if self.proc.returncode is not None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.poll() is None:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+def ThreadShell():
+    "Return the shell of the current thread (started if needed)"
+    shell = getattr(_LOCAL, "shell", None)
+    if shell is not None and not shell.is_usable():
+        if shell.owner == os.getpid():
+            shell.close()
+        shell = None
+
+    if shell is None:
+        shell = PersistentShell()
+        _LOCAL.shell = shell
+        _SHELLS_LOCK.acquire()
+        try:
+            _SHELLS.append(shell)
+        finally:
+            _SHELLS_LOCK.release()
+    return shell
+
+
+def CanRun(command, qualifiers):
+    """Return True if the command can be run in the persistent shell
+
+    Commands over several lines, interactive (ui) commands, commands that
+    change the shell itself (e.g. exit) and commands that cannot be safely
+    separated from the next command get their own shell. {*noshell*}
+    commands are run without a shell."""
+    if not ENABLED or "\n" in command:
+        return False
+    if 'ui' in qualifiers or 'noshell' in qualifiers:
+        return False
+    if SHELL_STATE_COMMAND_RE.search(command):
+        return False
+    if sys.platform == "win32" and not _CmdCanFrame(command):
+        return False
+    return True
+
+
+def RunCommand(command, echo = False):
+    "Run the command in the shell of the current thread"
+    return ThreadShell().run(command, echo)
+
+
+def CloseAll():
+    "Stop all the shells started by this process"
+    _SHELLS_LOCK.acquire()
+    try:
+        for shell in _SHELLS:
+            if shell.owner == os.getpid():
+                shell.close()
+        del _SHELLS[:]
+    finally:
+        _SHELLS_LOCK.release()
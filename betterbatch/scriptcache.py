@@ -0,0 +1,208 @@
+"""Persistent cache of parsed script files
+
+Loading a script means reading it, pre-processing the text, parsing the YAML
+and building all the Step objects. Scripts are very often run again without
+having been changed - so the parsed steps are pickled to a cache folder and
+re-used by later runs.
+
+An entry is keyed on the script path, size, modification time and a hash of
+the contents as well as the BetterBatch version (and the code that produced
+the steps), so a stale entry is never used. Several versions of the same
+script can be held at the same time (e.g. when switching between branches).
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import glob
+import tempfile
+import hashlib
+import cPickle as pickle
+
+from . import __version__
+
+# Set to True (by Main) to use the cache
+ENABLED = False
+
+# Folder to store the cache in, if None then a per user default is used
+# (can also be overridden with the BETTERBATCH_CACHE_DIR environment variable)
+CACHE_DIR = None
+
+# Number of different versions of the same script to keep
+MAX_VERSIONS_PER_SCRIPT = 5
+
+CACHE_FILE_EXT = ".bbcache"
+
+_CODE_STAMP = None
+
+
+def CacheDirectory():
+    "Return the folder where cached scripts are stored"
+    if CACHE_DIR:
+        return CACHE_DIR
+
+    if os.environ.get("BETTERBATCH_CACHE_DIR"):
+        return os.environ["BETTERBATCH_CACHE_DIR"]
+
+    app_data = os.environ.get("LOCALAPPDATA", os.environ.get("APPDATA"))
+    if app_data:
+        return os.path.join(app_data, "BetterBatch", "cache")
+
+    return os.path.join(os.path.expanduser("~"), ".betterbatch", "cache")
+
+
+def CodeStamp():
+    """Return a string identifying the BetterBatch code that parsed the script
+
+    Pickled steps are only valid for the code that created them, so as well as
+    the version the size and modification time of the modules are used.
+    """
+    global _CODE_STAMP
+    if _CODE_STAMP is None:
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        stamp = [__version__]
+        for module in sorted(glob.glob(os.path.join(package_dir, "*.py"))):
+            stat = os.stat(module)
+            stamp.append("%s:%d:%d" % (
+                os.path.basename(module), stat.st_size, int(stat.st_mtime)))
+        _CODE_STAMP = ";".join(stamp)
+    return _CODE_STAMP
+
+
+def NormalizedPath(filepath):
+    "Return the path in a form that can be compared to other paths"
+    return os.path.normcase(os.path.abspath(filepath))
+
+
+def CacheKey(filepath, script_text):
+    """Return the key for this version of the script
+
+    returns None if the cache is not enabled"""
+    if not ENABLED:
+        return None
+
+    stat = os.stat(filepath)
+    return hashlib.sha1("\n".join((
+        NormalizedPath(filepath),
+        str(stat.st_size),
+        repr(stat.st_mtime),
+        hashlib.sha1(script_text).hexdigest(),
+        CodeStamp()))).hexdigest()
+
+
+def _ScriptPrefix(filepath):
+    "Return the file name prefix shared by all entries of a script"
+    return hashlib.sha1(NormalizedPath(filepath)).hexdigest()[:16]
+
+
+def _EntryPath(filepath, key):
+    "Return the path of the cache file for the key"
+    return os.path.join(
+        CacheDirectory(),
+        "%s-%s%s" % (_ScriptPrefix(filepath), key[:24], CACHE_FILE_EXT))
+
+
+def Load(filepath, key):
+    """Return the cached steps for the script or None if not in the cache
+
+    Any problem reading the entry is treated as a cache miss"""
+    if not ENABLED or key is None:
+        return None
+
+    try:
+        cache_file = open(_EntryPath(filepath, key), "rb")
+        try:
+            stored_key, steps = pickle.load(cache_file)
+        finally:
+            cache_file.close()
+    except Exception:
+        return None
+
+    if stored_key != key:
+        return None
+    return steps
+
+
+def Store(filepath, key, steps):
+    """Store the parsed steps for the script
+
+    The entry is written to a temporary file first and then renamed so that
+    other processes never see a partially written entry. Returns True if the
+    entry was stored"""
+    if not ENABLED or key is None:
+        return False
+
+    cache_dir = CacheDirectory()
+    temp_path = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        handle, temp_path = tempfile.mkstemp(dir = cache_dir, suffix = ".tmp")
+        temp_file = os.fdopen(handle, "wb")
+        try:
+            pickle.dump((key, steps), temp_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            temp_file.close()
+    except (IOError, OSError, pickle.PicklingError, TypeError):
+        # e.g. a step that cannot be pickled - Clear() does not remove the
+        # temporary files
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return False
+
+    entry_path = _EntryPath(filepath, key)
+    try:
+        if sys.platform == "win32" and os.path.exists(entry_path):
+            # another process already stored the same entry
+            os.remove(temp_path)
+        else:
+            os.rename(temp_path, entry_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+    _PruneVersions(filepath)
+    return True
+
+
+def _PruneVersions(filepath):
+    "Remove the oldest entries of the script if there are too many"
+    entries = glob.glob(os.path.join(
+        CacheDirectory(), _ScriptPrefix(filepath) + "-*" + CACHE_FILE_EXT))
+    if len(entries) <= MAX_VERSIONS_PER_SCRIPT:
+        return
+
+    by_age = []
+    for entry in entries:
+        try:
+            by_age.append((os.path.getmtime(entry), entry))
+        except OSError:
+            # removed by another process
+            pass
+    by_age.sort()
+
+    for mtime, entry in by_age[:-MAX_VERSIONS_PER_SCRIPT]:
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+
+def Clear():
+    "Remove all the entries from the cache - returns the number removed"
+    removed = 0
+    cache_dir = CacheDirectory()
+    for entry in glob.glob(os.path.join(cache_dir, "*" + CACHE_FILE_EXT)):
+        try:
+            os.remove(entry)
+            removed += 1
+        except OSError:
+            pass
+    return removed
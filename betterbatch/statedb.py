@@ -0,0 +1,128 @@
+"""Small database of state that is kept between runs
+
+Some qualifiers need to remember things from earlier runs (e.g. the hashes
+of the input files of a command). That is stored in an SQLite database in the
+cache folder. The database can be used by several threads and processes
+(e.g. parallel steps) at the same time.
+"""
+from __future__ import absolute_import
+
+import os
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    # Python 2.4 or a Python built without SQLite
+    sqlite3 = None
+
+from . import scriptcache
+
+# The database file, if None then state.sqlite in the cache folder is used
+DATABASE_FILE = None
+
+# How long to wait for another process that is writing to the database
+TIMEOUT_SECONDS = 30
+
+# The statements that create the tables (added by the modules that use them)
+TABLES = []
+
+_CONNECTION = None
+_CONNECTION_KEY = None
+_LOCK = threading.RLock()
+
+
+def DatabaseFile():
+    "Return the path of the database"
+    if DATABASE_FILE:
+        return DATABASE_FILE
+    return os.path.join(scriptcache.CacheDirectory(), "state.sqlite")
+
+
+def AddTable(create_statement):
+    "Add a table that is created when the database is opened"
+    if create_statement not in TABLES:
+        TABLES.append(create_statement)
+
+
+def _CheckAvailable():
+    "Raise an error if SQLite is not available"
+    if sqlite3 is None:
+        raise RuntimeError(
+            "The state database needs the sqlite3 module which is not "
+            "available in this Python")
+
+
+def _Connection():
+    "Return the connection of this process (lock held)"
+    global _CONNECTION, _CONNECTION_KEY
+    path = DatabaseFile()
+    key = (path, os.getpid(), len(TABLES))
+    if _CONNECTION is not None and _CONNECTION_KEY == key:
+        return _CONNECTION
+
+    Close()
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    connection = sqlite3.connect(
+        path, timeout = TIMEOUT_SECONDS, check_same_thread = False)
+    # the values are mostly paths - so keep them as byte strings
+    connection.text_factory = str
+    for statement in TABLES:
+        connection.execute(statement)
+    connection.commit()
+
+    _CONNECTION = connection
+    _CONNECTION_KEY = key
+    return connection
+
+
+def Query(statement, parameters = ()):
+    "Return the rows selected by the statement"
+    _CheckAvailable()
+    _LOCK.acquire()
+    try:
+        try:
+            return _Connection().execute(statement, parameters).fetchall()
+        except sqlite3.Error, e:
+            raise RuntimeError(
+                "Could not read the state database '%s': %s" % (
+                    DatabaseFile(), e))
+    finally:
+        _LOCK.release()
+
+
+def Update(statement, parameters = ()):
+    "Run the statement that changes the database and commit it"
+    _CheckAvailable()
+    _LOCK.acquire()
+    try:
+        try:
+            connection = _Connection()
+            try:
+                connection.execute(statement, parameters)
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+        except sqlite3.Error, e:
+            raise RuntimeError(
+                "Could not update the state database '%s': %s" % (
+                    DatabaseFile(), e))
+    finally:
+        _LOCK.release()
+
+
+def Close():
+    "Close the connection (it is opened again when needed)"
+    global _CONNECTION, _CONNECTION_KEY
+    _LOCK.acquire()
+    try:
+        if _CONNECTION is not None and _CONNECTION_KEY[1] == os.getpid():
+            _CONNECTION.close()
+        _CONNECTION = None
+        _CONNECTION_KEY = None
+    finally:
+        _LOCK.release()
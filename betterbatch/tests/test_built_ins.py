@@ -3,6 +3,9 @@ from __future__ import absolute_import
 import unittest
 import os
 import sys
+import shutil
+import subprocess
+import tempfile
 
 TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
 TEST_FILES_PATH = os.path.join(TESTS_DIR, "test_files")
@@ -83,11 +86,171 @@ class BuiltInCommandsTests(unittest.TestCase):
     def test_SystemCommand_echo_nocapture(self):
         SystemCommand("echo here",  ['echo', 'nocapture'])
 
+    def test_SystemCommand_output(self):
+        ret, out = SystemCommand("echo here", [])
+        self.assertEquals(ret, 0)
+        self.assertEquals(out.strip(), "here")
+
+    def test_SystemCommand_nocapture_output(self):
+        self.assertEquals(
+            SystemCommand("echo here",  ['nocapture']), (0, ""))
+
+    def test_SystemCommand_stderr_captured(self):
+        ret, out = SystemCommand("echo here 1>&2", [])
+        self.assertEquals(out.strip(), "here")
+
+    def test_SystemCommand_return_code(self):
+        ret, out = SystemCommand("exit 3", [])
+        self.assertEquals(ret, 3)
+
+    def test_NeedsShell(self):
+        self.assertEquals(NeedsShell("tool.exe arg1 arg2"), False)
+        self.assertEquals(NeedsShell('"c:\\a b\\tool.exe" "arg 1"'), False)
+        self.assertEquals(NeedsShell("tool.exe --opt=value"), False)
+        self.assertEquals(NeedsShell("tool.exe > out.txt"), True)
+        self.assertEquals(NeedsShell("tool.exe < in.txt"), True)
+        self.assertEquals(NeedsShell("tool.exe | more"), True)
+        self.assertEquals(NeedsShell("tool.exe && other.exe"), True)
+        self.assertEquals(NeedsShell("tool.exe %path%"), True)
+        self.assertEquals(NeedsShell("tool.exe *.txt"), True)
+        self.assertEquals(NeedsShell("dir c:\\"), True)
+        self.assertEquals(NeedsShell('"copy" a b'), True)
+        self.assertEquals(NeedsShell("VAR=1 tool.exe"), True)
+        self.assertEquals(NeedsShell('tool.exe "not closed'), True)
+
+    def test_NeedsShell_qualifiers(self):
+        self.assertEquals(NeedsShell("tool.exe arg", ['shell']), True)
+        self.assertEquals(NeedsShell("tool.exe > out.txt", ['noshell']), False)
+
+    def test_SystemCommand_noshell(self):
+        ret, out = SystemCommand(
+            '"%s" -c "import sys; print sys.argv[1:]" "a b" c' %
+                sys.executable, ['noshell'])
+        self.assertEquals(ret, 0)
+        self.assertEquals(out.strip(), "['a b', 'c']")
+
+    def test_SystemCommand_noshell_not_found(self):
+        self.assertRaises(
+            RuntimeError,
+            SystemCommand,
+            "not_a_real_command_here", ['noshell'])
+
+    def test_SystemCommand_runs_program_found(self):
+        if sys.platform == "win32":
+            name, text = "bb_path_test.bat", "@echo %s\r\n"
+        else:
+            name, text = "bb_path_test", "#!/bin/sh\necho %s\n"
+
+        folders = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        for folder, output in zip(folders, ["first", "second"]):
+            path = os.path.join(folder, name)
+            open(path, "w").write(text % output)
+            os.chmod(path, 0755)
+
+        executables = []
+        orig_popen = subprocess.Popen
+        def Popen(*args, **kwargs):
+            executables.append(kwargs.get('executable'))
+            return orig_popen(*args, **kwargs)
+
+        prev_path = os.environ['PATH']
+        subprocess.Popen = Popen
+        try:
+            os.environ['PATH'] = os.pathsep.join(folders + [prev_path])
+            ret, out = SystemCommand("bb_path_test")
+        finally:
+            subprocess.Popen = orig_popen
+            os.environ['PATH'] = prev_path
+            for folder in folders:
+                shutil.rmtree(folder)
+
+        # the program in the first folder of the PATH is run
+        self.assertEquals(executables[0], os.path.join(folders[0], name))
+        self.assertEquals((ret, out.strip()), (0, "first"))
+
+    def test_SystemCommand_not_found_uses_shell(self):
+        # the shell reports that the command could not be found
+        ret, out = SystemCommand("not_a_real_command_here", [])
+        self.assertNotEquals(ret, 0)
+        self.assertNotEquals(out, "")
+
+    def test_SystemCommand_large_output(self):
+        # more output than fits in the pipe buffer
+        ret, out = SystemCommand(
+            '"%s" -c "print \'x\' * 200000"' % sys.executable, [])
+        self.assertEquals(ret, 0)
+        self.assertEquals(out.strip(), "x" * 200000)
+
     def test_SystemCommand_no_too_long(self):
         self.assertRaises(
             RuntimeError,
             SystemCommand,
-                "echo here" + "888" * 4000, [])
+                "echo here" + "8" * CommandLengthLimit(True), [])
+
+    def test_SystemCommand_long_without_shell(self):
+        # too long for the shell - but not for running it directly
+        num_args = CommandLengthLimit(True) / 3 + 1
+        ret, out = SystemCommand(
+            '"%s" -c "print 1" ' % sys.executable + "ab " * num_args, [])
+        self.assertEquals((ret, out.strip()), (0, "1"))
+
+    def test_EnvironmentSize(self):
+        size = EnvironmentSize()
+        environment = built_in_commands._ENVIRONMENT_SIZE[0]
+        self.assertEquals(EnvironmentSize(), size)
+        # not measured again while the environment is the same
+        self.assertEquals(
+            built_in_commands._ENVIRONMENT_SIZE[0] is environment, True)
+
+        os.environ['BB_TEST_ENV_SIZE'] = "x" * 100
+        try:
+            self.assertEquals(EnvironmentSize() > size + 100, True)
+        finally:
+            del os.environ['BB_TEST_ENV_SIZE']
+        self.assertEquals(EnvironmentSize(), size)
+
+    def test_CheckCommandLength(self):
+        self.assertEquals(CheckCommandLength("tool.exe arg"), None)
+
+        num_args = CommandLengthLimit(True) / 2 + 1
+        self.assertEquals(
+            CheckCommandLength("tool.exe " + "a " * num_args), "noshell")
+        self.assertRaises(
+            RuntimeError,
+            CheckCommandLength, "tool.exe " + "a " * num_args, ['shell'])
+
+        num_args = CommandLengthLimit(False) / 3 + 1
+        command = "tool.exe " + "ab " * num_args
+        self.assertRaises(RuntimeError, CheckCommandLength, command)
+        self.assertEquals(
+            CheckCommandLength(command, ['responsefile']), "responsefile")
+
+    def test_ResponseFileCommand(self):
+        command, path = ResponseFileCommand(
+            '"c:\\a b\\tool.exe" arg1 "arg 2"')
+        try:
+            self.assertEquals(
+                command.startswith('"c:\\a b\\tool.exe" '), True)
+            self.assertEquals(command.endswith(path + '"') or
+                command.endswith("@" + path), True)
+            self.assertEquals(open(path).read(), 'arg1 "arg 2"')
+        finally:
+            os.remove(path)
+
+    def test_FitCommand(self):
+        self.assertEquals(
+            FitCommand("tool.exe arg", ['nocheck']),
+            ("tool.exe arg", ['nocheck'], None))
+
+        num_args = CommandLengthLimit(False) / 3 + 1
+        command, qualifiers, path = FitCommand(
+            "tool.exe " + "ab " * num_args, ['responsefile'])
+        try:
+            self.assertEquals(command.startswith("tool.exe "), True)
+            self.assertEquals(qualifiers, ['responsefile', 'noshell'])
+            self.assertEquals(open(path).read().split(), ["ab"] * num_args)
+        finally:
+            os.remove(path)
 
     def test_SystemCommand_with_spaces(self):
         if 'ProgramFiles(x86)' in os.environ:
@@ -431,6 +594,139 @@ class BuiltInCommandsTests(unittest.TestCase):
                 "here", ['f', 'b', 'require'])
 
 
+class StreamedCommandTests(unittest.TestCase):
+    "Unit tests for reading the output of a command while it runs"
+
+    def command(self, code):
+        return '"%s" -c "%s"' % (sys.executable, code)
+
+    def test_lines(self):
+        cmd = StreamedCommand(self.command(
+            "import sys; print 'a'; print; sys.stderr.write('b\\n')"))
+        self.assertEquals(cmd.returncode, None)
+        self.assertEquals(list(cmd), ['a', '', 'b'])
+        self.assertEquals(cmd.returncode, 0)
+
+    def test_returncode(self):
+        cmd = StreamedCommand(self.command("import sys; sys.exit(3)"))
+        self.assertEquals(list(cmd), [])
+        self.assertEquals(cmd.returncode, 3)
+
+    def test_lines_before_finished(self):
+        # the command does not finish until it has been stopped
+        cmd = StreamedCommand(self.command(
+            "import sys, time; print 'a'; sys.stdout.flush(); time.sleep(30)"))
+        lines = iter(cmd)
+        self.assertEquals(lines.next(), 'a')
+        lines.close()
+        self.assertEquals(cmd.returncode, None)
+
+    def test_too_long(self):
+        self.assertRaises(
+            RuntimeError,
+            StreamedCommand, "echo " + "x" * CommandLengthLimit(True))
+
+
+class InProcessToolTests(unittest.TestCase):
+    "Unit tests for running the bundled tools in this process"
+
+    def setUp(self):
+        self.ini_file = os.path.join(TEST_FILES_PATH, "get_config_option.ini")
+
+    def test_bundled_tools(self):
+        for name in IN_PROCESS_TOOLS:
+            tool = built_in_commands.NAME_ACTION_MAPPING[name]
+            self.assertEquals(isinstance(tool, InProcessTool), True)
+
+    def test_other_tools(self):
+        import tempfile
+        import shutil
+        tools_dir = tempfile.mkdtemp()
+        try:
+            tool_path = os.path.join(tools_dir, "other_tool.py")
+            open(tool_path, "w").close()
+            PopulateFromToolsFolder(tools_dir)
+            tool = built_in_commands.NAME_ACTION_MAPPING['other_tool']
+            self.assertEquals(type(tool), ExternalCommand)
+        finally:
+            del built_in_commands.NAME_ACTION_MAPPING['other_tool']
+            shutil.rmtree(tools_dir)
+
+    def test_get_ini_option(self):
+        tool = built_in_commands.NAME_ACTION_MAPPING['get_ini_option']
+        self.assertEquals(
+            tool('"%s" 16.0.56b.200 acad_build' % self.ini_file),
+            (0, "F051" + os.linesep))
+        ret, out = tool('"%s" 16.0.56b.200 missing' % self.ini_file)
+        self.assertNotEquals(ret, 0)
+        self.assertEquals(
+            tool('"%s" 16.0.56b.200 missing default' % self.ini_file),
+            (0, "default" + os.linesep))
+
+    def test_nocapture(self):
+        tool = built_in_commands.NAME_ACTION_MAPPING['get_ini_option']
+        self.assertEquals(
+            tool('"%s" 16.0.56b.200 acad_build' % self.ini_file,
+                ['nocapture']),
+            (0, ""))
+
+    def test_usage_error(self):
+        # optparse exits with 2 and writes to stderr
+        tool = built_in_commands.NAME_ACTION_MAPPING['find_in_file']
+        ret, out = tool("--not-an-option")
+        self.assertEquals(ret, 2)
+        self.assertEquals("no such option" in out, True)
+
+    def test_SplitArguments(self):
+        self.assertEquals(
+            SplitArguments('a "b c" d'), ['a', 'b c', 'd'])
+
+    def test_RunToolInProcess(self):
+        def Tool(argv):
+            print "args:", argv
+            print >> sys.stderr, "error"
+            return 3
+        self.assertEquals(
+            RunToolInProcess(Tool, ["a", "b"]),
+            (3, "args: ['a', 'b']\nerror\n".replace("\n", os.linesep)))
+
+    def test_RunToolInProcess_exit(self):
+        def Exit(argv):
+            sys.exit(argv[0])
+        self.assertEquals(RunToolInProcess(Exit, [None]), (0, ""))
+        self.assertEquals(RunToolInProcess(Exit, [4]), (4, ""))
+        self.assertEquals(
+            RunToolInProcess(Exit, ["failed"]), (1, "failed" + os.linesep))
+
+    def test_RunToolInProcess_exception(self):
+        def Fail(argv):
+            raise ValueError("bad value")
+        ret, out = RunToolInProcess(Fail, [])
+        self.assertEquals(ret, 1)
+        self.assertEquals(out.startswith("Traceback"), True)
+        self.assertEquals(out.strip().endswith("ValueError: bad value"), True)
+
+    def test_RunToolInProcess_threads(self):
+        import threading
+        import time
+        results = {}
+        def Tool(argv):
+            for i in range(20):
+                print argv[0]
+                time.sleep(.001)
+        def Run(name):
+            results[name] = RunToolInProcess(Tool, [name])[1].split()
+
+        threads = [
+            threading.Thread(target = Run, args = (name,))
+                for name in ("a", "b", "c")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name in ("a", "b", "c"):
+            self.assertEquals(results[name], [name] * 20)
 
 
 if __name__ == "__main__":
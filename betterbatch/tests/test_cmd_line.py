@@ -105,6 +105,58 @@ class CommandLineTests(unittest.TestCase):
         self.assertEquals(options.colored_output, False)
         self.assertEquals(options.no_color, True)
 
+    def test_clear_cache_without_script(self):
+        """"""
+        sys.argv = ["prog.py", "--clear-cache"]
+        options = GetValidatedOptions()
+
+        self.assertEquals(options.clear_cache, True)
+        self.assertEquals(options.script_file, None)
+        self.assertEquals(options.variables, {})
+
+    def test_persist_options(self):
+        """"""
+        sys.argv = [
+            "prog.py", os.path.join(TEST_FILES_PATH, "commands.bb")]
+        options = GetValidatedOptions()
+        self.assertEquals(options.no_persist, False)
+        self.assertEquals(options.clear_persisted, False)
+
+        sys.argv = ["prog.py", "--clear-persisted", "--no-persist"]
+        options = GetValidatedOptions()
+        self.assertEquals(options.no_persist, True)
+        self.assertEquals(options.clear_persisted, True)
+        self.assertEquals(options.script_file, None)
+
+    def test_jobs(self):
+        """"""
+        sys.argv = [
+            "prog.py", os.path.join(TEST_FILES_PATH, "commands.bb")]
+        self.assertEquals(GetValidatedOptions().jobs, None)
+
+        sys.argv.append("--jobs=3")
+        self.assertEquals(GetValidatedOptions().jobs, 3)
+
+        sys.argv[-1] = "--jobs=0"
+        self.assertRaises(SystemExit, GetValidatedOptions)
+
+    def test_persistent_shell(self):
+        """"""
+        sys.argv = [
+            "prog.py", os.path.join(TEST_FILES_PATH, "commands.bb")]
+        self.assertEquals(GetValidatedOptions().persistent_shell, False)
+
+        sys.argv.append("--persistent-shell")
+        self.assertEquals(GetValidatedOptions().persistent_shell, True)
+
+    def test_auto_parallel(self):
+        """"""
+        sys.argv = [
+            "prog.py", os.path.join(TEST_FILES_PATH, "commands.bb")]
+        self.assertEquals(GetValidatedOptions().auto_parallel, False)
+
+        sys.argv.append("--auto-parallel")
+        self.assertEquals(GetValidatedOptions().auto_parallel, True)
 
     def test_different_platforms(self):
         """"""
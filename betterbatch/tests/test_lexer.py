@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import glob
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+TEST_FILES_PATH = os.path.join(TESTS_DIR, "test_files")
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import lexer
+from betterbatch.lexer import *
+from betterbatch import parsescript
+parsescript.LOG = parsescript.ConfigLogging()
+
+
+def ParseWithYAML(text):
+    "Return the result (or the error) of the YAML parser for text"
+    try:
+        return parsescript.ParseYAMLTextWithYAML(text, "test.bb")
+    except RuntimeError, e:
+        return type(e)
+
+
+def ParseWithLexer(text):
+    "Return the result (or the error) of the lexer for text"
+    try:
+        return ParseScriptText(text)
+    except RuntimeError, e:
+        return type(e)
+
+
+class LexerTests(unittest.TestCase):
+    "Unit tests for the script lexer"
+
+    def assertSameAsYAML(self, text):
+        self.assertEquals(ParseWithLexer(text), ParseWithYAML(text))
+
+    def test_test_files(self):
+        for script in glob.glob(os.path.join(TEST_FILES_PATH, "*.bb")):
+            text = open(script, "rb").read().replace("\t", "    ")
+            if text.count("{{{") != text.count("}}}"):
+                continue
+            try:
+                ParseScriptText(text)
+            except UnsupportedSyntax:
+                continue
+
+            self.assertSameAsYAML(text)
+
+    def test_simple_steps(self):
+        self.assertSameAsYAML(
+            "- set x = 1\n"
+            "- dir c:\\ /b  \n"
+            '- copy "a b.txt" c:\\temp\n'
+            "- set time = 12:30\n")
+
+    def test_crlf(self):
+        self.assertSameAsYAML("- set x = 1\r\n- set y = a:b\r\n")
+
+    def test_no_final_newline(self):
+        self.assertSameAsYAML("- set x = 1\n- echo <x>")
+
+    def test_comments(self):
+        self.assertSameAsYAML(
+            "# a comment\n"
+            "- set x = 1 # trailing comment\n"
+            "    # indented comment\n"
+            "- set y = 2#not a comment\n"
+            "- set z = a: # not a key\n")
+
+    def test_preformatted(self):
+        self.assertSameAsYAML(
+            "- echo x: y # not a comment  \n"
+            "- set usage = script.bb file:\n"
+            "\n"
+            "- end 1, failed:\n")
+
+    def test_nested(self):
+        self.assertSameAsYAML(
+            "- if exists <x>:\n"
+            "    - echo yes\n"
+            "    - if defined y:\n"
+            "        - set z = 1\n"
+            "  else:\n"
+            "  - echo no\n"
+            "- for f in <files>:\n"
+            "    - parallel:\n"
+            "        - copy <f> c:\\temp\n"
+            "- function func(a, b=2):\n"
+            "    - return <a>\n")
+
+    def test_multi_line_steps(self):
+        self.assertSameAsYAML(
+            "- set x = {{{exec dir\r\n"
+            "    /b}}}\r\n"
+            "- set y = a long\n"
+            "    value\n"
+            "\n"
+            "    split over lines\n"
+            "- echo {{{exec\n"
+            " dir}}}\n")
+
+    def test_empty(self):
+        self.assertEquals(ParseScriptText(""), None)
+        self.assertEquals(ParseScriptText("# just a comment\n\n"), None)
+
+    def test_unsupported(self):
+        for text in (
+                "- 123\n",
+                "- yes\n",
+                "- echo\n- set x = 1\n",
+                "- end\n",
+                "- |\n    text\n",
+                "- >\n    text\n",
+                "- 'quoted'\n",
+                "- [a, b]\n",
+                "- {{{exec x}}}\n",
+                "- - nested\n",
+                "-\n  value\n",
+                "---\n- x\n",
+                "- x\n  # comment\n  y\n",
+                "- echo hi\n      continued\n",
+                "- set x = {{{exec a:\n b}}}\n",
+                "- set x = caf\xc3\xa9\n",
+                "- x +++++colon+++++\n",
+                "- a\rb\n",
+                ):
+            self.assertRaises(UnsupportedSyntax, ParseScriptText, text)
+
+    def test_parse_errors(self):
+        for text in (
+                "- if x:\n    - a\n   - b\n",
+                "- a\n b:\n",
+                ):
+            self.assertRaises(RuntimeError, parsescript.ParseYAMLText,
+                text, "test.bb")
+
+    def test_FoldBraceNewlines(self):
+        self.assertEquals(
+            FoldBraceNewlines("a {{{b\r\nc\nd}}} e\n{{{f}}}\n{{{g"),
+            "a {{{b  c d}}} e\n{{{f}}}\n{{{g")
+
+    def test_FoldBraceNewlines_strict(self):
+        self.assertEquals(
+            FoldBraceNewlines("- {{{a\nb}}}", strict=True), "- {{{a b}}}")
+        self.assertRaises(
+            UnsupportedSyntax,
+            FoldBraceNewlines, "- {{{a:\nb}}}", strict=True)
+        self.assertRaises(
+            UnsupportedSyntax,
+            FoldBraceNewlines, "- {{{a\n- echo b}}}", strict=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
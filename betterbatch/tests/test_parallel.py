@@ -0,0 +1,161 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import threading
+import time
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import parallel
+from betterbatch.parallel import *
+
+
+def ProcessId(value):
+    "Return the value and the id of the process that it was called in"
+    return value, os.getpid()
+
+
+class Counter(object):
+    "Record how many jobs run at the same time"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0
+        self.finished = 0
+
+    def job(self, duration = .01, func = None):
+        "Return a job that is counted while it runs"
+        def Job():
+            self.lock.acquire()
+            self.running += 1
+            self.most = max(self.most, self.running)
+            self.lock.release()
+            try:
+                time.sleep(duration)
+                if func is not None:
+                    func()
+            finally:
+                self.lock.acquire()
+                self.running -= 1
+                self.finished += 1
+                self.lock.release()
+        return Job
+
+
+class JobPoolTests(unittest.TestCase):
+    "Unit tests for the pool that runs parallel blocks"
+
+    def test_all_jobs_run(self):
+        counter = Counter()
+        pool = JobPool(4)
+        self.assertEquals(
+            pool.run([counter.job(0) for i in range(200)]), [])
+        self.assertEquals(counter.finished, 200)
+        self.assertEquals(pool.workers <= 4, True)
+
+    def test_max_jobs(self):
+        counter = Counter()
+        pool = JobPool(3)
+        pool.run([counter.job() for i in range(20)])
+        self.assertEquals(counter.most, 3)
+
+    def test_block_max_jobs(self):
+        counter = Counter()
+        pool = JobPool(8)
+        pool.run([counter.job() for i in range(20)], max_jobs = 2)
+        self.assertEquals(counter.most, 2)
+
+    def test_nested_blocks_share_budget(self):
+        counter = Counter()
+        pool = JobPool(3)
+
+        def Nested():
+            pool.run([counter.job() for i in range(5)])
+
+        # the outer jobs are all waiting for their nested blocks
+        pool.run([Nested for i in range(6)])
+        self.assertEquals(counter.finished, 30)
+        self.assertEquals(counter.most <= 3, True)
+        self.assertEquals(pool.workers, 3)
+
+    def test_errors(self):
+        def Fail():
+            raise RuntimeError("failed")
+
+        counter = Counter()
+        pool = JobPool(2)
+        errors = pool.run([Fail, counter.job(), Fail])
+        self.assertEquals([str(e) for e in errors], ["failed", "failed"])
+        self.assertEquals(counter.finished, 1)
+
+    def test_empty(self):
+        self.assertEquals(JobPool(1).run([]), [])
+
+    def test_invalid_max_jobs(self):
+        self.assertRaises(RuntimeError, JobPool, 0)
+        self.assertRaises(RuntimeError, JobPool(1).run, [], 0)
+
+    def test_stop(self):
+        counter = Counter()
+        pool = JobPool(3)
+        pool.run([counter.job() for i in range(6)])
+        threads = list(pool.threads)
+        self.assertEquals(len(threads), 3)
+
+        pool.stop(5)
+        self.assertEquals([t.isAlive() for t in threads], [False] * 3)
+        self.assertEquals(pool.workers, 0)
+
+    def test_shutdown_stops_workers(self):
+        RunJobs([Counter().job(0) for i in range(4)])
+        threads = list(Pool().threads)
+
+        Shutdown()
+        self.assertEquals(parallel._POOL, None)
+        self.assertEquals([t.isAlive() for t in threads], [False] * len(threads))
+        # a new pool is started when needed
+        self.assertEquals(RunJobs([Counter().job(0)]), [])
+
+    def test_shared_pool(self):
+        prev = parallel.MAX_JOBS
+        try:
+            parallel.MAX_JOBS = 2
+            counter = Counter()
+            RunJobs([counter.job() for i in range(10)])
+            self.assertEquals(counter.most, 2)
+            self.assertEquals(Pool().max_jobs, 2)
+        finally:
+            parallel.MAX_JOBS = prev
+
+
+class ProcessPoolTests(unittest.TestCase):
+    "Unit tests for running jobs in worker processes"
+
+    def tearDown(self):
+        Shutdown()
+
+    def test_run_in_process(self):
+        if not ProcessesAvailable():
+            return
+        value, pid = RunInProcess(ProcessId, "value")
+        self.assertEquals(value, "value")
+        self.assertNotEquals(pid, os.getpid())
+
+    def test_shutdown(self):
+        if not ProcessesAvailable():
+            return
+        RunInProcess(ProcessId, 1)
+        Shutdown()
+        self.assertEquals(parallel._PROCESS_POOL, None)
+        self.assertEquals(RunInProcess(ProcessId, 2)[0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,11 @@ import os
 import sys
 import logging
 import glob
+import shutil
+import tempfile
+import pickle
+import threading
+import time
 
 TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
 TEST_FILES_PATH = os.path.join(TESTS_DIR, "test_files")
@@ -13,7 +18,9 @@ TEST_FILES_PATH = os.path.join(TESTS_DIR, "test_files")
 PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
 sys.path.append(PACKAGE_ROOT)
 
+from betterbatch import parallel
 from betterbatch import parsescript
+from betterbatch import statedb
 from betterbatch. parsescript import *
 
 parsescript.LOG = ConfigLogging()
@@ -414,6 +421,59 @@ class ReplaceVariableReferencesTests(unittest.TestCase):
 
         self.assertEqual(replaced, "uses some value <and_missing>")
 
+    def test_nested_reference(self):
+        """"""
+        variables = {'key': 'k', 'var.k': 'value'}
+        new = ReplaceVariableReferences("<var.<key> >", variables)
+        self.assertEquals(new, "value")
+
+    def test_escaped_value(self):
+        """"""
+        variables = {'x': 'a <<b>>', 'b': 'c'}
+        new = ReplaceVariableReferences("<x>!", variables)
+        self.assertEquals(new, "a c!")
+
+
+class CompileVariableReferencesTests(unittest.TestCase):
+
+    def test_template(self):
+        """"""
+        self.assertEquals(
+            CompileVariableReferences("a <X > << b >> <y>"),
+            ["a ", "x", " {{_LT_}} b {{_GT_}} ", "y", ""])
+
+    def test_no_refs(self):
+        """"""
+        self.assertEquals(CompileVariableReferences("a b"), ["a b"])
+
+    def test_unmatched_brackets(self):
+        """"""
+        self.assertEquals(CompileVariableReferences("a < <x> > b"), None)
+        self.assertEquals(CompileVariableReferences("a >>> b"), None)
+
+    def test_same_as_full_replacement(self):
+        """"""
+        variables = {
+            'x': 'uses <z>',
+            'y': '<<my value>>',
+            'z': 'c:\\temp',
+            'key': 'z',
+            'q': 'a < b',
+            }
+        for text in (
+                "<x>",
+                "<z> <<z>> <KEY >",
+                "<<<<z>>>>",
+                "x<z>>>>",
+                "<q>",
+                "<<z",
+                "<x> <y>>>>",
+                ):
+            self.assertEquals(
+                ReplaceVariableReferences(text, variables),
+                ReplaceAllVariableReferences(text, variables))
+
+
 #class ReplaceVariablesInStepsTests(unittest.TestCase):
 #    """"""
 #    def test_normal_no_update(self):
@@ -717,6 +777,123 @@ class ReplaceExecutableSectionsTests(unittest.TestCase):
         self.assertEquals("<<" in replaced , True)
         self.assertEquals(">>" in replaced, True)
 
+    def counting_section(self, qualifiers = "{*cache*}"):
+        "Return a section that counts how often it has been run"
+        self.count_file = os.path.join(tempfile.mkdtemp(), "count")
+        return '{{{"%s" -c "import sys; f = open(r\'%s\', \'a\'); ' \
+            'f.write(\'x\'); f.close(); ' \
+            'sys.stdout.write(\'<arg>\')" %s}}}' % (
+                sys.executable, self.count_file, qualifiers)
+
+    def run_count(self):
+        "Return how often the counting section was run"
+        count = len(open(self.count_file).read())
+        shutil.rmtree(os.path.dirname(self.count_file))
+        return count
+
+    def test_cache(self):
+        parsescript.EXEC_SECTION_CACHE = ExecSectionCache()
+        section = self.counting_section()
+        for i in range(3):
+            self.assertEquals(
+                RenderVariableValue(section, {'arg': 'a'}, "run"), "a")
+        self.assertEquals(
+            RenderVariableValue(section, {'arg': 'b'}, "run"), "b")
+        self.assertEquals(self.run_count(), 2)
+        self.assertEquals(parsescript.EXEC_SECTION_CACHE.hits, 2)
+        self.assertEquals(parsescript.EXEC_SECTION_CACHE.misses, 2)
+
+    def test_not_cached(self):
+        parsescript.EXEC_SECTION_CACHE = ExecSectionCache()
+        section = self.counting_section("")
+        for i in range(2):
+            RenderVariableValue(section, {'arg': 'a'}, "run")
+        self.assertEquals(self.run_count(), 2)
+
+    def test_cache_threads(self):
+        parsescript.EXEC_SECTION_CACHE = ExecSectionCache()
+        section = self.counting_section()
+        outputs = []
+        def Render():
+            outputs.append(RenderVariableValue(section, {'arg': 'a'}, "run"))
+        threads = [threading.Thread(target = Render) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(outputs, ["a"] * 5)
+        self.assertEquals(self.run_count(), 1)
+
+    def test_cache_tools(self):
+        parsescript.EXEC_SECTION_CACHE = ExecSectionCache()
+        ini_file = os.path.join(TEST_FILES_PATH, "get_config_option.ini")
+        self.assertEquals(
+            ReplaceExecutableSections(
+                "{{{get_ini_option %s deu x86_ISO {*cache*}}}}" % ini_file,
+                {}),
+            "valid_return")
+        for i in range(2):
+            self.assertRaises(
+                RuntimeError,
+                ReplaceExecutableSections,
+                    "{{{get_ini_option %s deu missing {*cache*}}}}" % ini_file,
+                    {})
+
+        # an external tool that writes its arguments (and fails with 'fail')
+        tool_dir = tempfile.mkdtemp()
+        if sys.platform == "win32":
+            tool_path = os.path.join(tool_dir, "args.bat")
+            open(tool_path, "w").write(
+                '@echo %*\n@if "%1" == "fail" exit /b 2\n')
+        else:
+            tool_path = os.path.join(tool_dir, "args")
+            open(tool_path, "w").write(
+                "#!%s\nimport sys\nprint ' '.join(sys.argv[1:])\n"
+                "sys.exit('fail' in sys.argv and 2 or 0)\n" % sys.executable)
+            os.chmod(tool_path, 0755)
+        built_in_commands.NAME_ACTION_MAPPING['bb_args_test'] = \
+            built_in_commands.ExternalCommand(tool_path)
+        try:
+            self.assertEquals(
+                ReplaceExecutableSections(
+                    "{{{bb_args_test a b {*cache*}}}}", {}),
+                "a b")
+            for i in range(2):
+                self.assertRaises(
+                    RuntimeError,
+                    ReplaceExecutableSections,
+                        "{{{bb_args_test fail {*cache*}}}}", {})
+        finally:
+            del built_in_commands.NAME_ACTION_MAPPING['bb_args_test']
+            shutil.rmtree(tool_dir)
+        self.assertEquals(parsescript.EXEC_SECTION_CACHE.hits, 0)
+
+    def test_cache_error(self):
+        cache = ExecSectionCache()
+        def Fail():
+            raise RuntimeError("failed")
+        self.assertRaises(RuntimeError, cache.output, "cmd", Fail)
+        self.assertEquals(cache.output("cmd", lambda: "out"), "out")
+        self.assertEquals(cache.output("cmd", Fail), "out")
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+    def test_cache_nested(self):
+        cache = ExecSectionCache()
+        def Run(depth):
+            # a cached command that needs its own output - and the output
+            # of other cached commands
+            if depth == 0:
+                return cache.output("leaf", lambda: "leaf")
+            return cache.output("cmd", lambda: Run(depth - 1))
+        outputs = []
+        thread = threading.Thread(target = lambda: outputs.append(Run(3)))
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(10)
+        self.assertEquals(thread.isAlive(), False)
+        self.assertEquals(outputs, ["leaf"])
+        self.assertEquals(cache.output("cmd", lambda: "other"), "leaf")
+
 
 class ParseStepTests(unittest.TestCase):
     ""
@@ -905,6 +1082,18 @@ class ParseComplexStepTests(unittest.TestCase):
             ParseComplexStep,
                 step)
 
+    def test_else_steps_parsed_when_needed(self):
+        step = ParseComplexStep(
+            {r"if exists c:\temp": ["cd 1"], 'else': [{"blah": None}]})
+        self.assertEquals(
+            isinstance(step.__dict__['else_steps'], UnparsedSteps), True)
+
+        self.assertEquals(step.if_steps[0].raw_step, 'cd 1')
+        self.assertRaises(
+            RuntimeError,
+            getattr,
+                step, 'else_steps')
+
 
 class ParallelStepTests(unittest.TestCase):
     def test_empty_steps(self):
@@ -926,6 +1115,304 @@ class ParallelStepTests(unittest.TestCase):
 
         ParseComplexStep(step).execute({}, 'test')
 
+    def test_maxjobs(self):
+        step = ParseComplexStep({"parallel {*maxjobs=2*}": ["set x = 1"]})
+        self.assertEquals(step.max_jobs, 2)
+        self.assertEquals(ParseComplexStep({"parallel": ["x"]}).max_jobs, None)
+
+        step = ParseComplexStep({"for x in a b {*parallel*}{*maxjobs=3*}": [
+            "set y = <x>"]})
+        self.assertEquals(step.max_jobs, 3)
+
+        for bad in ("0", "x", ""):
+            self.assertRaises(
+                RuntimeError,
+                ParseComplexStep,
+                    {"parallel {*maxjobs=%s*}" % bad: ["set x = 1"]})
+
+    def test_processes(self):
+        step = ParseComplexStep({"parallel {*processes*}": ["set x = 1"]})
+        self.assertEquals(step.processes, True)
+        self.assertEquals(
+            ParseComplexStep({"parallel": ["x"]}).processes, False)
+
+    def test_ExecuteStepInProcess(self):
+        if not parallel.ProcessesAvailable():
+            return
+
+        def RunInProcess(step, variables = None):
+            return parallel.RunInProcess(
+                ExecuteStepInProcess, ParseStep(step), variables or {},
+                "run", {})
+
+        prev_max_jobs = parallel.MAX_JOBS
+        prev_handlers = list(parsescript.LOG.handlers)
+        # one process - so each step runs in the same process
+        parallel.MAX_JOBS = 1
+        try:
+            cwd = parallel.RunInProcess(os.getcwd)
+            error, records = RunInProcess("echo hello <x>", {'x': 'there'})
+            self.assertEquals(error, None)
+            self.assertEquals(
+                [r.getMessage() for r in records], ["hello there"])
+
+            # the records are only returned once
+            error, records = RunInProcess("cd %s" % tempfile.gettempdir())
+            self.assertEquals(error, None)
+            self.assertEquals(
+                "hello there" in [r.getMessage() for r in records], False)
+            self.assertEquals(parallel.RunInProcess(os.getcwd), cwd)
+
+            error, records = RunInProcess("end 2, stopped")
+            self.assertEquals(isinstance(error, EndExecution), True)
+        finally:
+            parallel.Shutdown()
+            parallel.MAX_JOBS = prev_max_jobs
+
+        # the logger of this process is not changed
+        self.assertEquals(parsescript.LOG.handlers, prev_handlers)
+        self.assertRaises(
+            RuntimeError,
+            ExecuteStepInProcess, ParseStep("echo x"), {}, "run", {})
+
+    def test_errors_pickle(self):
+        errors = ErrorCollection([
+            UndefinedVariableError("var", "<var>"),
+            CommandPathNotFoundError("cmd", "cmd x"),
+            EndExecution(3, "message"),
+            ])
+        errors = pickle.loads(pickle.dumps(errors, 2))
+        self.assertEquals(len(errors.errors), 3)
+        self.assertEquals(errors.errors[0].variable, "var")
+        self.assertEquals(errors.errors[1].string, "cmd x")
+        self.assertEquals(errors.errors[2].ret, 3)
+
+
+def SleepCommand(seconds, output = "", ret = 0):
+    "Return a command that waits, writes output and returns ret"
+    return '"%s" -c "import time, sys; time.sleep(%s); ' \
+        'sys.stdout.write(\'%s\'); sys.exit(%d)"' % (
+            sys.executable, seconds, output, ret)
+
+
+class AutoParallelTests(unittest.TestCase):
+    "Unit tests for running the independent steps of a block together"
+
+    def setUp(self):
+        parsescript.AUTO_PARALLEL = True
+
+    def tearDown(self):
+        parsescript.AUTO_PARALLEL = False
+
+    def run_steps(self, raw_steps, variables = None):
+        "Run the steps and return (seconds taken, variables)"
+        if variables is None:
+            variables = {}
+        variables = VariableStore(variables)
+        steps = ParseSteps(raw_steps)
+        start = time.time()
+        ExecuteSteps(steps, variables, "run")
+        return time.time() - start, variables
+
+    def test_independent_commands(self):
+        taken, variables = self.run_steps([
+            SleepCommand(.5) + " {*writes=a*}",
+            SleepCommand(.5) + " {*reads=b*}",
+            ])
+        self.assertEquals(taken < .9, True)
+
+    def test_resources(self):
+        # the second step reads what the first writes
+        taken, variables = self.run_steps([
+            SleepCommand(.4) + " {*writes=a*}",
+            SleepCommand(.4) + " {*reads=a, b*}",
+            ])
+        self.assertEquals(taken >= .8, True)
+
+    def test_undeclared_commands_in_order(self):
+        taken, variables = self.run_steps([
+            SleepCommand(.4),
+            SleepCommand(.4) + " {*writes=b*}",
+            ])
+        self.assertEquals(taken >= .8, True)
+
+    def test_variables_in_step_order(self):
+        taken, variables = self.run_steps([
+            "set x = {{{%s}}} {*writes=a*}" % SleepCommand(.5, "first"),
+            "set x = {{{%s}}} {*writes=b*}" % SleepCommand(0, "second"),
+            "set y = <x>",
+            ])
+        self.assertEquals(variables['x'], "second")
+        self.assertEquals(variables['y'], "second")
+
+    def test_variable_dependency(self):
+        taken, variables = self.run_steps([
+            "set x = {{{%s}}} {*writes=a*}" % SleepCommand(.3, "first"),
+            "set y = {{{%s}}} {*writes=b*}" % SleepCommand(0, "<x>2"),
+            ])
+        self.assertEquals(variables['y'], "first2")
+
+    def test_first_error_raised(self):
+        try:
+            self.run_steps([
+                SleepCommand(.5, ret = 3) + " {*writes=a*}",
+                SleepCommand(0, ret = 4) + " {*writes=b*}",
+                "set x = {{{%s}}} {*writes=c*}" % SleepCommand(0, "set"),
+                ])
+        except RuntimeError, e:
+            self.assertEquals("Non zero return (3)" in str(e), True)
+        else:
+            self.fail("error not raised")
+
+    def test_not_committed_after_error(self):
+        variables = VariableStore()
+        steps = ParseSteps([
+            SleepCommand(.3, ret = 3) + " {*writes=a*}",
+            "set x = {{{%s}}} {*writes=b*}" % SleepCommand(0, "set"),
+            ])
+        self.assertRaises(
+            RuntimeError, ExecuteSteps, steps, variables, "run")
+        self.assertEquals('x' in variables, False)
+        self.assertEquals(variables['__last_return__'], "3")
+
+    def test_barrier(self):
+        cwd = os.getcwd()
+        try:
+            taken, variables = self.run_steps([
+                "set x = {{{%s}}} {*writes=a*}" % SleepCommand(.3, "x"),
+                "cd %s" % tempfile.gettempdir(),
+                "set y = {{{%s}}} {*writes=b*}" % SleepCommand(.3, "y"),
+                ])
+            self.assertEquals(taken >= .6, True)
+            self.assertEquals(os.getcwd(), os.path.abspath(
+                tempfile.gettempdir()))
+        finally:
+            os.chdir(cwd)
+
+    def test_step_access(self):
+        variables = {'a': "<b>", 'b': "value", 'c': "x"}
+        access = FindStepAccess(ParseStep("set x = <a> {*writes=f1, F2*}"),
+            variables)
+        self.assertEquals(access.barrier, False)
+        self.assertEquals(access.pooled, False)
+        self.assertEquals(access.variables_read, set(['a', 'b']))
+        self.assertEquals(access.variables_written, set(['x']))
+        self.assertEquals(access.resources_written, set(['f1', 'f2']))
+
+        access = FindStepAccess(ParseStep("cmd <c>"), variables)
+        self.assertEquals(access.pooled, True)
+        self.assertEquals(access.all_resources, True)
+        self.assertEquals('c' in access.variables_read, True)
+        self.assertEquals(access.variables_written, set(['__last_return__']))
+
+        access = FindStepAccess(ParseStep("cmd {*reads=f1*}"), variables)
+        self.assertEquals(access.all_resources, False)
+        self.assertEquals(access.resources_read, set(['f1']))
+
+    def test_delayed_executable_section_uses_all_resources(self):
+        value = VariableValue("{{{tool.exe}}}")
+        value.delayed = True
+        variables = {'a': "<b>", 'b': value}
+        for raw_step in (
+                "set x = <b> {*writes=f1*}",
+                "cmd <a> {*reads=f1*}",
+                ):
+            access = FindStepAccess(ParseStep(raw_step), variables)
+            self.assertEquals(access.barrier, False)
+            self.assertEquals(access.all_resources, True)
+
+    def test_barrier_steps(self):
+        for raw_step in (
+                "cd here",
+                "pushd here",
+                "<cmd> arg",
+                "set x = <a> {*delayed*}",
+                "cmd <a.<b>>",
+                "cmd {*ui*}",
+                {"if exist here": ["echo here"]},
+                ):
+            self.assertEquals(
+                FindStepAccess(ParseStep(raw_step), {}).barrier, True)
+
+    def test_inputs_and_outputs_are_resources(self):
+        access = FindStepAccess(
+            ParseStep("cc {*inputs=a.c, <x>*}{*outputs=a.o*}"), {})
+        self.assertEquals(access.all_resources, False)
+        self.assertEquals(access.resources_read, set(['a.c', '<x>']))
+        self.assertEquals(access.resources_written, set(['a.o']))
+        self.assertEquals('x' in access.variables_read, True)
+
+
+class UpToDateStepTests(unittest.TestCase):
+    "Unit tests for the {*inputs=...*} and {*outputs=...*} qualifiers"
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.prev_database = statedb.DATABASE_FILE
+        statedb.DATABASE_FILE = os.path.join(self.folder, "state.sqlite")
+        self.src = os.path.join(self.folder, "src.txt")
+        self.out = os.path.join(self.folder, "out.txt")
+        self.runs = os.path.join(self.folder, "runs.txt")
+        open(self.src, "w").write("source")
+        os.utime(self.src, (time.time() - 100, time.time() - 100))
+
+    def tearDown(self):
+        statedb.Close()
+        statedb.DATABASE_FILE = self.prev_database
+        shutil.rmtree(self.folder)
+
+    def run_step(self, qualifiers):
+        "Run a command that copies src to out and return the number of runs"
+        step = ParseStep(
+            '"%s" -c "import shutil; shutil.copy(r\'%s\', r\'%s\'); '
+            'open(r\'%s\', \'a\').write(\'x\')" %s' % (
+                sys.executable, self.src, self.out, self.runs, qualifiers))
+        step.execute(
+            {'folder': self.folder, 'src': self.src}, "run")
+        return len(open(self.runs).read())
+
+    def test_skipped_when_up_to_date(self):
+        qualifiers = "{*inputs=<src>*}{*outputs=<folder>/out*.txt*}"
+        self.assertEquals(self.run_step(qualifiers), 1)
+        self.assertEquals(self.run_step(qualifiers), 1)
+
+        # the input changed
+        open(self.src, "w").write("changed")
+        os.utime(self.src, (time.time() + 10, time.time() + 10))
+        self.assertEquals(self.run_step(qualifiers), 2)
+
+    def test_hash(self):
+        qualifiers = "{*inputs=<src>*}{*outputs=<folder>/out.txt*}{*hash*}"
+        self.assertEquals(self.run_step(qualifiers), 1)
+
+        # newer but the same contents
+        os.utime(self.src, (time.time() + 10, time.time() + 10))
+        self.assertEquals(self.run_step(qualifiers), 1)
+
+        open(self.src, "w").write("changed")
+        self.assertEquals(self.run_step(qualifiers), 2)
+        self.assertEquals(self.run_step(qualifiers), 2)
+
+    def test_skipped_result(self):
+        step = ParseStep(
+            '"%s" -c "open(r\'%s\', \'w\'); print \'made\'; raise SystemExit(3)" '
+            '{*outputs=%s*}{*nocheck*}' % (sys.executable, self.out, self.out))
+        variables = {}
+        step.execute(variables, "run")
+        self.assertEquals((step.ret, step.output.strip()), (3, "made"))
+        self.assertEquals(variables['__last_return__'], '3')
+
+        step.execute(variables, "run")
+        self.assertEquals((step.ret, step.output), (0, ""))
+        self.assertEquals(variables['__last_return__'], '0')
+
+    def test_failed_command_not_recorded(self):
+        step = ParseStep(
+            '"%s" -c "import sys; sys.exit(2)" '
+            '{*inputs=%s*}{*hash*}{*nocheck*}' % (sys.executable, self.src))
+        step.execute({}, "run")
+        self.assertEquals(statedb.Query("SELECT * FROM command_inputs"), [])
+
 
 class StepTests(unittest.TestCase):
     ""
@@ -1032,6 +1519,47 @@ class VariableDefinitionTests(unittest.TestCase):
 
         self.assertEquals(vars["_yikes_"], '_close_ here')
 
+    def test_persist(self):
+        folder = tempfile.mkdtemp()
+        prev_database = statedb.DATABASE_FILE
+        statedb.DATABASE_FILE = os.path.join(folder, "state.sqlite")
+        try:
+            step = VariableDefinition(
+                "set v = {{{ uppercase <a> }}} {*persist=1h*}")
+            vars = {'a': 'here'}
+            step.execute(vars, "run")
+            self.assertEquals(vars['v'], 'HERE')
+            self.assertEquals(
+                len(statedb.Query("SELECT * FROM persisted_values")), 1)
+
+            # the stored value is used
+            statedb.Update("UPDATE persisted_values SET value = 'STORED'")
+            step.execute(vars, "run")
+            self.assertEquals(vars['v'], 'STORED')
+
+            # a different value of the variable is a different key
+            vars['a'] = 'there'
+            step.execute(vars, "run")
+            self.assertEquals(vars['v'], 'THERE')
+
+            # nothing is run or stored in the test phase
+            vars['a'] = 'other'
+            step.execute(vars, "test")
+            self.assertEquals(
+                len(statedb.Query("SELECT * FROM persisted_values")), 2)
+        finally:
+            statedb.Close()
+            statedb.DATABASE_FILE = prev_database
+            shutil.rmtree(folder)
+
+    def test_persist_bad_qualifiers(self):
+        for raw_step in (
+                "set v = x {*persist=forever*}",
+                "set v = x {*persist=1h*} {*delayed*}"):
+            self.assertRaises(
+                RuntimeError,
+                VariableDefinition(raw_step).execute, {}, "test")
+
 
 class EndExecutionTests(unittest.TestCase):
     ""
@@ -1217,6 +1745,70 @@ class CommandStepTests(unittest.TestCase):
             s.execute,
             {}, 'run', )
 
+    def test_cancelled_in_thread(self):
+        # only the main thread asks if the script should be stopped
+        def Cancel(params, qualifiers):
+            raise KeyboardInterrupt()
+        built_in_commands.NAME_ACTION_MAPPING['bb_cancel_test'] = Cancel
+        errors = []
+        def Run():
+            try:
+                CommandStep("bb_cancel_test").execute({}, "run")
+            except KeyboardInterrupt, e:
+                errors.append(e)
+        try:
+            thread = threading.Thread(target = Run)
+            thread.start()
+            thread.join(10)
+        finally:
+            del built_in_commands.NAME_ACTION_MAPPING['bb_cancel_test']
+        self.assertEquals(len(errors), 1)
+
+    def tool_command_line(self, raw_step):
+        "Return the command line that the external tool in raw_step runs"
+        tool_path = os.path.join(TEST_FILES_PATH, "get_config_option.ini")
+        built_in_commands.NAME_ACTION_MAPPING['bb_args_test'] = \
+            built_in_commands.ExternalCommand(tool_path)
+        old_SystemCommand = built_in_commands.SystemCommand
+        built_in_commands.SystemCommand = lambda cmd, quals: (0, cmd)
+        try:
+            step = CommandStep(raw_step)
+            step.execute({}, "run")
+        finally:
+            built_in_commands.SystemCommand = old_SystemCommand
+            del built_in_commands.NAME_ACTION_MAPPING['bb_args_test']
+        return step.output[len(tool_path):].strip()
+
+    def test_scheduling_qualifiers_not_passed(self):
+        self.assertEquals(
+            self.tool_command_line(
+                "bb_args_test a b {*reads=x*}{*writes=y, z*}{*arg*}"),
+            "a b arg")
+
+        ini_file = os.path.join(TEST_FILES_PATH, "get_config_option.ini")
+        step = CommandStep(
+            "get_ini_option %s deu x86_ISO {*reads=%s*}" % (ini_file, ini_file))
+        step.execute({}, "run")
+        self.assertEquals(step.output.strip(), "valid_return")
+
+        step = CommandStep(
+            "get_ini_option %s deu missing {*writes=x*}" % ini_file)
+        self.assertRaises(RuntimeError, step.execute, {}, "run")
+
+    def test_up_to_date_qualifiers_not_passed(self):
+        missing = os.path.join(TEST_FILES_PATH, "not_here.txt")
+        self.assertEquals(
+            self.tool_command_line(
+                "bb_args_test a {*inputs=%s*}{*outputs=%s*}{*hash*}" % (
+                    missing, missing)),
+            "a")
+
+        ini_file = os.path.join(TEST_FILES_PATH, "get_config_option.ini")
+        step = CommandStep(
+            "get_ini_option %s deu missing {*inputs=%s*}" % (
+                ini_file, ini_file))
+        self.assertRaises(RuntimeError, step.execute, {}, "run")
+
     def test_Step_with_hidden_var_in_output(self):
         """"""
         hidden_var = VariableValue("some value")
@@ -1362,6 +1954,163 @@ class IncludeStepTests(unittest.TestCase):
 #        inc_step.execute({}, 'test')
 
 
+class IncludePrefetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.prefetcher = IncludePrefetcher()
+        self.variables = {"__script_dir__": TEST_FILES_PATH}
+
+    def tearDown(self):
+        self.prefetcher.stop()
+
+    def test_static_include(self):
+        steps = ParseSteps(["include commands.bb", "include <not_known>.bb"])
+        self.prefetcher.prefetch_includes(steps, self.variables)
+
+        self.assertEquals(
+            self.prefetcher.includes.keys(),
+            [os.path.join(TEST_FILES_PATH, "commands.bb")])
+
+        steps = self.prefetcher.take(
+            os.path.join(TEST_FILES_PATH, "commands.bb"))
+        self.assertEquals(steps[0].raw_step.strip(), "echo Hello World")
+
+        # it can only be taken once
+        self.assertEquals(
+            self.prefetcher.take(
+                os.path.join(TEST_FILES_PATH, "commands.bb")),
+            None)
+
+    def test_error_raised_when_taken(self):
+        steps = ParseSteps(["include file_doesn't_exist.bb"])
+        self.prefetcher.prefetch_includes(steps, self.variables)
+
+        self.assertRaises(
+            IOError,
+            self.prefetcher.take,
+                os.path.join(TEST_FILES_PATH, "file_doesn't_exist.bb"))
+
+    def test_functions_registered_when_taken(self):
+        FunctionDefinition.all_functions.pop('prefetched_function', None)
+        filename = os.path.join(TEST_FILES_PATH, "prefetch_function.bb")
+
+        self.prefetcher.prefetch(filename, self.variables)
+        self.prefetcher.includes[filename].finished.wait()
+        self.assertEquals(
+            'prefetched_function' in FunctionDefinition.all_functions, False)
+
+        self.prefetcher.take(filename)
+        self.assertEquals(
+            'prefetched_function' in FunctionDefinition.all_functions, True)
+
+    def test_include_step_takes_steps(self):
+        parsescript.INCLUDE_PREFETCHER = self.prefetcher
+        try:
+            step = IncludeStep("include commands.bb")
+            self.prefetcher.prefetch_includes([step], self.variables)
+
+            step.execute(dict(self.variables), 'test')
+            self.assertEquals(self.prefetcher.includes, {})
+        finally:
+            parsescript.INCLUDE_PREFETCHER = None
+
+    def test_stop_waits_for_threads(self):
+        steps = ParseSteps(["include commands.bb"])
+        self.prefetcher.prefetch_includes(steps, self.variables)
+        threads = list(self.prefetcher.threads)
+        self.assertEquals(len(threads), 1)
+
+        self.prefetcher.stop()
+        self.assertEquals([t.isAlive() for t in threads], [False])
+
+
+class IncludeCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = IncludeCache()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_hits_get_copies(self):
+        filename = os.path.join(TEST_FILES_PATH, "commands.bb")
+        steps = self.cache.load(filename)
+        steps2 = self.cache.load(filename)
+
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEquals(
+            [step.raw_step for step in steps],
+            [step.raw_step for step in steps2])
+        self.assertNotEqual(steps[0], steps2[0])
+
+    def test_changed_file_loaded_again(self):
+        filename = os.path.join(self.temp_dir, "changed.bb")
+        open(filename, "wb").write("- echo first\n")
+        self.assertEquals(
+            self.cache.load(filename)[0].raw_step.strip(), "echo first")
+
+        open(filename, "wb").write("- echo second one\n")
+        self.assertEquals(
+            self.cache.load(filename)[0].raw_step.strip(), "echo second one")
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_functions_registered_on_hit(self):
+        filename = os.path.join(TEST_FILES_PATH, "prefetch_function.bb")
+        self.cache.load(filename)
+        FunctionDefinition.all_functions.pop('prefetched_function', None)
+
+        self.cache.load(filename)
+        self.assertEquals(self.cache.hits, 1)
+        self.assertEquals(
+            'prefetched_function' in FunctionDefinition.all_functions, True)
+
+    def test_blocks_parsed_once(self):
+        filename = os.path.join(self.temp_dir, "blocks.bb")
+        open(filename, "wb").write(
+            "- for x in a b:\n"
+            "    - echo <x>\n"
+            "- if defined x:\n"
+            "    - echo x\n"
+            "  else:\n"
+            "    - blah:\n")
+        steps = self.cache.load(filename)
+        self.assertEquals(
+            isinstance(steps[0].__dict__['steps'], UnparsedSteps), True)
+
+        for i in range(2):
+            steps = self.cache.load(filename)
+            self.assertEquals(
+                steps[0].__dict__['steps'][0].raw_step.strip(), "echo <x>")
+            self.assertEquals(
+                steps[1].__dict__['if_steps'][0].raw_step.strip(), "echo x")
+            # the error is raised when the block is used
+            self.assertEquals(
+                isinstance(steps[1].__dict__['else_steps'], UnparsedSteps),
+                True)
+            self.assertRaises(RuntimeError, getattr, steps[1], 'else_steps')
+
+        parsed = []
+        orig_parse = UnparsedSteps.parse
+        def Parse(self):
+            parsed.append(self)
+            return orig_parse(self)
+        UnparsedSteps.parse = Parse
+        try:
+            steps = self.cache.load(filename)
+            steps[0].steps
+            steps[1].if_steps
+        finally:
+            UnparsedSteps.parse = orig_parse
+        self.assertEquals(parsed, [])
+
+    def test_missing_file(self):
+        self.assertRaises(
+            IOError,
+            self.cache.load,
+                os.path.join(self.temp_dir, "missing.bb"))
+
+
 class LogFileStepTests(IncludeStepTests):
     class_under_test = LogFileStep
     test_file_not_existing = lambda x: 1
@@ -1478,6 +2227,95 @@ class ForStepTests(unittest.TestCase):
             ParseStep(step).execute, 
                 {}, 'run')
 
+    def test_run(self):
+        step = ParseStep({'for x in <values>': ['set all = <all><x>;']})
+        vars = {'values': 'a\r\nb {*hidden*}\n <c> \n', 'all': '', 'c': 'C'}
+        step.execute(vars, 'run')
+        self.assertEquals(vars['all'], 'a;b;C;;')
+        self.assertEquals(vars['x'], '')
+
+    def test_loop_steps_lazy(self):
+        step = ParseStep({'for x in <values>': ['echo 1', 'echo 2']})
+        loop_steps = step.loop_steps(IterLines("a\nb"))
+        binding = loop_steps.next()
+        self.assertEquals(isinstance(binding, LoopVariableBinding), True)
+        self.assertEquals(binding.value, "a")
+        self.assertEquals(loop_steps.next(), step.steps[0])
+        self.assertEquals(len(list(loop_steps)), 4)
+
+    def test_LoopVariableBinding(self):
+        vars = {}
+        LoopVariableBinding('x', ' value {*hidden*} ').execute(vars, 'run')
+        self.assertEquals(vars['x'], 'value')
+        self.assertEquals(vars['x'].printable(), '*****')
+
+    def test_invalid_loop_variable(self):
+        self.assertRaises(
+            RuntimeError, ParseStep, {'for x y in a b': ['echo 1']})
+
+    def test_IterLines(self):
+        for text in ("", "a", "a\nb", "a\n", "\n\n", "a\r\nb\r\n"):
+            self.assertEquals(list(IterLines(text)), text.split("\n"))
+
+    def test_StreamedLoopValues(self):
+        for text in ("", "\n \n", "a", "\n\na\n\n b \n\nc <d>\r\n\n"):
+            output = text.strip().replace("<", "<<").replace(">", ">>")
+            expected = []
+            if output:
+                expected = [v.strip() for v in output.split("\n")]
+            self.assertEquals(
+                [v.strip() for v in StreamedLoopValues(text.split("\n"))],
+                expected)
+
+    def stream_loop(self, return_value, command_qualifiers = ""):
+        "Run a loop that only finishes if the steps run while streaming"
+        temp_dir = tempfile.mkdtemp()
+        try:
+            flag = os.path.join(temp_dir, "flag")
+            producer = '"%s" -c "%s"' % (sys.executable, "; ".join([
+                "import os, sys, time",
+                "print 'first'",
+                "sys.stdout.flush()",
+                "[time.sleep(.1) for i in range(100) "
+                    "if not os.path.exists(r'%s')]" % flag,
+                "print 'second'",
+                "sys.exit(%d)" % return_value]))
+            consumer = '"%s" -c "open(r\'%s\', \'w\')"' % (
+                sys.executable, flag)
+
+            step = ParseStep({"for x in {{{%s %s}}} {*stream*}" % (
+                producer, command_qualifiers): [
+                consumer,
+                "set got = <got><x>;"]})
+            vars = {'got': ''}
+            try:
+                step.execute(vars, "run")
+            finally:
+                self.got = vars['got']
+                self.last_return = vars.get('__last_return__')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_stream(self):
+        self.stream_loop(0)
+        self.assertEquals(self.got, "first;second;")
+
+    def test_stream_return_value_checked(self):
+        self.assertRaises(RuntimeError, self.stream_loop, 4)
+        self.assertEquals(self.got, "first;second;")
+        self.assertEquals(self.last_return, "4")
+
+        self.stream_loop(4, "{*nocheck*}")
+        self.assertEquals(self.got, "first;second;")
+
+    def test_stream_builtin(self):
+        # in process commands are not streamed
+        step = ParseStep({"for x in {{{ split a b }}} {*stream*}": [
+            "set got = <got><x>;"]})
+        vars = {'got': ''}
+        step.execute(vars, "run")
+        self.assertEquals(vars['got'], "a;b;")
+
 
 class IfStepTests(unittest.TestCase):
 
@@ -1777,6 +2615,55 @@ class ParseFunctionDefinitionTests(unittest.TestCase):
             ParseComplexStep,
                 {"function test(a)": []})
 
+    def test_only_none_steps(self):
+        self.assertRaises(
+            RuntimeError,
+            ParseComplexStep,
+                {"function test(a)": [None]})
+
+    def test_steps_parsed_when_needed(self):
+        func = ParseComplexStep({"function test(a)": ["echo 1", 'echo 2']})
+        self.assertEquals(
+            isinstance(func.__dict__['steps'], UnparsedSteps), True)
+
+        steps = func.steps
+        self.assertEquals(func.__dict__['steps'], steps)
+        self.assertEquals(func.steps is steps, True)
+
+    def test_nested_function_called_before_block(self):
+        for name in ('nested_func', 'deeper_func'):
+            FunctionDefinition.all_functions.pop(name, None)
+
+        steps = ParseSteps([
+            "call nested_func()",
+            {"if defined not_defined_var": [
+                {"function nested_func()": ["call deeper_func()"]},
+                {"parallel": [
+                    {"function deeper_func()": ["echo deeper"]}]},
+                ]},
+            ])
+        # the block is not parsed - but the functions are registered
+        self.assertEquals(
+            isinstance(steps[1].__dict__['if_steps'], UnparsedSteps), True)
+        ExecuteSteps(steps[:1], {}, "test")
+        ExecuteSteps(steps[:1], {}, "run")
+
+        # e.g. steps loaded from the cache
+        FunctionDefinition.all_functions.pop('nested_func')
+        FunctionDefinition.all_functions.pop('deeper_func')
+        RegisterFunctions(pickle.loads(pickle.dumps(steps)))
+        for name in ('nested_func', 'deeper_func'):
+            self.assertEquals(name in FunctionDefinition.all_functions, True)
+
+    def test_broken_steps_not_called(self):
+        step = {"function test(a)": [{"blah": None}]}
+        func = ParseComplexStep(step)
+
+        self.assertRaises(
+            RuntimeError,
+            func.call_function,
+                {'a': '123'}, {}, 'test')
+
 
 class FunctionDefinitionTests(unittest.TestCase):
     def test_basic(self):
@@ -2001,6 +2888,42 @@ class FunctionReturnTests(unittest.TestCase):
         self.assertEquals(vars['b'], '55')
 
 
+class ValidateStepsTests(unittest.TestCase):
+    "Tests that checking the steps does not change them"
+
+    def parse_all(self, steps):
+        "Parse any lazily parsed blocks so that they are in the snapshot"
+        for step in steps:
+            for attr in ('steps', 'if_steps', 'else_steps'):
+                if isinstance(getattr(step, attr, None), list):
+                    self.parse_all(getattr(step, attr))
+
+    def test_steps_not_changed(self):
+        steps = ParseSteps([
+            {"function test(a)": [
+                {"if defined a": ["return <a>1"]},
+                "echo <a>"]},
+            {"if defined __script_dir__": [
+                "include basic_set_var.bb",
+                "set b = {{{ call test(1) }}}"]},
+            {"for x in a b": ["echo <x>", "set c = {{{ call test(<x>) }}}"]},
+            ])
+        self.parse_all(steps)
+        before = pickle.dumps(steps)
+
+        vars = {'__script_dir__': TEST_FILES_PATH}
+        self.assertEquals(ExecuteSteps(steps, vars, "test"), steps)
+        self.assertEquals(vars['b'], '11')
+        self.assertEquals(pickle.dumps(steps), before)
+
+    def test_validate(self):
+        step = VariableDefinedCheck("defined x")
+        step.validate({})
+        self.assertEquals(hasattr(step, "ret"), False)
+        step.execute({}, "test")
+        self.assertEquals(step.ret, 1)
+
+
 class ParseStepsTests(unittest.TestCase):
     def test_single_step(self):
         ParseSteps(["set z = <a>", "set n = <b>",])
@@ -2053,6 +2976,48 @@ class ExecuteScriptFileTests(unittest.TestCase):
         path = os.path.join(TEST_FILES_PATH, "missing_variable.bb")
         ExecuteScriptFile(path, {})
 
+    def test_usage_is_printed_stream(self):
+        path = os.path.join(TEST_FILES_PATH, "missing_variable.bb")
+        self.assertEquals(ExecuteScriptFile(path, {}, stream=True), ([], {}))
+
+    def test_stream(self):
+        path = os.path.join(TEST_FILES_PATH, "streamed.bb")
+        steps, variables = ExecuteScriptFile(path, {}, stream=True)
+
+        self.assertEquals(steps, [])
+        self.assertEquals(variables['y'], "A  - B")
+        self.assertEquals(variables['z'], "11")
+
+    def test_stream_forward_call(self):
+        for name in ('triple', 'outer', 'nested_double'):
+            FunctionDefinition.all_functions.pop(name, None)
+        path = os.path.join(TEST_FILES_PATH, "streamed_forward_call.bb")
+        steps, variables = ExecuteScriptFile(path, {}, stream=True)
+
+        self.assertEquals(variables['x'], "aaa")
+        self.assertEquals(variables['y'], "bb")
+
+
+class StreamScriptFileTests(unittest.TestCase):
+    def test_steps(self):
+        path = os.path.join(TEST_FILES_PATH, "streamed.bb")
+        steps = list(StreamScriptFile(path))
+
+        self.assertEquals(len(steps), 5)
+        self.assertEquals(steps[1].raw_step, "set y = {{{uppercase a  - b}}}")
+        self.assertEquals(isinstance(steps[2], FunctionDefinition), True)
+
+    def test_steps_read_when_needed(self):
+        path = os.path.join(TEST_FILES_PATH, "streamed_broken.bb")
+        steps = StreamScriptFile(path)
+
+        self.assertEquals(steps.next().raw_step, "set x = 1")
+        self.assertRaises(RuntimeError, steps.next)
+
+    def test_not_a_list(self):
+        path = os.path.join(TEST_FILES_PATH, "commands_broken.bb")
+        self.assertRaises(RuntimeError, list, StreamScriptFile(path))
+
 
 class IntegrationTests(unittest.TestCase):
 
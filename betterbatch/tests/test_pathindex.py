@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import pathindex
+from betterbatch.pathindex import *
+
+
+def CommandName(name):
+    "Return the file name of a command on this platform"
+    if sys.platform == "win32":
+        return name + ".bat"
+    return name
+
+
+class PathIndexTests(unittest.TestCase):
+    "Unit tests for finding commands in an index of the PATH"
+
+    def setUp(self):
+        self.folders = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.index = PathIndex()
+
+    def tearDown(self):
+        for folder in self.folders:
+            shutil.rmtree(folder)
+
+    def add_command(self, folder, name, executable = True):
+        "Create a command in the folder and return its full path"
+        path = os.path.join(folder, CommandName(name))
+        open(path, "w").close()
+        if executable:
+            os.chmod(path, 0755)
+        return os.path.abspath(path)
+
+    def test_find(self):
+        path = self.add_command(self.folders[1], "cmd_one")
+        self.assertEquals(self.index.find("cmd_one", self.folders), path)
+
+    def test_first_folder(self):
+        self.add_command(self.folders[1], "cmd_one")
+        path = self.add_command(self.folders[0], "cmd_one")
+        self.assertEquals(self.index.find("cmd_one", self.folders), path)
+
+    def test_not_found(self):
+        self.assertEquals(self.index.find("cmd_none", self.folders), None)
+        self.assertEquals(
+            self.index.find("cmd_none", [os.path.join(
+                self.folders[0], "missing")]),
+            None)
+
+    def test_with_directory(self):
+        self.add_command(self.folders[0], "cmd_one")
+        self.assertEquals(
+            self.index.find(os.path.join("x", "cmd_one"), self.folders),
+            None)
+
+    def test_not_executable(self):
+        if sys.platform == "win32":
+            return
+        self.add_command(self.folders[0], "cmd_one", executable = False)
+        self.assertEquals(self.index.find("cmd_one", self.folders), None)
+
+    def test_folder_listed_once(self):
+        self.add_command(self.folders[0], "cmd_one")
+        self.index.find("cmd_one", self.folders)
+
+        listed = []
+        orig_listdir = os.listdir
+        def ListDir(folder):
+            listed.append(folder)
+            return orig_listdir(folder)
+        os.listdir = ListDir
+        try:
+            for i in range(10):
+                self.index.find("cmd_one", self.folders)
+        finally:
+            os.listdir = orig_listdir
+        self.assertEquals(listed, [])
+
+    def test_new_command_found(self):
+        self.assertEquals(self.index.find("cmd_new", self.folders), None)
+        path = self.add_command(self.folders[0], "cmd_new")
+        self.assertEquals(self.index.find("cmd_new", self.folders), path)
+
+    def test_removed_command(self):
+        path = self.add_command(self.folders[0], "cmd_one")
+        self.assertEquals(self.index.find("cmd_one", self.folders), path)
+        os.remove(path)
+        self.assertEquals(self.index.find("cmd_one", self.folders), None)
+
+    def test_save_and_load(self):
+        path = self.add_command(self.folders[0], "cmd_one")
+        self.index.find("cmd_one", self.folders)
+        cache_file = os.path.join(self.folders[1], "cache", "index.pickle")
+        self.assertEquals(self.index.save(cache_file), True)
+        # nothing has changed since it was saved
+        self.assertEquals(self.index.save(cache_file), False)
+
+        index = PathIndex()
+        index.load(cache_file)
+        self.assertEquals(
+            sorted(index.folders.keys()), sorted(self.index.folders.keys()))
+        self.assertEquals(index.find("cmd_one", self.folders), path)
+
+    def test_save_failed(self):
+        self.add_command(self.folders[0], "cmd_one")
+        self.index.find("cmd_one", self.folders)
+        cache_dir = os.path.join(self.folders[1], "cache")
+        # the temporary file cannot be renamed over a folder
+        os.makedirs(os.path.join(cache_dir, "index.pickle", "sub"))
+        self.assertEquals(
+            self.index.save(os.path.join(cache_dir, "index.pickle")), False)
+        self.assertEquals(os.listdir(cache_dir), ["index.pickle"])
+
+    def test_load_bad_file(self):
+        cache_file = os.path.join(self.folders[0], "index.pickle")
+        open(cache_file, "wb").write("not a pickle")
+        index = PathIndex()
+        index.load(cache_file)
+        self.assertEquals(index.folders, {})
+
+    def test_find_command(self):
+        path = self.add_command(self.folders[0], "cmd_one")
+        prev_path = os.environ['PATH']
+        try:
+            os.environ['PATH'] = os.pathsep.join(self.folders)
+            self.assertEquals(FindCommand("cmd_one"), path)
+        finally:
+            os.environ['PATH'] = prev_path
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import persisted
+from betterbatch import statedb
+from betterbatch.persisted import *
+
+
+class PersistedTests(unittest.TestCase):
+    "Unit tests for values kept between runs"
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.prev_database = statedb.DATABASE_FILE
+        statedb.DATABASE_FILE = os.path.join(self.folder, "state.sqlite")
+        self.computed = []
+
+    def tearDown(self):
+        statedb.Close()
+        statedb.DATABASE_FILE = self.prev_database
+        persisted.ENABLED = True
+        shutil.rmtree(self.folder)
+
+    def compute(self, value = "value"):
+        "Return a function that records that the value was computed"
+        def Compute():
+            self.computed.append(value)
+            return value
+        return Compute
+
+    def test_time_to_live(self):
+        self.assertEquals(ParseTimeToLive("30"), 30)
+        self.assertEquals(ParseTimeToLive("1.5s"), 1.5)
+        self.assertEquals(ParseTimeToLive("10m"), 600)
+        self.assertEquals(ParseTimeToLive(" 2H "), 7200)
+        self.assertEquals(ParseTimeToLive("7d"), 7 * 24 * 60 * 60)
+        for bad in ("", "d", "1w", "-1", "1 day"):
+            self.assertRaises(RuntimeError, ParseTimeToLive, bad)
+
+    def test_value_stored(self):
+        self.assertEquals(
+            Value("cmd", [], 60, self.compute()), ("value", False))
+        self.assertEquals(
+            Value("cmd", [], 60, self.compute()), ("value", True))
+        self.assertEquals(self.computed, ["value"])
+
+    def test_expired(self):
+        Value("cmd", [], .01, self.compute())
+        time.sleep(.05)
+        self.assertEquals(
+            Value("cmd", [], 60, self.compute("new")), ("new", False))
+        self.assertEquals(
+            statedb.Query("SELECT value FROM persisted_values"), [("new", )])
+
+    def test_environment(self):
+        prev = os.environ.get("BB_PERSIST_TEST")
+        try:
+            os.environ["BB_PERSIST_TEST"] = "1"
+            Value("cmd", ["BB_PERSIST_TEST"], 60, self.compute())
+            Value("cmd", ["BB_PERSIST_TEST"], 60, self.compute())
+            os.environ["BB_PERSIST_TEST"] = "2"
+            Value("cmd", ["BB_PERSIST_TEST"], 60, self.compute())
+            # not part of the key if it is not listed
+            Value("cmd", [], 60, self.compute())
+            Value("cmd", [], 60, self.compute())
+        finally:
+            if prev is None:
+                del os.environ["BB_PERSIST_TEST"]
+            else:
+                os.environ["BB_PERSIST_TEST"] = prev
+        self.assertEquals(len(self.computed), 3)
+
+    def test_disabled(self):
+        Value("cmd", [], 60, self.compute())
+        persisted.ENABLED = False
+        self.assertEquals(
+            Value("cmd", [], 60, self.compute("new")), ("new", False))
+        persisted.ENABLED = True
+        self.assertEquals(
+            Value("cmd", [], 60, self.compute()), ("new", True))
+
+    def test_clear(self):
+        self.assertEquals(Clear(), 0)
+        Value("cmd1", [], 60, self.compute())
+        Value("cmd2", [], 60, self.compute())
+        self.assertEquals(Clear(), 2)
+        Value("cmd1", [], 60, self.compute())
+        self.assertEquals(len(self.computed), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
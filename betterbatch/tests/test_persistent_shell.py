@@ -0,0 +1,199 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import tempfile
+import threading
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import persistent_shell
+from betterbatch.persistent_shell import *
+from betterbatch.built_in_commands import SystemCommand
+
+
+def PythonCommand(code):
+    "Return a command that runs the python code"
+    return '"%s" -c "%s"' % (sys.executable, code)
+
+
+class PersistentShellTests(unittest.TestCase):
+    "Unit tests for running commands in a persistent shell"
+
+    def setUp(self):
+        self.shell = PersistentShell()
+
+    def tearDown(self):
+        self.shell.close()
+
+    def test_output(self):
+        self.assertEquals(
+            self.shell.run("echo here"), (0, "here" + os.linesep))
+
+    def test_output_without_newline(self):
+        ret, out = self.shell.run(
+            PythonCommand("import sys; sys.stdout.write('here')"))
+        self.assertEquals(out, "here")
+
+    def test_stderr(self):
+        ret, out = self.shell.run(
+            PythonCommand("import sys; sys.stderr.write('here')"))
+        self.assertEquals(out, "here")
+
+    def test_return_value(self):
+        self.assertEquals(self.shell.run(
+            PythonCommand("import sys; sys.exit(3)"))[0], 3)
+        self.assertEquals(self.shell.run("echo here")[0], 0)
+
+    def test_large_output(self):
+        ret, out = self.shell.run(PythonCommand("print 'x' * 200000"))
+        self.assertEquals(out.strip(), "x" * 200000)
+
+    def test_same_shell(self):
+        pid = self.shell.proc.pid
+        self.shell.run("echo here")
+        self.shell.run("echo here")
+        self.assertEquals(self.shell.proc.pid, pid)
+        self.assertEquals(self.shell.is_usable(), True)
+
+    def test_no_input(self):
+        # the command must not read the commands that follow it
+        ret, out = self.shell.run(
+            PythonCommand("import sys; print repr(sys.stdin.read())"))
+        self.assertEquals(out.strip(), "''")
+        self.assertEquals(self.shell.run("echo here")[1].strip(), "here")
+
+    def test_current_directory(self):
+        cur_dir = os.getcwd()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(temp_dir)
+            ret, out = self.shell.run(
+                PythonCommand("import os; print os.getcwd()"))
+            self.assertEquals(
+                os.path.normcase(out.strip()),
+                os.path.normcase(os.getcwd()))
+        finally:
+            os.chdir(cur_dir)
+            os.rmdir(temp_dir)
+
+    def test_syntax_error(self):
+        if sys.platform == "win32":
+            return
+        result = []
+        thread = threading.Thread(
+            target = lambda: result.append(self.shell.run('echo "abc')))
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(10)
+        self.assertEquals(thread.isAlive(), False)
+        self.assertNotEquals(result[0][0], 0)
+
+        # the shell is still in step with the commands
+        self.assertEquals(self.shell.run("echo here")[1].strip(), "here")
+
+    def test_quotes_passed(self):
+        ret, out = self.shell.run(
+            PythonCommand("import sys; print sys.argv[1:]") +
+                " 'a b' \"c'd\" $HOME%")
+        if sys.platform != "win32":
+            self.assertEquals(
+                out.strip(), "['a b', \"c'd\", '%s%%']" % os.environ['HOME'])
+
+    def test_environment_changed(self):
+        os.environ['BB_PERSISTENT_SHELL_TEST'] = "1"
+        try:
+            self.assertEquals(self.shell.is_usable(), False)
+        finally:
+            del os.environ['BB_PERSISTENT_SHELL_TEST']
+        self.assertEquals(self.shell.is_usable(), True)
+
+
+class ThreadShellTests(unittest.TestCase):
+    "Unit tests for the shell used by SystemCommand"
+
+    def setUp(self):
+        persistent_shell.ENABLED = True
+
+    def tearDown(self):
+        persistent_shell.ENABLED = False
+        CloseAll()
+
+    def test_shell_reused(self):
+        self.assertEquals(ThreadShell() is ThreadShell(), True)
+
+    def test_environment(self):
+        os.environ['BB_PERSISTENT_SHELL_TEST'] = "first"
+        try:
+            code = "import os; print os.environ['BB_PERSISTENT_SHELL_TEST']"
+            self.assertEquals(
+                RunCommand(PythonCommand(code))[1].strip(), "first")
+            os.environ['BB_PERSISTENT_SHELL_TEST'] = "second"
+            self.assertEquals(
+                RunCommand(PythonCommand(code))[1].strip(), "second")
+        finally:
+            del os.environ['BB_PERSISTENT_SHELL_TEST']
+
+    def test_shell_changes_not_kept(self):
+        if sys.platform == "win32":
+            RunCommand("set BB_PERSISTENT_SHELL_TEST=changed")
+            self.assertEquals(
+                RunCommand("echo [%BB_PERSISTENT_SHELL_TEST%]")[1].strip(),
+                "[%BB_PERSISTENT_SHELL_TEST%]")
+        else:
+            RunCommand("export BB_PERSISTENT_SHELL_TEST=changed")
+            self.assertEquals(
+                RunCommand('echo "[$BB_PERSISTENT_SHELL_TEST]"')[1].strip(),
+                "[]")
+
+    def test_unclosed_quote(self):
+        result = []
+        thread = threading.Thread(
+            target = lambda: result.append(SystemCommand('echo "abc', [])))
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(10)
+        self.assertEquals(thread.isAlive(), False)
+        if sys.platform != "win32":
+            self.assertNotEquals(result[0][0], 0)
+        self.assertEquals(SystemCommand("echo here")[1].strip(), "here")
+
+    def test_shell_exits(self):
+        self.assertEquals(RunCommand("exit 4")[0], 4)
+        self.assertEquals(RunCommand("echo here")[1].strip(), "here")
+
+    def test_CanRun(self):
+        self.assertEquals(CanRun("echo here", []), True)
+        self.assertEquals(CanRun("echo here", ['ui']), False)
+        self.assertEquals(CanRun("echo\nhere", []), False)
+        self.assertEquals(CanRun("exit 3", []), False)
+        self.assertEquals(CanRun("echo a && exec sh", []), False)
+        self.assertEquals(CanRun("echo exited", []), True)
+        self.assertEquals(
+            CanRun('echo "not closed', []), sys.platform != "win32")
+        self.assertEquals(
+            CanRun('echo "(x)" & echo y', []), True)
+        self.assertEquals(CanRun('echo a)', []), sys.platform != "win32")
+        persistent_shell.ENABLED = False
+        self.assertEquals(CanRun("echo here", []), False)
+
+    def test_SystemCommand(self):
+        self.assertEquals(SystemCommand("echo here")[1].strip(), "here")
+        self.assertEquals(SystemCommand("echo here", ['nocapture']), (0, ""))
+        self.assertEquals(len(persistent_shell._SHELLS), 1)
+
+    def test_CloseAll(self):
+        shell = ThreadShell()
+        CloseAll()
+        self.assertEquals(shell.is_usable(), False)
+        self.assertEquals(persistent_shell._SHELLS, [])
+        self.assertEquals(ThreadShell() is shell, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
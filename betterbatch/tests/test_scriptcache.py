@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+TEST_FILES_PATH = os.path.join(TESTS_DIR, "test_files")
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import scriptcache
+from betterbatch import parsescript
+from betterbatch.parsescript import *
+parsescript.LOG = ConfigLogging()
+
+
+class ScriptCacheTests(unittest.TestCase):
+    "Unit tests for the cache of parsed scripts"
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.scripts_dir = tempfile.mkdtemp()
+        self.prev_enabled = scriptcache.ENABLED
+        self.prev_dir = scriptcache.CACHE_DIR
+        scriptcache.ENABLED = True
+        scriptcache.CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        scriptcache.ENABLED = self.prev_enabled
+        scriptcache.CACHE_DIR = self.prev_dir
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.scripts_dir)
+
+    def write_script(self, text, name = "script.bb"):
+        path = os.path.join(self.scripts_dir, name)
+        f = open(path, "wb")
+        f.write(text)
+        f.close()
+        return path
+
+    def cache_entries(self):
+        return [f for f in os.listdir(self.cache_dir)
+            if f.endswith(scriptcache.CACHE_FILE_EXT)]
+
+    def test_store_and_load(self):
+        path = self.write_script("- set x = 1\n")
+        key = scriptcache.CacheKey(path, "- set x = 1\n")
+
+        self.assertEquals(scriptcache.Load(path, key), None)
+        self.assertEquals(scriptcache.Store(path, key, ["a", "b"]), True)
+        self.assertEquals(scriptcache.Load(path, key), ["a", "b"])
+
+    def test_disabled(self):
+        scriptcache.ENABLED = False
+        path = self.write_script("- set x = 1\n")
+
+        self.assertEquals(scriptcache.CacheKey(path, "- set x = 1\n"), None)
+        self.assertEquals(scriptcache.Store(path, "key", ["a"]), False)
+        self.assertEquals(self.cache_entries(), [])
+
+    def test_key_changes_with_contents(self):
+        path = self.write_script("- set x = 1\n")
+        key1 = scriptcache.CacheKey(path, "- set x = 1\n")
+        key2 = scriptcache.CacheKey(path, "- set x = 2\n")
+        self.assertNotEquals(key1, key2)
+
+        scriptcache.Store(path, key1, ["a"])
+        self.assertEquals(scriptcache.Load(path, key2), None)
+
+    def test_corrupt_entry(self):
+        path = self.write_script("- set x = 1\n")
+        key = scriptcache.CacheKey(path, "- set x = 1\n")
+        scriptcache.Store(path, key, ["a"])
+
+        entry = os.path.join(self.cache_dir, self.cache_entries()[0])
+        f = open(entry, "wb")
+        f.write("not a pickle")
+        f.close()
+
+        self.assertEquals(scriptcache.Load(path, key), None)
+
+    def test_versions_are_pruned(self):
+        path = self.write_script("- set x = 1\n")
+        for i in range(scriptcache.MAX_VERSIONS_PER_SCRIPT + 3):
+            scriptcache.Store(path, "key%d" % i + "0" * 30, [i])
+
+        self.assertEquals(
+            len(self.cache_entries()), scriptcache.MAX_VERSIONS_PER_SCRIPT)
+
+    def test_store_unpicklable(self):
+        path = self.write_script("- set x = 1\n")
+        key = scriptcache.CacheKey(path, "- set x = 1\n")
+
+        self.assertEquals(scriptcache.Store(path, key, [lambda: 1]), False)
+        # the temporary file is removed
+        self.assertEquals(os.listdir(self.cache_dir), [])
+
+    def test_clear(self):
+        path = self.write_script("- set x = 1\n")
+        scriptcache.Store(path, scriptcache.CacheKey(path, "1"), ["a"])
+        scriptcache.Store(path, scriptcache.CacheKey(path, "2"), ["b"])
+
+        self.assertEquals(scriptcache.Clear(), 2)
+        self.assertEquals(self.cache_entries(), [])
+
+    def test_LoadScriptFile_uses_cache(self):
+        path = self.write_script(
+            "- function cached_func(a):\n"
+            "    - return <a>\n"
+            "- set x = {{{call cached_func(2)}}}\n")
+
+        steps = LoadScriptFile(path)
+        self.assertEquals(len(self.cache_entries()), 1)
+
+        # ensure that the steps are not re-parsed
+        del FunctionDefinition.all_functions['cached_func']
+        prev_parse = parsescript.ParseSteps
+        parsescript.ParseSteps = None
+        try:
+            cached_steps = LoadScriptFile(path)
+        finally:
+            parsescript.ParseSteps = prev_parse
+
+        self.assertEquals(
+            [s.raw_step for s in cached_steps], [s.raw_step for s in steps])
+        self.assertEquals(
+            'cached_func' in FunctionDefinition.all_functions, True)
+
+        variables = {}
+        ExecuteSteps(cached_steps, variables, "run")
+        self.assertEquals(variables['x'], "2")
+
+    def test_LoadScriptFile_changed_script(self):
+        path = self.write_script("- set x = 1\n")
+        LoadScriptFile(path)
+
+        # make sure the modification time is different also
+        time.sleep(0.01)
+        self.write_script("- set x = 2\n- set y = 3\n")
+        steps = LoadScriptFile(path)
+
+        self.assertEquals(len(steps), 2)
+        self.assertEquals(len(self.cache_entries()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch import statedb
+from betterbatch import uptodate
+from betterbatch.uptodate import *
+
+
+class UpToDateTests(unittest.TestCase):
+    "Unit tests for skipping commands whose outputs are up to date"
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.prev_database = statedb.DATABASE_FILE
+        statedb.DATABASE_FILE = os.path.join(self.folder, "state.sqlite")
+
+    def tearDown(self):
+        statedb.Close()
+        statedb.DATABASE_FILE = self.prev_database
+        shutil.rmtree(self.folder)
+
+    def write(self, name, contents = "text", age = 0):
+        "Write the file and set its modification time age seconds ago"
+        path = os.path.join(self.folder, name)
+        open(path, "wb").write(contents)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_split_patterns(self):
+        self.assertEquals(SplitPatterns("a.c, b\\*.h ,"), ["a.c", "b\\*.h"])
+        self.assertEquals(SplitPatterns(""), [])
+        self.assertEquals(SplitPatterns(None), [])
+
+    def test_matching_files(self):
+        self.write("a.c")
+        self.write("b.c")
+        self.assertEquals(
+            MatchingFiles([os.path.join(self.folder, "*.c")]),
+            [os.path.join(self.folder, "a.c"), os.path.join(self.folder, "b.c")])
+        self.assertEquals(
+            MatchingFiles([os.path.join(self.folder, "*.x")]), None)
+        self.assertEquals(MatchingFiles([]), [])
+
+    def test_outputs_newer(self):
+        src = self.write("a.c", age = 100)
+        out = self.write("a.o", age = 50)
+        check = UpToDateCheck("cc a.c", [src], [out])
+        self.assertEquals(
+            check.skip_reason(), "the outputs are newer than the inputs")
+
+    def test_outputs_older(self):
+        src = self.write("a.c", age = 50)
+        out = self.write("a.o", age = 100)
+        self.assertEquals(
+            UpToDateCheck("cc a.c", [src], [out]).skip_reason(), None)
+
+    def test_missing_files(self):
+        src = self.write("a.c", age = 100)
+        out = os.path.join(self.folder, "a.o")
+        self.assertEquals(
+            UpToDateCheck("cc a.c", [src], [out]).skip_reason(), None)
+
+        out = self.write("a.o")
+        self.assertEquals(
+            UpToDateCheck("cc", [src + "x"], [out]).skip_reason(), None)
+
+    def test_no_inputs(self):
+        out = self.write("a.o")
+        self.assertEquals(
+            UpToDateCheck("cc", [], [out]).skip_reason(), "the outputs exist")
+        # there is nothing to compare the inputs with
+        src = self.write("a.c")
+        self.assertEquals(UpToDateCheck("cc", [src], []).skip_reason(), None)
+
+    def test_hash(self):
+        src = self.write("a.c", "one", age = 10)
+        out = self.write("a.o", age = 100)
+
+        check = UpToDateCheck("cc a.c", [src], [out], use_hash = True)
+        self.assertEquals(check.skip_reason(), None)
+        check.record()
+
+        # newer but not changed
+        self.write("a.c", "one")
+        check = UpToDateCheck("cc a.c", [src], [out], use_hash = True)
+        self.assertEquals(check.skip_reason(), "the inputs have not changed")
+
+        self.write("a.c", "two")
+        check = UpToDateCheck("cc a.c", [src], [out], use_hash = True)
+        self.assertEquals(check.skip_reason(), None)
+
+        # a different command is checked separately
+        self.write("a.c", "one")
+        check = UpToDateCheck("cc -O a.c", [src], [out], use_hash = True)
+        self.assertEquals(check.skip_reason(), None)
+
+    def test_hash_recorded_before_run(self):
+        src = self.write("a.c", "one")
+        check = UpToDateCheck("cc a.c", [src], [], use_hash = True)
+        self.assertEquals(check.skip_reason(), None)
+        # changed while the command was running
+        self.write("a.c", "two")
+        check.record()
+
+        check = UpToDateCheck("cc a.c", [src], [], use_hash = True)
+        self.assertEquals(check.skip_reason(), None)
+
+    def test_file_hash_kept(self):
+        src = self.write("a.c", "one", age = 100)
+        digest = FileHash(src)
+        self.assertEquals(
+            statedb.Query("SELECT digest FROM file_hashes"), [(digest, )])
+
+        # recently changed files are not kept
+        src = self.write("b.c", "one")
+        self.assertEquals(FileHash(src), digest)
+        self.assertEquals(len(statedb.Query("SELECT * FROM file_hashes")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import sys
+import copy
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+TEST_FILES_PATH = os.path.join(TESTS_DIR, "test_files")
+
+# ensure that the package root is on the path
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(TESTS_DIR))
+sys.path.append(PACKAGE_ROOT)
+
+from betterbatch.parsescript import *
+
+
+class VariableStoreTests(unittest.TestCase):
+    "Tests for caching the resolved values of variables"
+
+    def setUp(self):
+        self.vars = VariableStore({
+            'root': 'c:\\work',
+            'project': '<root>\\<name>',
+            'name': 'bb',
+            'build': '<project>\\build',
+            })
+
+    def test_resolved_values_cached(self):
+        self.assertEquals(
+            ReplaceVariableReferences("<build>", self.vars),
+            "c:\\work\\bb\\build")
+        self.assertEquals(
+            sorted(self.vars._resolved.keys()),
+            ['build', 'name', 'project', 'root'])
+
+    def test_set_invalidates_dependents(self):
+        ReplaceVariableReferences("<build> <name>", self.vars)
+        self.vars['root'] = 'd:'
+
+        self.assertEquals(sorted(self.vars._resolved.keys()), ['name'])
+        self.assertEquals(
+            ReplaceVariableReferences("<build>", self.vars), "d:\\bb\\build")
+
+    def test_delete_invalidates_dependents(self):
+        ReplaceVariableReferences("<build>", self.vars)
+        del self.vars['name']
+
+        self.assertEquals(sorted(self.vars._resolved.keys()), ['root'])
+        self.assertRaises(
+            ErrorCollection, ReplaceVariableReferences, "<build>", self.vars)
+
+    def test_update_invalidates_dependents(self):
+        ReplaceVariableReferences("<build>", self.vars)
+        self.vars.update({'name': 'other'})
+
+        self.assertEquals(
+            ReplaceVariableReferences("<build>", self.vars),
+            "c:\\work\\other\\build")
+
+    def test_copies_are_independent(self):
+        ReplaceVariableReferences("<build>", self.vars)
+        copied = copy.deepcopy(self.vars)
+        copied['name'] = 'other'
+
+        self.assertEquals(isinstance(copied, VariableStore), True)
+        self.assertEquals(
+            ReplaceVariableReferences("<build>", self.vars),
+            "c:\\work\\bb\\build")
+        self.assertEquals(
+            ReplaceVariableReferences("<build>", copied),
+            "c:\\work\\other\\build")
+
+    def test_loop(self):
+        self.vars['root'] = '<build>'
+        try:
+            ReplaceVariableReferences("<name> <build>", self.vars)
+        except ErrorCollection, e:
+            self.assertEquals(len(e.errors), 1)
+            self.assertEquals(str(e.errors[0]).startswith("Loop found"), True)
+            self.assertEquals(
+                str(e.errors[0]).endswith(
+                    "['build', 'project', 'root', 'build']"), True)
+        else:
+            self.fail("Loop not found")
+
+    def test_not_cached_if_full_replacement_needed(self):
+        self.vars['name'] = 'a <<b>>'
+        self.vars['b'] = 'x'
+        self.assertEquals(
+            ReplaceVariableReferences("<name>", self.vars), "a x")
+        self.assertEquals('name' in self.vars._resolved, False)
+
+
+class VariableScopeTests(unittest.TestCase):
+    "Tests for the layered variable scopes"
+
+    def setUp(self):
+        self.vars = VariableStore({'a': '1', 'b': '<a>2'})
+
+    def test_reads_through(self):
+        scope = self.vars.scope()
+        self.assertEquals(scope['a'], '1')
+        self.assertEquals(ReplaceVariableReferences("<b>", scope), "12")
+        self.assertEquals(sorted(scope.items()), [('a', '1'), ('b', '<a>2')])
+
+    def test_writes_are_local(self):
+        scope = self.vars.scope()
+        scope['a'] = 'x'
+        scope['c'] = '3'
+
+        self.assertEquals(self.vars, {'a': '1', 'b': '<a>2'})
+        self.assertEquals(scope, {'a': 'x', 'b': '<a>2', 'c': '3'})
+        self.assertEquals(ReplaceVariableReferences("<b>", scope), "x2")
+        self.assertEquals(ReplaceVariableReferences("<b>", self.vars), "12")
+
+    def test_parent_changes_not_seen(self):
+        scope = self.vars.scope()
+        self.vars['a'] = 'changed'
+        self.vars['new'] = 'new'
+
+        self.assertEquals(scope['a'], '1')
+        self.assertEquals('new' in scope, False)
+
+    def test_delete_inherited(self):
+        scope = self.vars.scope()
+        del scope['a']
+
+        self.assertEquals('a' in scope, False)
+        self.assertEquals(scope.get('a'), None)
+        self.assertEquals(dict(scope), {'b': '<a>2'})
+        self.assertEquals(len(scope), 1)
+        self.assertEquals(self.vars['a'], '1')
+        self.assertRaises(KeyError, scope.__delitem__, 'a')
+
+    def test_nested_scopes(self):
+        scope = self.vars
+        for i in range(100):
+            scope = scope.scope()
+            scope['level'] = str(i)
+
+        self.assertEquals(scope['level'], '99')
+        self.assertEquals(scope['a'], '1')
+        self.assertEquals('level' in self.vars, False)
+
+    def test_NewScope_dict(self):
+        variables = {'a': '1'}
+        scope = NewScope(variables)
+        scope['a'] = '2'
+
+        self.assertEquals(isinstance(scope, VariableStore), True)
+        self.assertEquals(variables, {'a': '1'})
+
+
+class LoopVarIndexTests(unittest.TestCase):
+    "Tests for finding variables that match __loopvar__ references"
+
+    def setUp(self):
+        self.vars = VariableStore()
+        for i in range(100):
+            self.vars['shell.var_%d' % i] = 'value'
+        self.vars['map.a'] = 'A'
+        self.vars['list.a.b'] = 'B'
+
+    def test_prefix(self):
+        self.assertEquals(
+            FindVariableMatchingLoopVar("map.__loopvar__", self.vars),
+            "map.a")
+
+    def test_suffix(self):
+        self.assertEquals(
+            FindVariableMatchingLoopVar("__loopvar__.a.b", self.vars),
+            "list.a.b")
+
+    def test_no_match(self):
+        self.assertEquals(
+            FindVariableMatchingLoopVar("other.__loopvar__", self.vars),
+            None)
+
+    def test_index_updated(self):
+        del self.vars['map.a']
+        self.assertEquals(
+            FindVariableMatchingLoopVar("map.__loopvar__", self.vars),
+            None)
+
+        copied = self.vars.copy()
+        copied['map.b'] = 'B'
+        self.assertEquals(
+            FindVariableMatchingLoopVar("map.__loopvar__", copied),
+            "map.b")
+        self.assertEquals(
+            FindVariableMatchingLoopVar("map.__loopvar__", self.vars),
+            None)
+
+    def test_unusual_names(self):
+        # the name does not start with the prefix 'x' but still matches
+        self.vars['start_x'] = 'X'
+        self.assertEquals(
+            FindVariableMatchingLoopVar("x__loopvar__", self.vars), "start_x")
+
+        self.assertEquals(
+            sorted(self.vars.names_matching("map.", "")), ['map.a', 'start_x'])
+
+
+if __name__ == "__main__":
+    unittest.main()
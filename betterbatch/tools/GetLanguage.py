@@ -62,27 +62,31 @@ def GetLangInfo(lang, requested_format):
 
     return language_data[requested_format]
 
-if __name__ == "__main__":
-    import sys
-
+def run_tool(argv):
+    "Run the tool with the command line arguments argv"
     try:
-        req_lang = sys.argv[1].lower()
-        req_format = sys.argv[2].lower()
+        req_lang = argv[0].lower()
+        req_format = argv[1].lower()
     except IndexError:
         print __doc__
-        sys.exit(1)
+        return 1
 
     try:
         lang_info = GetLangInfo(req_lang, req_format)
         if not lang_info.strip():
             print "Language '%s' has no setting for '%s'" % (
                 req_lang, req_format)
-            sys.exit(2)
+            return 2
         print lang_info
     except RuntimeError, e:
         print e
-        sys.exit(1)
+        return 1
 
     # successfully done
-    sys.exit(0)
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(run_tool(sys.argv[1:]))
 
@@ -4,7 +4,7 @@ from fnmatch import fnmatch
 from optparse import OptionParser
 
 
-def ParseArguments():
+def ParseArguments(argv = None):
     parser = OptionParser(
         usage = "%prog [options] (path) (patern1) (pattern2) ...")
 
@@ -14,7 +14,7 @@ def ParseArguments():
         action = "store_true",
         help = "scan recursively")
 
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(argv)
 
     if not args:
         parser.print_help()
@@ -33,8 +33,9 @@ def ParseArguments():
     return options
 
 
-if __name__ == "__main__":
-    options = ParseArguments()
+def run_tool(argv):
+    "Run the tool with the command line arguments argv"
+    options = ParseArguments(argv)
 
     for root, dir, files in os.walk(options.search_path):
         for filename in files:
@@ -42,6 +43,15 @@ if __name__ == "__main__":
                 if fnmatch(filename, pattern):
                     print '%s'% os.path.abspath(os.path.join(root, filename))
                     break
-                    
+
+        # let a {*stream*} loop start on the files found so far
+        sys.stdout.flush()
+
         if not options.recursive:
             break
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_tool(sys.argv[1:]))
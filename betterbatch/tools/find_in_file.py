@@ -4,7 +4,7 @@ import sys
 from optparse import OptionParser
 
 
-def GetArguments():
+def GetArguments(argv = None):
     parser = OptionParser("$prog [-r] file text_to_find [text_to_find...]")
 
     parser.add_option("-r", "--regex", default = False, action = "store_true",
@@ -15,7 +15,7 @@ def GetArguments():
                       help="ignore case when searching")
 
     # parse the command line arguments
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
 
     if not args:
         parser.print_help()
@@ -24,8 +24,9 @@ def GetArguments():
     return options, args
 
 
-if __name__ == "__main__":
-    options, args = GetArguments()
+def run_tool(argv):
+    "Run the tool with the command line arguments argv"
+    options, args = GetArguments(argv)
     filename = args[0]
     texts_to_find = args[1:]
 
@@ -52,11 +53,15 @@ if __name__ == "__main__":
 
         # if it was not found - then check if we need to return an error code
         if not found and not options.noerr:
-            sys.exit(1)
+            return 1
 
         # print out any found items
         for found_item in found:
             print found_item
 
     # return success
-    sys.exit(0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_tool(sys.argv[1:]))
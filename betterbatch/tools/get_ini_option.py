@@ -75,17 +75,22 @@ def main(ini_file, section, value, default = None):
         return -4
 
 
-if __name__ == "__main__":
-    if len(sys.argv) <= 3:
+def run_tool(argv):
+    "Run the tool with the command line arguments argv"
+    if len(argv) <= 2:
         print __doc__
-        sys.exit(1)
+        return 1
     else:
-        ini_file = sys.argv[1]
-        section = sys.argv[2]
-        value = sys.argv[3]
+        ini_file = argv[0]
+        section = argv[1]
+        value = argv[2]
 
     default = None
-    if len(sys.argv) >= 5:
-        default = sys.argv[4]
+    if len(argv) >= 4:
+        default = argv[3]
+
+    return main(ini_file, section, value, default)
 
-    sys.exit(main(ini_file, section, value, default))
+
+if __name__ == "__main__":
+    sys.exit(run_tool(sys.argv[1:]))
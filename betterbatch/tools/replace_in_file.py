@@ -20,7 +20,7 @@ if not (sys.version_info[0] == 2 and sys.version_info[1] == 5):
         1, (getattr(codecs, "BOM_UTF32_LE"), 'utf-32-le'))
 
 
-def get_arguments():
+def get_arguments(argv = None):
     parser = OptionParser("$prog [-rn] [--encoding enc] filepath to_find replace_with")
 
     parser.add_option("-r", "--regex",
@@ -48,7 +48,7 @@ def get_arguments():
                         "http://docs.python.org/library/codecs.html#standard-encodings.")
 
     # parse the command line arguments
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
 
     if not args:
         parser.print_help()
@@ -172,11 +172,16 @@ def main(filename, to_find, replace_with, options):
     return 0
 
 
-if __name__ == "__main__":
-    options, args = get_arguments()
+def run_tool(argv):
+    "Run the tool with the command line arguments argv"
+    options, args = get_arguments(argv)
     filename = os.path.abspath(args[0])
     to_find = args[1]
     replace_with = args[2]
 
-    sys.exit(main(filename, to_find, replace_with, options))
+    return main(filename, to_find, replace_with, options)
+
+
+if __name__ == "__main__":
+    sys.exit(run_tool(sys.argv[1:]))
 
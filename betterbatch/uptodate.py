@@ -0,0 +1,150 @@
+"""Skip commands whose outputs are up to date (like make)
+
+A command with {*outputs=...*} (and usually {*inputs=...*}) is skipped if all
+of its outputs exist and every output is newer than every input. With the
+{*hash*} qualifier the contents of the inputs are compared instead: the
+command is skipped if the outputs exist and the inputs have the same contents
+as the last time that the command succeeded. The hashes are kept in the
+state database (see statedb).
+
+Inputs and outputs are lists of file names or wildcards separated by commas.
+"""
+from __future__ import absolute_import
+
+import os
+import glob
+import hashlib
+import time
+
+from . import statedb
+
+# Files changed this recently could change again without their modification
+# time changing - so their hashes are not kept
+MTIME_RESOLUTION = 2
+
+statedb.AddTable(
+    "CREATE TABLE IF NOT EXISTS command_inputs ("
+        "command TEXT PRIMARY KEY, digest TEXT)")
+statedb.AddTable(
+    "CREATE TABLE IF NOT EXISTS file_hashes ("
+        "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, digest TEXT)")
+
+
+def SplitPatterns(value):
+    "Return the file names/wildcards in the value of a qualifier"
+    if not value:
+        return []
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+
+def MatchingFiles(patterns):
+    """Return the files matched by the patterns
+
+    Returns None if any pattern does not match an existing file"""
+    files = set()
+    for pattern in patterns:
+        matched = [path for path in glob.glob(pattern) if os.path.isfile(path)]
+        if not matched:
+            return None
+        files.update([os.path.abspath(path) for path in matched])
+    return sorted(files)
+
+
+def FileHash(path):
+    """Return the hash of the contents of the file
+
+    Hashes are stored with the size and modification time of the file, so a
+    file is only read again when it changes"""
+    stat = os.stat(path)
+    rows = statedb.Query(
+        "SELECT mtime, size, digest FROM file_hashes WHERE path = ?", (path,))
+    if rows and rows[0][0] == stat.st_mtime and rows[0][1] == stat.st_size:
+        return rows[0][2]
+
+    hasher = hashlib.sha1()
+    contents = open(path, "rb")
+    try:
+        while True:
+            data = contents.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        contents.close()
+    digest = hasher.hexdigest()
+
+    if time.time() - stat.st_mtime < MTIME_RESOLUTION:
+        return digest
+    statedb.Update(
+        "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+        (path, stat.st_mtime, stat.st_size, digest))
+    return digest
+
+
+class UpToDateCheck(object):
+    "Decide if a command can be skipped - and record when it succeeds"
+
+    def __init__(self, command, inputs, outputs, use_hash = False):
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.use_hash = use_hash
+        self.digest = None
+
+    def key(self):
+        """Return the key of the command in the database
+
+        The command is hashed as it could include hidden variables"""
+        return hashlib.sha1("%s\n%s" % (os.getcwd(), self.command)).hexdigest()
+
+    def inputs_digest(self, input_files):
+        "Return a hash of the names and contents of the input files"
+        hasher = hashlib.sha1()
+        for path in input_files:
+            hasher.update("%s\0%s\0" % (path, FileHash(path)))
+        return hasher.hexdigest()
+
+    def skip_reason(self):
+        "Return why the command can be skipped (None if it has to be run)"
+        input_files = MatchingFiles(self.inputs)
+        if input_files is None:
+            # let the command report the missing input
+            return None
+
+        if self.use_hash:
+            # the inputs are hashed before the command runs (they could be
+            # changed while it runs)
+            self.digest = self.inputs_digest(input_files)
+
+        if self.outputs:
+            output_files = MatchingFiles(self.outputs)
+            if output_files is None:
+                return None
+        elif not self.use_hash:
+            # nothing to compare the inputs with
+            return None
+
+        if self.use_hash:
+            rows = statedb.Query(
+                "SELECT digest FROM command_inputs WHERE command = ?",
+                (self.key(),))
+            if rows and rows[0][0] == self.digest:
+                return "the inputs have not changed"
+            return None
+
+        if not input_files:
+            return "the outputs exist"
+
+        newest_input = max([os.stat(path).st_mtime for path in input_files])
+        oldest_output = min([os.stat(path).st_mtime for path in output_files])
+        if oldest_output > newest_input:
+            return "the outputs are newer than the inputs"
+        return None
+
+    def record(self):
+        "Record that the command succeeded (only needed when using hashes)"
+        if self.digest is None:
+            return
+        statedb.Update(
+            "INSERT OR REPLACE INTO command_inputs VALUES (?, ?)",
+            (self.key(), self.digest))